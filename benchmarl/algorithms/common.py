@@ -10,6 +10,7 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
 
+import torch
 from tensordict import TensorDictBase
 from tensordict.nn import TensorDictModule, TensorDictSequential
 from torchrl.data import (
@@ -29,8 +30,12 @@ from torchrl.envs import Compose, EnvBase, Transform
 from torchrl.objectives import LossModule
 from torchrl.objectives.utils import HardUpdate, SoftUpdate, TargetNetUpdater
 
-from benchmarl.models.common import ModelConfig
-from benchmarl.utils import _read_yaml_config, DEVICE_TYPING
+from benchmarl.algorithms.replay_buffer import (
+    EpochTensorDictReplayBuffer,
+    PrefetchTensorDictReplayBuffer,
+)
+from benchmarl.models.common import AGENT_MASK_KEY, ModelConfig
+from benchmarl.utils import _read_yaml_config, DEVICE_TYPING, SEQUENCE_PADDING_KEY
 
 
 class Algorithm(ABC):
@@ -126,6 +131,13 @@ class Algorithm(ABC):
                 policy_for_loss=self.get_policy_for_loss(group),
                 continuous=continuous,
             )
+            if (group, AGENT_MASK_KEY) in self.observation_spec.keys(
+                True, True
+            ) and not isinstance(loss, _AgentMaskedLoss):
+                raise ValueError(
+                    f"Group {group} has an agent mask, but its {type(loss).__name__} does not support padded agents "
+                    "and would average them in the loss. Choose an algorithm that leaves them out of its losses."
+                )
             if use_target:
                 if self.experiment_config.soft_target_update:
                     target_net_updater = SoftUpdate(
@@ -157,11 +169,17 @@ class Algorithm(ABC):
         memory_size = self.experiment_config.replay_buffer_memory_size(self.on_policy)
         sampling_size = self.experiment_config.train_minibatch_size(self.on_policy)
         if self.has_rnn:
-            sequence_length = -(
+            collected_sequence_length = -(
                 -self.experiment_config.collected_frames_per_batch(self.on_policy)
-                // self.experiment_config.n_envs_per_worker(self.on_policy)
+                // self.experiment_config.n_envs(self.on_policy)
+            )
+            sequence_length = self.experiment_config.train_sequence_length(
+                self.on_policy
+            )
+            # Collected sequences are stored as windows of sequence_length
+            memory_size = -(-memory_size // collected_sequence_length) * -(
+                -collected_sequence_length // sequence_length
             )
-            memory_size = -(-memory_size // sequence_length)
             sampling_size = -(-sampling_size // sequence_length)
 
         # Sampler
@@ -189,12 +207,36 @@ class Algorithm(ABC):
                 device=self.device if self.on_policy else self.buffer_device,
             )
 
-        return TensorDictReplayBuffer(
+        buffer_kwargs = {}
+        if self.on_policy and self.experiment_config.on_policy_use_epoch_sampler:
+            # Shuffles once per epoch and samples minibatches as views of the shuffled data
+            buffer_class = EpochTensorDictReplayBuffer
+        elif not self.on_policy and self.experiment_config.off_policy_prefetch_batches:
+            # Samples the next batches in a background thread
+            buffer_class = PrefetchTensorDictReplayBuffer
+            buffer_kwargs[
+                "prefetch_batches"
+            ] = self.experiment_config.off_policy_prefetch_batches
+            buffer_kwargs["pin_memory"] = (
+                storage.device == torch.device("cpu")
+                and torch.device(self.device).type == "cuda"
+            )
+            # The thread samples with its own generator, so that it does not draw from the global one
+            # (prioritized samplers draw on the cpu and the other ones on the storage device)
+            buffer_kwargs["generator"] = torch.Generator(
+                device="cpu"
+                if isinstance(sampler, PrioritizedSampler)
+                else storage.device
+            ).manual_seed(self.experiment.seed)
+        else:
+            buffer_class = TensorDictReplayBuffer
+        return buffer_class(
             storage=storage,
             sampler=sampler,
             batch_size=sampling_size,
             priority_key=(group, "td_error"),
             transform=Compose(*transforms) if transforms is not None else None,
+            **buffer_kwargs,
         )
 
     def get_policy_for_loss(self, group: str) -> TensorDictModule:
@@ -364,6 +406,52 @@ class Algorithm(ABC):
         return loss_vals
 
 
+class _AgentMaskedLoss:
+    """Mixin for torchrl losses built with ``reduction="none"``, averaging the per-agent loss terms over the agents present.
+
+    The terms of the padded agents (``False`` in the :data:`~benchmarl.models.common.AGENT_MASK_KEY` entry of the
+    group) are left out of the mean, so padded agents get no gradient. So are the padding steps of recurrent
+    training windows (see :data:`~benchmarl.utils.SEQUENCE_PADDING_KEY`).
+    Without agent masks and padding, this is the mean reduction.
+    Groups with agent masks can only be trained with losses using this mixin.
+
+    Args:
+        group (str): the agent group of the loss.
+
+    """
+
+    def __init__(self, *args, group: str, **kwargs):
+        super().__init__(*args, reduction="none", **kwargs)
+        self.group = group
+        self.agent_mask_key = (group, AGENT_MASK_KEY)
+
+    def forward(self, tensordict: TensorDictBase) -> TensorDictBase:
+        loss_vals = super().forward(tensordict)
+        agent_mask = tensordict.get(self.agent_mask_key, None)
+        padding = tensordict.get(SEQUENCE_PADDING_KEY, None)
+        if padding is not None:
+            present = ~padding.unsqueeze(-1).expand(
+                tensordict.get(self.group).batch_size
+            )
+            agent_mask = (
+                present if agent_mask is None else agent_mask.to(torch.bool) & present
+            )
+        for key, value in loss_vals.items():
+            if key.startswith("loss"):
+                loss_vals.set(key, _masked_mean(value, agent_mask))
+            elif key == "ESS":
+                # The effective sample size is computed per agent
+                loss_vals.set(key, value.mean())
+        return loss_vals
+
+
+def _masked_mean(value: torch.Tensor, agent_mask: Optional[torch.Tensor]):
+    if agent_mask is None:
+        return value.mean()
+    agent_mask = agent_mask.to(torch.bool).expand(value.shape)
+    return torch.where(agent_mask, value, 0).sum() / agent_mask.sum().clamp(min=1)
+
+
 @dataclass
 class AlgorithmConfig:
     """
@@ -17,8 +17,13 @@ from torchrl.modules import IndependentNormal, ProbabilisticActor, TanhNormal
 from torchrl.modules.distributions import MaskedCategorical
 from torchrl.objectives import ClipPPOLoss, LossModule, ValueEstimators
 
-from benchmarl.algorithms.common import Algorithm, AlgorithmConfig
+from benchmarl.algorithms.common import _AgentMaskedLoss, Algorithm, AlgorithmConfig
 from benchmarl.models.common import ModelConfig
+from benchmarl.models.gnn import STORED_GRAPH_KEY
+
+
+class _ClipPPOLoss(_AgentMaskedLoss, ClipPPOLoss):
+    """:class:`~torchrl.objectives.ClipPPOLoss` averaged over the agents present."""
 
 
 class Ippo(Algorithm):
@@ -75,7 +80,8 @@ class Ippo(Algorithm):
         self, group: str, policy_for_loss: TensorDictModule, continuous: bool
     ) -> Tuple[LossModule, bool]:
         # Loss
-        loss_module = ClipPPOLoss(
+        loss_module = _ClipPPOLoss(
+            group=group,
             actor=policy_for_loss,
             critic=self.get_critic(group),
             clip_epsilon=self.clip_epsilon,
@@ -243,10 +249,14 @@ class Ippo(Algorithm):
             minimbatch = batch[last_start_index:start_index]
             minibatches.append(minimbatch)
             with torch.no_grad():
-                loss.value_estimator(
-                    minimbatch,
-                    params=loss.critic_network_params,
-                    target_params=loss.target_critic_network_params,
+                # Stored graphs are not kept in the next data (see Experiment._get_excluded_keys),
+                # so the critic rebuilds the graphs of both when evaluating them together
+                minimbatch.update(
+                    loss.value_estimator(
+                        minimbatch.exclude((group, STORED_GRAPH_KEY)),
+                        params=loss.critic_network_params,
+                        target_params=loss.target_critic_network_params,
+                    )
                 )
             last_start_index = start_index
             start_index += increment
@@ -13,10 +13,14 @@ from torchrl.data import Composite, Unbounded
 from torchrl.modules import EGreedyModule, QValueModule
 from torchrl.objectives import DQNLoss, LossModule, ValueEstimators
 
-from benchmarl.algorithms.common import Algorithm, AlgorithmConfig
+from benchmarl.algorithms.common import _AgentMaskedLoss, Algorithm, AlgorithmConfig
 from benchmarl.models.common import ModelConfig
 
 
+class _DQNLoss(_AgentMaskedLoss, DQNLoss):
+    """:class:`~torchrl.objectives.DQNLoss` averaged over the agents present."""
+
+
 class Iql(Algorithm):
     """Independent Q Learning (from `https://www.semanticscholar.org/paper/Multi-Agent-Reinforcement-Learning%3A-Independent-Tan/59de874c1e547399b695337bcff23070664fa66e <https://www.semanticscholar.org/paper/Multi-Agent-Reinforcement-Learning%3A-Independent-Tan/59de874c1e547399b695337bcff23070664fa66e>`__).
 
@@ -44,8 +48,9 @@ class Iql(Algorithm):
             raise NotImplementedError("Iql is not compatible with continuous actions.")
         else:
             # Loss
-            loss_module = DQNLoss(
+            loss_module = _DQNLoss(
                 policy_for_loss,
+                group=group,
                 delay_value=self.delay_value,
                 loss_function=self.loss_function,
                 action_space=self.action_spec[group, "action"],
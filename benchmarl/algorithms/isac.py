@@ -19,10 +19,18 @@ from torchrl.modules import (
 )
 from torchrl.objectives import DiscreteSACLoss, LossModule, SACLoss, ValueEstimators
 
-from benchmarl.algorithms.common import Algorithm, AlgorithmConfig
+from benchmarl.algorithms.common import _AgentMaskedLoss, Algorithm, AlgorithmConfig
 from benchmarl.models.common import ModelConfig
 
 
+class _SACLoss(_AgentMaskedLoss, SACLoss):
+    """:class:`~torchrl.objectives.SACLoss` averaged over the agents present."""
+
+
+class _DiscreteSACLoss(_AgentMaskedLoss, DiscreteSACLoss):
+    """:class:`~torchrl.objectives.DiscreteSACLoss` averaged over the agents present."""
+
+
 class Isac(Algorithm):
     """Independent Soft Actor Critic.
 
@@ -90,7 +98,8 @@ class Isac(Algorithm):
     ) -> Tuple[LossModule, bool]:
         if continuous:
             # Loss
-            loss_module = SACLoss(
+            loss_module = _SACLoss(
+                group=group,
                 actor_network=policy_for_loss,
                 qvalue_network=self.get_continuous_value_module(group),
                 num_qvalue_nets=self.num_qvalue_nets,
@@ -113,7 +122,8 @@ class Isac(Algorithm):
             )
 
         else:
-            loss_module = DiscreteSACLoss(
+            loss_module = _DiscreteSACLoss(
+                group=group,
                 actor_network=policy_for_loss,
                 qvalue_network=self.get_discrete_value_module(group),
                 num_qvalue_nets=self.num_qvalue_nets,
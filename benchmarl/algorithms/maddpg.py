@@ -13,10 +13,14 @@ from torchrl.data import Composite, Unbounded
 from torchrl.modules import AdditiveGaussianModule, Delta, ProbabilisticActor, TanhDelta
 from torchrl.objectives import DDPGLoss, LossModule, ValueEstimators
 
-from benchmarl.algorithms.common import Algorithm, AlgorithmConfig
+from benchmarl.algorithms.common import _AgentMaskedLoss, Algorithm, AlgorithmConfig
 from benchmarl.models.common import ModelConfig
 
 
+class _DDPGLoss(_AgentMaskedLoss, DDPGLoss):
+    """:class:`~torchrl.objectives.DDPGLoss` averaged over the agents present."""
+
+
 class Maddpg(Algorithm):
     """Multi Agent DDPG (from `https://arxiv.org/abs/1706.02275 <https://arxiv.org/abs/1706.02275>`__).
 
@@ -53,7 +57,8 @@ class Maddpg(Algorithm):
     ) -> Tuple[LossModule, bool]:
         if continuous:
             # Loss
-            loss_module = DDPGLoss(
+            loss_module = _DDPGLoss(
+                group=group,
                 actor_network=policy_for_loss,
                 value_network=self.get_value_module(group),
                 delay_value=self.delay_value,
@@ -22,10 +22,18 @@ from torchrl.modules import (
 )
 from torchrl.objectives import DiscreteSACLoss, LossModule, SACLoss, ValueEstimators
 
-from benchmarl.algorithms.common import Algorithm, AlgorithmConfig
+from benchmarl.algorithms.common import _AgentMaskedLoss, Algorithm, AlgorithmConfig
 from benchmarl.models.common import ModelConfig
 
 
+class _SACLoss(_AgentMaskedLoss, SACLoss):
+    """:class:`~torchrl.objectives.SACLoss` averaged over the agents present."""
+
+
+class _DiscreteSACLoss(_AgentMaskedLoss, DiscreteSACLoss):
+    """:class:`~torchrl.objectives.DiscreteSACLoss` averaged over the agents present."""
+
+
 class Masac(Algorithm):
     """Multi Agent Soft Actor Critic.
 
@@ -99,7 +107,8 @@ class Masac(Algorithm):
     ) -> Tuple[LossModule, bool]:
         if continuous:
             # Loss
-            loss_module = SACLoss(
+            loss_module = _SACLoss(
+                group=group,
                 actor_network=policy_for_loss,
                 qvalue_network=self.get_continuous_value_module(group),
                 num_qvalue_nets=self.num_qvalue_nets,
@@ -127,7 +136,8 @@ class Masac(Algorithm):
                     "disabling share_param_critic in MASAC with discrete actions and coupled_discrete_values has not effect"
                     "as the critic is already able to predict different values for different agents."
                 )
-            loss_module = DiscreteSACLoss(
+            loss_module = _DiscreteSACLoss(
+                group=group,
                 actor_network=policy_for_loss,
                 qvalue_network=self.get_discrete_value_module_decoupled(group)
                 if not self.coupled_discrete_values
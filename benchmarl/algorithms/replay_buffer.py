@@ -0,0 +1,187 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+
+import threading
+from collections import deque
+from typing import Any, Optional, Tuple
+
+import torch
+from tensordict import TensorDictBase
+from tensordict.nn.utils import _set_dispatch_td_nn_modules
+from torchrl.data import TensorDictReplayBuffer
+from torchrl.data.replay_buffers.utils import pin_memory_output
+
+
+class EpochTensorDictReplayBuffer(TensorDictReplayBuffer):
+    """Replay buffer for on-policy minibatch training that samples whole epochs at once.
+
+    At the first ``sample`` of each epoch, the stored data is shuffled with a single permutation,
+    which results in one gather on the storage device.
+    The following ``sample`` calls return contiguous slices of the shuffled data, which are views
+    and do not copy it, until the epoch is exhausted (the last minibatch can be smaller if the
+    batch size does not divide the buffer length, as in :class:`~torchrl.data.replay_buffers.SamplerWithoutReplacement`).
+    Extending or emptying the buffer starts a new epoch.
+
+    The buffer takes the same arguments as :class:`~torchrl.data.TensorDictReplayBuffer`.
+    The sampler is ignored when sampling.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reset_epoch()
+
+    def _reset_epoch(self):
+        self._epoch_data: Optional[TensorDictBase] = None
+        self._epoch_index: Optional[torch.Tensor] = None
+        self._epoch_cursor = 0
+
+    def extend(self, *args, **kwargs):
+        self._reset_epoch()
+        return super().extend(*args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        self._reset_epoch()
+        return super().add(*args, **kwargs)
+
+    def empty(self, *args, **kwargs):
+        self._reset_epoch()
+        return super().empty(*args, **kwargs)
+
+    def load_state_dict(self, *args, **kwargs):
+        self._reset_epoch()
+        return super().load_state_dict(*args, **kwargs)
+
+    @pin_memory_output
+    def _sample(self, batch_size: int) -> Tuple[Any, dict]:
+        # Same as TensorDictReplayBuffer._sample, with the sampler and storage gather replaced by the epoch slices
+        with self._replay_lock, self._write_lock:
+            if self._epoch_data is None or self._epoch_cursor >= len(self._epoch_index):
+                self._epoch_index = torch.randperm(len(self._storage))
+                self._epoch_data = self._storage.get(self._epoch_index)
+                self._epoch_cursor = 0
+            start, end = self._epoch_cursor, self._epoch_cursor + batch_size
+            index = self._epoch_index[start:end]
+            data = self._epoch_data[start:end]
+            self._epoch_cursor = end
+        data = self._collate_fn(data)
+
+        if self._transform is not None and len(self._transform):
+            with data.unlock_(), _set_dispatch_td_nn_modules(True):
+                data = self._transform(data)
+        return data, {"index": index}
+
+
+class PrefetchTensorDictReplayBuffer(TensorDictReplayBuffer):
+    """Replay buffer that prepares the next batches in a background thread.
+
+    Once data has been written to the buffer, a background thread keeps a bounded queue of
+    ``prefetch_batches`` sampled batches (with transforms applied), so that
+    ``sample`` calls only have to pop them.
+    Setting ``pin_memory=True`` pins the prefetched batches, which speeds up their transfer to cuda.
+
+    All writes (``extend``, ``add``, ``empty`` and ``load_state_dict``) discard the prefetched batches,
+    so the indices of returned batches always refer to the current content of the storage and
+    ``update_tensordict_priority`` stays correct with a :class:`~torchrl.data.replay_buffers.PrioritizedSampler`.
+    Priority updates are applied as usual, which means batches that have already been prefetched were sampled using
+    priorities that are at most ``prefetch_batches`` updates old.
+    This is why the buffer does not use the ``prefetch`` option of :class:`~torchrl.data.ReplayBuffer`, which keeps
+    returning the batches prefetched before a write, whose indices may refer to overwritten data.
+
+    The number of batches that are sampled and discarded depends on the timing of the thread, so the sampled batches are
+    not reproducible across seeded runs. Give the buffer its own ``generator`` so that the thread does not draw from the
+    global random number generator (and does not change the rest of the run).
+
+    Args:
+        prefetch_batches (int): the maximum number of batches to prefetch.
+        *args, **kwargs: the arguments of :class:`~torchrl.data.TensorDictReplayBuffer`
+
+    """
+
+    def __init__(self, *args, prefetch_batches: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        if prefetch_batches < 1:
+            raise ValueError("prefetch_batches must be greater than zero")
+        self._prefetch_batches = prefetch_batches
+        self._prefetch_thread: Optional[threading.Thread] = None
+        self._prefetch_condition = threading.Condition()
+        self._prefetch_queue = deque()
+        self._prefetch_generation = 0
+        self._prefetch_ready = False
+        self._prefetch_stop = False
+
+    def _invalidate_prefetch(self, ready: bool):
+        with self._prefetch_condition:
+            self._prefetch_generation += 1
+            self._prefetch_queue.clear()
+            self._prefetch_ready = ready
+            self._prefetch_condition.notify_all()
+
+    def extend(self, *args, **kwargs):
+        # Invalidate after writing, so that batches sampled during the write are discarded
+        index = super().extend(*args, **kwargs)
+        self._invalidate_prefetch(ready=True)
+        return index
+
+    def add(self, *args, **kwargs):
+        index = super().add(*args, **kwargs)
+        self._invalidate_prefetch(ready=True)
+        return index
+
+    def empty(self, *args, **kwargs):
+        super().empty(*args, **kwargs)
+        self._invalidate_prefetch(ready=False)
+
+    def load_state_dict(self, *args, **kwargs):
+        super().load_state_dict(*args, **kwargs)
+        self._invalidate_prefetch(ready=len(self) > 0)
+
+    def _prefetch_loop(self):
+        while True:
+            with self._prefetch_condition:
+                self._prefetch_condition.wait_for(
+                    lambda: self._prefetch_stop
+                    or (
+                        self._prefetch_ready
+                        and len(self._prefetch_queue) < self._prefetch_batches
+                    )
+                )
+                if self._prefetch_stop:
+                    return
+                generation = self._prefetch_generation
+            try:
+                result = super()._sample(self._batch_size)
+            except Exception as err:
+                result = err
+            with self._prefetch_condition:
+                if generation == self._prefetch_generation:
+                    self._prefetch_queue.append(result)
+                    self._prefetch_condition.notify_all()
+
+    def _sample(self, batch_size: int) -> Tuple[Any, dict]:
+        if batch_size != self._batch_size or not self._prefetch_ready:
+            return super()._sample(batch_size)
+        if self._prefetch_thread is None:
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch_loop, daemon=True
+            )
+            self._prefetch_thread.start()
+        with self._prefetch_condition:
+            self._prefetch_condition.wait_for(lambda: len(self._prefetch_queue) > 0)
+            result = self._prefetch_queue.popleft()
+            self._prefetch_condition.notify_all()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def shutdown(self):
+        """Stops the prefetching thread."""
+        with self._prefetch_condition:
+            self._prefetch_stop = True
+            self._prefetch_condition.notify_all()
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+            self._prefetch_thread = None
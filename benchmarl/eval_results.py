@@ -4,12 +4,20 @@
 #  LICENSE file in the root directory of this source tree.
 #
 
-import collections
+import contextlib
 import importlib
 import json
+import os
+import sqlite3
+import sys
+import warnings
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from os import walk
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+
+from benchmarl.utils import _merge_dicts, _read_json_dict
 
 _has_marl_eval = importlib.util.find_spec("marl_eval") is not None
 if _has_marl_eval:
@@ -26,10 +34,23 @@ if _has_marl_eval:
     )
     from matplotlib import pyplot as plt
 
+RESULTS_INDEX_FILE_NAME = ".benchmarl_results_index.sqlite"
+
 
-def get_raw_dict_from_multirun_folder(multirun_folder: str) -> Dict:
+def get_raw_dict_from_multirun_folder(
+    multirun_folder: str,
+    use_index: bool = True,
+    n_workers: Optional[int] = None,
+) -> Dict:
     """Get the ``marl-eval`` input dictionary from the folder of a hydra multirun.
 
+    By default, the loaded files and their merged dictionary are cached in an index (an sqlite database stored at
+    ``multirun_folder/.benchmarl_results_index.sqlite``) keyed by file path, modification time and size.
+    Following calls return the cached dictionary if no file changed, and otherwise only load the files that
+    were added or changed since the last call.
+    The index stores the dictionaries in columns of json text and numeric arrays (never pickled),
+    and is rebuilt if it is corrupted.
+
     Examples:
         .. code-block:: python
 
@@ -41,53 +62,236 @@ def get_raw_dict_from_multirun_folder(multirun_folder: str) -> Dict:
 
     Args:
         multirun_folder (str): the absolute path to the multirun folder
+        use_index (bool): whether to use the cached index of the loaded files. If the index cannot be created
+            (e.g., the folder is read-only), files are loaded without it. Default: ``True``.
+        n_workers (int, optional): number of threads used to load the files. If ``None``, it uses
+            the default of :class:`~concurrent.futures.ThreadPoolExecutor`.
 
     Returns:
         the dict obtained by merging all the json files in the multirun
 
     """
-    return load_and_merge_json_dicts(_get_json_files_from_multirun(multirun_folder))
+    json_files = _get_json_files_from_multirun(multirun_folder)
+    if use_index:
+        index_file = Path(multirun_folder) / RESULTS_INDEX_FILE_NAME
+        try:
+            try:
+                return _load_merged_dict_with_index(
+                    json_files, index_file=str(index_file), n_workers=n_workers
+                )
+            except sqlite3.DatabaseError as err:
+                if isinstance(err, sqlite3.OperationalError) or not index_file.exists():
+                    raise
+                # The index is corrupted, it is rebuilt
+                warnings.warn(
+                    f"Rebuilding the corrupted results index: {err}", stacklevel=2
+                )
+                index_file.unlink()
+                return _load_merged_dict_with_index(
+                    json_files, index_file=str(index_file), n_workers=n_workers
+                )
+        except (sqlite3.DatabaseError, OSError) as err:
+            warnings.warn(f"Could not use the results index: {err}", stacklevel=2)
+    return _merge_json_dicts(_load_json_dicts(json_files, n_workers=n_workers))
 
 
 def _get_json_files_from_multirun(multirun_folder: str) -> List[str]:
     files = []
     for dirpath, _, filenames in walk(multirun_folder):
         for file_name in filenames:
-            if file_name.endswith(".json") and "wandb" not in file_name:
+            if (
+                file_name.endswith(".json") or file_name.endswith(".jsonl")
+            ) and "wandb" not in file_name:
                 files.append(str(Path(dirpath) / Path(file_name)))
-    return files
+    return sorted(files)
+
+
+def _load_json_dicts(
+    json_input_files: List[str], n_workers: Optional[int] = None
+) -> List[Dict]:
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(_read_json_dict, json_input_files))
+
+
+def _merge_json_dicts(dicts: List[Dict]) -> Dict:
+    full_dict = {}
+    for single_dict in dicts:
+        _merge_dicts(full_dict, single_dict)
+    return full_dict
+
+
+def _load_merged_dict_with_index(
+    json_input_files: List[str], index_file: str, n_workers: Optional[int] = None
+) -> Dict:
+    """Loads and merges json dictionaries, reusing the ones of the files that are up to date in the index.
+
+    The merged dictionary is also stored in the index, and returned as is if no file changed.
+    See :func:`_encode_json_dict` for the format of the stored dictionaries.
+    """
+    with contextlib.closing(sqlite3.connect(index_file)) as connection:
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_results (path TEXT PRIMARY KEY, "
+                "mtime_ns INTEGER, size INTEGER, structure TEXT, other TEXT, floats BLOB, ints BLOB)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS merged_results (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                "files TEXT, structure TEXT, other TEXT, floats BLOB, ints BLOB)"
+            )
+
+        stats = {}
+        for file in json_input_files:
+            stat = os.stat(file)
+            stats[file] = (stat.st_mtime_ns, stat.st_size)
+        files_key = json.dumps([[file, *stats[file]] for file in json_input_files])
+        merged = connection.execute(
+            "SELECT structure, other, floats, ints FROM merged_results WHERE files = ?",
+            (files_key,),
+        ).fetchone()
+        if merged is not None:
+            return _decode_json_dict(*merged)
+
+        indexed = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in connection.execute(
+                "SELECT path, mtime_ns, size FROM file_results"
+            )
+        }
+        files_to_load = [
+            file for file in json_input_files if indexed.get(file) != stats[file]
+        ]
+        loaded_dicts = dict(
+            zip(files_to_load, _load_json_dicts(files_to_load, n_workers=n_workers))
+        )
+        indexed_dicts = {}
+        if len(loaded_dicts) < len(json_input_files):
+            indexed_dicts = {
+                path: columns
+                for path, *columns in connection.execute(
+                    "SELECT path, structure, other, floats, ints FROM file_results"
+                )
+            }
+        full_dict = _merge_json_dicts(
+            [
+                (
+                    loaded_dicts[file]
+                    if file in loaded_dicts
+                    else _decode_json_dict(*indexed_dicts[file])
+                )
+                for file in json_input_files
+            ]
+        )
+
+        with connection:
+            connection.executemany(
+                "DELETE FROM file_results WHERE path = ?",
+                [(path,) for path in indexed.keys() if path not in stats],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO file_results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (file, *stats[file], *_encode_json_dict(loaded_dict))
+                    for file, loaded_dict in loaded_dicts.items()
+                ],
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO merged_results VALUES (0, ?, ?, ?, ?, ?)",
+                (files_key, *_encode_json_dict(full_dict)),
+            )
+    return full_dict
+
+
+def _encode_json_dict(json_dict: Dict) -> Tuple[str, str, bytes, bytes]:
+    """Encodes a json dictionary in columns, which are faster to load than its json text.
+
+    The values of marl-eval dictionaries are mostly lists of floats (the metrics) and integers (the step counts),
+    which are stored in binary arrays. The structure of the dictionary is stored as json text, with the length of
+    each list of floats in place of the list, ``0`` in place of each integer and ``-i - 1`` in place of the
+    ``i``-th other value, which are stored as a json list.
+    """
+    floats, ints, other = array("d"), array("q"), []
+
+    def encode(node: Dict) -> Dict:
+        structure = {}
+        for key, value in node.items():
+            if isinstance(value, dict):
+                structure[key] = encode(value)
+            elif (
+                type(value) is list
+                and len(value)
+                and all(type(v) is float for v in value)
+            ):
+                structure[key] = len(value)
+                floats.extend(value)
+            elif type(value) is int and -(2**63) <= value < 2**63:
+                structure[key] = 0
+                ints.append(value)
+            else:
+                structure[key] = -len(other) - 1
+                other.append(value)
+        return structure
+
+    structure = encode(json_dict)
+    if sys.byteorder != "little":
+        floats.byteswap()
+        ints.byteswap()
+    return json.dumps(structure), json.dumps(other), floats.tobytes(), ints.tobytes()
+
+
+def _decode_json_dict(structure: str, other: str, floats: bytes, ints: bytes) -> Dict:
+    """Inverse of :func:`_encode_json_dict`."""
+    float_array, int_array = array("d"), array("q")
+    float_array.frombytes(floats)
+    int_array.frombytes(ints)
+    if sys.byteorder != "little":
+        float_array.byteswap()
+        int_array.byteswap()
+    float_values, int_values = float_array.tolist(), iter(int_array.tolist())
+    other = json.loads(other)
+    start = 0
+
+    def decode(node: Dict):
+        nonlocal start
+        for key, value in node.items():
+            if type(value) is dict:
+                decode(value)
+            elif value > 0:
+                node[key] = float_values[start : start + value]
+                start += value
+            elif value == 0:
+                node[key] = next(int_values)
+            else:
+                node[key] = other[-value - 1]
+
+    json_dict = json.loads(structure)
+    decode(json_dict)
+    return json_dict
 
 
 def load_and_merge_json_dicts(
-    json_input_files: List[str], json_output_file: Optional[str] = None
+    json_input_files: List[str],
+    json_output_file: Optional[str] = None,
+    n_workers: Optional[int] = None,
 ) -> Dict:
     """Loads and merges json dictionaries to form the ``marl-eval`` input dictionary .
 
+    Files ending in ``.jsonl`` are read as the append-only files written during experiments,
+    where each line is a dictionary to merge.
+
     Args:
-       json_input_files (list of str): a list containing the absolute paths to the json files
+       json_input_files (list of str): a list containing the absolute paths to the json (or jsonl) files
        json_output_file (str, optional): if specified, the merged dictionary will be also written
             to the file in this absolute path
+       n_workers (int, optional): number of threads used to load the files. If ``None``, it uses
+            the default of :class:`~concurrent.futures.ThreadPoolExecutor`.
 
     Returns:
         the dict obtained by merging all the json files
 
     """
-
-    def update(d, u):
-        for k, v in u.items():
-            if isinstance(v, collections.abc.Mapping):
-                d[k] = update(d.get(k, {}), v)
-            else:
-                d[k] = v
-        return d
-
-    dicts = []
-    for file in json_input_files:
-        with open(file, "r") as f:
-            dicts.append(json.load(f))
-    full_dict = {}
-    for single_dict in dicts:
-        update(full_dict, single_dict)
+    full_dict = _merge_json_dicts(
+        _load_json_dicts(json_input_files, n_workers=n_workers)
+    )
 
     if json_output_file is not None:
         with open(json_output_file, "w+") as f:
@@ -170,7 +374,7 @@ class Plotting:
         environment_comparison_matrix,
         metric_name: Optional[str] = METRIC_TO_PLOT,
         metrics_to_normalize: Optional[List[str]] = METRICS_TO_NORMALIZE,
-        **kwargs
+        **kwargs,
     ):
         return performance_profiles(
             environment_comparison_matrix,
@@ -185,7 +389,7 @@ class Plotting:
         metric_name: Optional[str] = METRIC_TO_PLOT,
         metrics_to_normalize: Optional[List[str]] = METRICS_TO_NORMALIZE,
         save_tabular_as_latex: bool = True,
-        **kwargs
+        **kwargs,
     ):
         return aggregate_scores(
             dictionary=environment_comparison_matrix,
@@ -201,7 +405,7 @@ class Plotting:
         algorithms_to_compare: List[List[str]],
         metric_name: Optional[str] = METRIC_TO_PLOT,
         metrics_to_normalize: Optional[List[str]] = METRICS_TO_NORMALIZE,
-        **kwargs
+        **kwargs,
     ):
         return probability_of_improvement(
             environment_comparison_matrix,
@@ -216,7 +420,7 @@ class Plotting:
         sample_effeciency_matrix,
         metric_name: Optional[str] = METRIC_TO_PLOT,
         metrics_to_normalize: Optional[List[str]] = METRICS_TO_NORMALIZE,
-        **kwargs
+        **kwargs,
     ):
         return sample_efficiency_curves(
             dictionary=sample_effeciency_matrix,
@@ -236,7 +440,7 @@ class Plotting:
         env,
         metric_name: Optional[str] = METRIC_TO_PLOT,
         metrics_to_normalize: Optional[List[str]] = METRICS_TO_NORMALIZE,
-        **kwargs
+        **kwargs,
     ):
         return plot_single_task(
             processed_data=processed_data,
@@ -0,0 +1,98 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+
+import os
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Any, Optional
+
+import torch
+from tensordict import TensorDictBase
+
+
+def _snapshot(state: Any) -> Any:
+    """Copies all tensors in a (nested) state dict, so that it is not affected by later in-place updates."""
+    if isinstance(state, (torch.Tensor, TensorDictBase)):
+        return state.detach().clone()
+    if isinstance(state, dict):
+        return type(state)((key, _snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(_snapshot(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    """Writes experiment checkpoints and rotates old ones.
+
+    Checkpoints are first written to a temporary file and then atomically renamed,
+    so that a checkpoint file is never partially written, even if the process is interrupted.
+    Once a checkpoint is written, the oldest ones are deleted to keep ``keep_checkpoints_num`` of them.
+
+    If ``async_write`` is True, :meth:`save` snapshots the state dict (by copying its tensors) and
+    serializes and writes it in a background thread. At most one checkpoint is written at a time:
+    :meth:`save` waits for the previous write to be done before starting a new one.
+    Errors raised in the background thread are re-raised at the next call to :meth:`save` or :meth:`wait`.
+
+    Args:
+        keep_checkpoints_num (int, optional): how many checkpoints to keep. If ``None``, all checkpoints are kept
+        async_write (bool): whether to write checkpoints in a background thread
+
+    """
+
+    def __init__(self, keep_checkpoints_num: Optional[int], async_write: bool):
+        self.keep_checkpoints_num = keep_checkpoints_num
+        self.async_write = async_write
+        self.checkpointed_files = deque([])
+
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def save(self, state_dict: Any, file: Path) -> None:
+        """Writes ``state_dict`` to ``file``.
+
+        Args:
+            state_dict: the state dict to save
+            file (Path): the checkpoint file
+
+        """
+        self.wait()
+        if not self.async_write:
+            self._write(state_dict, file)
+            return
+        self._thread = threading.Thread(
+            target=self._write_background, args=(_snapshot(state_dict), file)
+        )
+        self._thread.start()
+
+    def wait(self) -> None:
+        """Waits for the checkpoint being written (if any) to be done."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_background(self, state_dict: Any, file: Path):
+        try:
+            self._write(state_dict, file)
+        except BaseException as err:
+            self._error = err
+
+    def _write(self, state_dict: Any, file: Path):
+        tmp_file = file.with_name(file.name + ".tmp")
+        with open(tmp_file, "wb") as f:
+            torch.save(state_dict, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file)
+
+        self.checkpointed_files.append(file)
+        if self.keep_checkpoints_num is not None:
+            while len(self.checkpointed_files) > self.keep_checkpoints_num:
+                file_to_delete = self.checkpointed_files.popleft()
+                file_to_delete.unlink(missing_ok=False)
@@ -0,0 +1,205 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+
+import copy
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Sequence
+
+import torch
+from tensordict import TensorDict, TensorDictBase
+from tensordict.nn import TensorDictModuleBase
+from torchrl.collectors import DataCollectorBase
+from torchrl.envs import EnvBase
+
+
+class AsyncCollector:
+    """Wraps a collector to run it in a background thread.
+
+    This allows the collection of batch ``k+1`` to overlap with training on batch ``k``.
+    The collector has to be constructed with its own copy of the policy (not the one being trained).
+    Weights are published from the trained ``policy`` by calling :meth:`update_policy_weights_` and are
+    loaded by the collection thread in between batches.
+    The state of the collector is also snapshotted by the collection thread in between batches, so that
+    :meth:`state_dict` and :meth:`load_state_dict` never wait for the batch being collected.
+
+    Each batch is tagged with the version of the policy that collected it.
+    The version is incremented at each call to :meth:`update_policy_weights_`.
+    The collection thread will not start a batch if this would result in the batch having a policy lag
+    (number of versions between the one that collected it and the one at the time it is consumed)
+    greater than ``max_policy_lag``.
+
+    Args:
+        collector (DataCollectorBase): the collector to run in the background
+        policy (TensorDictModuleBase): the policy being trained, from which weights are read
+        collection_policy (TensorDictModuleBase): the policy copy given to the collector
+        max_policy_lag (int): the maximum policy lag of collected batches
+
+    """
+
+    def __init__(
+        self,
+        collector: DataCollectorBase,
+        policy: TensorDictModuleBase,
+        collection_policy: TensorDictModuleBase,
+        max_policy_lag: int,
+    ):
+        self.collector = collector
+        self.max_policy_lag = max_policy_lag
+
+        self._policy_weights = TensorDict.from_module(policy).data
+        self._collection_policy_weights = TensorDict.from_module(collection_policy).data
+
+        self._thread: Optional[threading.Thread] = None
+        self._stop = False
+        self._condition = threading.Condition()
+        self._batches = deque()
+        self._pending_weights: Optional[TensorDictBase] = None
+        self._pending_state_dict: Optional[Dict] = None
+        self._state_dict = copy.deepcopy(collector.state_dict())
+        self._policy_version = 0
+
+        # Stats of the last returned batch
+        self.policy_lag = 0
+        self.collection_time = 0.0
+
+    def __iter__(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __next__(self) -> TensorDictBase:
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._batches) > 0)
+            batch, version, collection_time = self._batches.popleft()
+        if isinstance(batch, BaseException):
+            raise batch
+        if batch is None:
+            raise StopIteration
+        self.policy_lag = self._policy_version - version
+        self.collection_time = collection_time
+        return batch
+
+    def _run(self):
+        iterator = iter(self.collector)
+        n_batch = 0
+        while True:
+            with self._condition:
+                # Wait until starting this batch would not break the maximum policy lag
+                self._condition.wait_for(
+                    lambda n_batch=n_batch: self._stop
+                    or self._policy_version >= n_batch - self.max_policy_lag
+                )
+                if self._stop:
+                    return
+                weights, self._pending_weights = self._pending_weights, None
+                state_dict, self._pending_state_dict = self._pending_state_dict, None
+                version = self._policy_version
+
+            start = time.time()
+            try:
+                if state_dict is not None:
+                    self.collector.load_state_dict(state_dict)
+                if weights is not None:
+                    self._collection_policy_weights.update_(weights)
+                    self.collector.update_policy_weights_()
+                batch = next(iterator)
+                state_dict = copy.deepcopy(self.collector.state_dict())
+            except StopIteration:
+                batch = None
+            except BaseException as err:
+                batch = err
+            collection_time = time.time() - start
+
+            with self._condition:
+                if (
+                    isinstance(batch, TensorDictBase)
+                    and self._pending_state_dict is None
+                ):
+                    self._state_dict = state_dict
+                self._batches.append((batch, version, collection_time))
+                self._condition.notify_all()
+            if batch is None or isinstance(batch, BaseException):
+                return
+            n_batch += 1
+
+    def update_policy_weights_(self):
+        """Publish the current weights of the trained policy to the collection thread."""
+        weights = self._policy_weights.clone()
+        with self._condition:
+            self._pending_weights = weights
+            self._policy_version += 1
+            self._condition.notify_all()
+
+    def state_dict(self) -> Dict:
+        """Returns the state of the collector after the last collected batch."""
+        with self._condition:
+            return self._state_dict
+
+    def load_state_dict(self, state_dict: Dict):
+        """Loads the state of the collector, before the next batch is collected."""
+        with self._condition:
+            if self._thread is None:
+                self.collector.load_state_dict(state_dict)
+            else:
+                self._pending_state_dict = state_dict
+            self._state_dict = state_dict
+
+    def shutdown(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.collector.shutdown()
+
+
+class PinnedEnvFun:
+    """Env function that pins the process calling it to a set of cpus.
+
+    Used as the ``create_env_fn`` of multi-process collectors, as it is called once in each worker
+    process before the environment is created.
+
+    Args:
+        env_fun (callable): a function that takes no args and creates an environment
+        cpus (sequence of int, optional): the cpus to pin the process to, also setting the number of torch threads.
+            If ``None``, the process is not pinned.
+
+    """
+
+    def __init__(
+        self,
+        env_fun: Callable[[], EnvBase],
+        cpus: Optional[Sequence[int]] = None,
+    ):
+        self.env_fun = env_fun
+        self.cpus = cpus
+
+    def __call__(self) -> EnvBase:
+        if self.cpus is not None:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, self.cpus)
+            torch.set_num_threads(len(self.cpus))
+        return self.env_fun()
+
+
+def _get_worker_cpus(n_workers: int) -> List[Optional[List[int]]]:
+    """Splits the cpus available to this process in ``n_workers`` disjoint sets.
+
+    If there are less cpus than workers or cpu affinity is not supported, workers are not pinned.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * n_workers
+    cpus = sorted(os.sched_getaffinity(0))
+    cpus_per_worker = len(cpus) // n_workers
+    if cpus_per_worker == 0:
+        return [None] * n_workers
+    return [
+        cpus[i * cpus_per_worker : (i + 1) * cpus_per_worker] for i in range(n_workers)
+    ]
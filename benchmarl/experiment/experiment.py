@@ -12,9 +12,11 @@ import importlib
 import os
 import pickle
 import shutil
+import threading
 import time
 import warnings
-from collections import deque, OrderedDict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, MISSING
 from pathlib import Path
 
@@ -23,7 +25,7 @@ from typing import Any, Dict, List, Optional, Union
 import torch
 from tensordict import TensorDictBase
 from tensordict.nn import TensorDictSequential
-from torchrl.collectors import SyncDataCollector
+from torchrl.collectors import MultiSyncDataCollector, SyncDataCollector
 
 from torchrl.envs import ParallelEnv, SerialEnv, TransformedEnv
 from torchrl.envs.transforms import Compose
@@ -33,14 +35,25 @@ from tqdm import tqdm
 
 from benchmarl.algorithms import IppoConfig, MappoConfig
 
-from benchmarl.algorithms.common import AlgorithmConfig
+from benchmarl.algorithms.common import _AgentMaskedLoss, AlgorithmConfig
+from benchmarl.algorithms.replay_buffer import PrefetchTensorDictReplayBuffer
 from benchmarl.environments import Task, TaskClass
 from benchmarl.experiment.callback import Callback, CallbackNotifier
+from benchmarl.experiment.checkpoint import CheckpointWriter
+from benchmarl.experiment.collector import (
+    _get_worker_cpus,
+    AsyncCollector,
+    PinnedEnvFun,
+)
 from benchmarl.experiment.logger import Logger
 from benchmarl.models import GnnConfig, SequenceModelConfig
-from benchmarl.models.common import ModelConfig
+from benchmarl.models.common import _stored_state_name, ModelConfig
+from benchmarl.models.gnn import STORED_GRAPH_KEY
 from benchmarl.utils import (
+    _add_graph_transforms,
     _add_rnn_transforms,
+    _burn_in_states,
+    _get_sequence_windows,
     _read_yaml_config,
     local_seed,
     seed_everything,
@@ -69,6 +82,11 @@ class ExperimentConfig:
     prefer_continuous_actions: bool = MISSING
     collect_with_grad: bool = MISSING
     parallel_collection: bool = MISSING
+    async_collection: bool = MISSING
+    async_collection_max_policy_lag: int = MISSING
+    n_collector_workers: int = MISSING
+    pin_collector_workers: bool = MISSING
+    concurrent_group_training: bool = MISSING
 
     gamma: float = MISSING
     lr: float = MISSING
@@ -92,6 +110,7 @@ class ExperimentConfig:
     on_policy_n_envs_per_worker: int = MISSING
     on_policy_n_minibatch_iters: int = MISSING
     on_policy_minibatch_size: int = MISSING
+    on_policy_use_epoch_sampler: bool = MISSING
 
     off_policy_collected_frames_per_batch: int = MISSING
     off_policy_n_envs_per_worker: int = MISSING
@@ -102,6 +121,10 @@ class ExperimentConfig:
     off_policy_use_prioritized_replay_buffer: bool = MISSING
     off_policy_prb_alpha: float = MISSING
     off_policy_prb_beta: float = MISSING
+    off_policy_prefetch_batches: int = MISSING
+
+    rnn_sequence_length: Optional[int] = MISSING
+    rnn_burn_in: int = MISSING
 
     evaluation: bool = MISSING
     render: bool = MISSING
@@ -122,6 +145,7 @@ class ExperimentConfig:
     checkpoint_at_end: bool = MISSING
     keep_checkpoints_num: Optional[int] = MISSING
     exclude_buffer_from_checkpoint: bool = MISSING
+    async_checkpointing: bool = MISSING
 
     def train_batch_size(self, on_policy: bool) -> int:
         """
@@ -194,9 +218,26 @@ class ExperimentConfig:
             else self.off_policy_collected_frames_per_batch
         )
 
+    def train_sequence_length(self, on_policy: bool) -> int:
+        """
+        Length of the sequences that recurrent models are trained on (excluding burn-in steps).
+        This is the number of frames collected by each environment in an iteration,
+        or ``rnn_sequence_length`` if it is set and shorter.
+
+        Args:
+            on_policy (bool): is the algorithms on_policy
+
+        """
+        sequence_length = -(
+            -self.collected_frames_per_batch(on_policy) // self.n_envs(on_policy)
+        )
+        if self.rnn_sequence_length is not None:
+            sequence_length = min(sequence_length, self.rnn_sequence_length)
+        return sequence_length
+
     def n_envs_per_worker(self, on_policy: bool) -> int:
         """
-        Number of environments used for collection
+        Number of environments used for collection in each collector worker
 
         - In vectorized environments, this will be the vectorized batch_size.
         - In other environments, this will be emulated by running them sequentially.
@@ -212,6 +253,16 @@ class ExperimentConfig:
             else self.off_policy_n_envs_per_worker
         )
 
+    def n_envs(self, on_policy: bool) -> int:
+        """
+        Total number of environments used for collection across all collector workers
+
+        Args:
+            on_policy (bool): is the algorithms on_policy
+
+        """
+        return self.n_envs_per_worker(on_policy) * self.n_collector_workers
+
     def get_max_n_frames(self, on_policy: bool) -> int:
         """
         Get the maximum number of frames collected before the experiment ends.
@@ -305,6 +356,36 @@ class ExperimentConfig:
                 f"checkpoint_interval ({self.checkpoint_interval}) "
                 f"is not a multiple of the collected_frames_per_batch ({self.collected_frames_per_batch(on_policy)})"
             )
+        if self.async_collection and self.collect_with_grad:
+            raise ValueError(
+                "async_collection is not compatible with collect_with_grad"
+            )
+        if self.n_collector_workers < 1:
+            raise ValueError("n_collector_workers must be greater than zero")
+        if self.n_collector_workers > 1 and self.collect_with_grad:
+            raise ValueError(
+                "n_collector_workers > 1 is not compatible with collect_with_grad"
+            )
+        if (
+            self.n_collector_workers > 1
+            and self.collected_frames_per_batch(on_policy) % self.n_envs(on_policy) != 0
+        ):
+            raise ValueError(
+                f"collected_frames_per_batch ({self.collected_frames_per_batch(on_policy)}) "
+                f"is not a multiple of the number of envs across the collector workers ({self.n_envs(on_policy)})"
+            )
+        if self.async_collection and self.async_collection_max_policy_lag < 1:
+            raise ValueError(
+                "async_collection_max_policy_lag must be greater than zero"
+            )
+        if self.rnn_sequence_length is not None and self.rnn_sequence_length <= 0:
+            raise ValueError("rnn_sequence_length must be greater than zero or null")
+        if self.rnn_burn_in < 0:
+            raise ValueError("rnn_burn_in must be greater than or equal to zero")
+        if self.rnn_burn_in > 0 and self.rnn_sequence_length is None:
+            raise ValueError(
+                "rnn_burn_in can only be used when rnn_sequence_length is set"
+            )
         if self.keep_checkpoints_num is not None and self.keep_checkpoints_num <= 0:
             raise ValueError("keep_checkpoints_num must be greater than zero or null")
         if self.max_n_frames is None and self.max_n_iters is None:
@@ -359,10 +440,9 @@ class Experiment(CallbackNotifier):
             task = task.get_task()
         self.task = task
         self.model_config = model_config
-        self.critic_model_config = (
-            critic_model_config
-            if critic_model_config is not None
-            else copy.deepcopy(model_config)
+        # The critic config is copied, so that it is not shared with the policy when marked as critic
+        self.critic_model_config = copy.deepcopy(
+            critic_model_config if critic_model_config is not None else model_config
         )
         self.critic_model_config.is_critic = True
 
@@ -487,6 +567,17 @@ class Experiment(CallbackNotifier):
                 lambda: self.test_env, self.group_map, self.model_config
             )()
             env_func = _add_rnn_transforms(env_func, self.group_map, self.model_config)
+        # Add transforms that keep the graphs built by the policy in the collected data
+        if any(
+            len(self.model_config._get_graph_spec(group, len(agents)).keys()) > 0
+            for group, agents in self.group_map.items()
+        ):
+            self.test_env = _add_graph_transforms(
+                lambda: self.test_env, self.group_map, self.model_config
+            )()
+            env_func = _add_graph_transforms(
+                env_func, self.group_map, self.model_config
+            )
 
         # Initialize train env
         if self.test_env.batch_size == ():
@@ -537,6 +628,14 @@ class Experiment(CallbackNotifier):
             }
             for group in self.group_map.keys()
         }
+        # Groups do not share losses, optimizers or buffers, so they can be trained concurrently
+        self._group_executor = (
+            ThreadPoolExecutor(max_workers=len(self.train_group_map))
+            if self.config.concurrent_group_training and len(self.train_group_map) > 1
+            else None
+        )
+        # Callbacks are not thread safe, so the groups trained concurrently call them one at a time
+        self._callback_lock = threading.Lock()
 
     def _setup_collector(self):
         self.policy = self.algorithm.get_policy_for_collection()
@@ -548,19 +647,55 @@ class Experiment(CallbackNotifier):
             self.group_policies.update({group: group_policy[0]})
 
         if not self.config.collect_with_grad:
-            self.collector = SyncDataCollector(
-                self.env_func,
-                self.policy,
-                device=self.config.sampling_device,
-                storing_device=self.config.sampling_device,
-                frames_per_batch=self.config.collected_frames_per_batch(self.on_policy),
-                total_frames=self.config.get_max_n_frames(self.on_policy),
-                init_random_frames=(
+            # In async collection, the collector runs with its own copy of the policy
+            # which receives the trained weights at each update
+            collection_policy = (
+                copy.deepcopy(self.policy)
+                if self.config.async_collection
+                else self.policy
+            )
+            collector_kwargs = {
+                "device": self.config.sampling_device,
+                "storing_device": self.config.sampling_device,
+                "frames_per_batch": self.config.collected_frames_per_batch(
+                    self.on_policy
+                ),
+                "total_frames": self.config.get_max_n_frames(self.on_policy),
+                "init_random_frames": (
                     self.config.off_policy_init_random_frames
                     if not self.on_policy
                     else 0
                 ),
-            )
+            }
+            if self.config.n_collector_workers == 1:
+                self.collector = SyncDataCollector(
+                    self.env_func, collection_policy, **collector_kwargs
+                )
+            else:
+                n_workers = self.config.n_collector_workers
+                workers_cpus = (
+                    _get_worker_cpus(n_workers)
+                    if self.config.pin_collector_workers
+                    else [None] * n_workers
+                )
+                self.collector = MultiSyncDataCollector(
+                    [PinnedEnvFun(self.env_func, cpus) for cpus in workers_cpus],
+                    collection_policy,
+                    # Worker batches are concatenated along the env dimension,
+                    # resulting in the same layout of a single collector
+                    cat_results=0,
+                    num_sub_threads=(
+                        len(workers_cpus[0]) if workers_cpus[0] is not None else 1
+                    ),
+                    **collector_kwargs,
+                )
+            if self.config.async_collection:
+                self.collector = AsyncCollector(
+                    self.collector,
+                    policy=self.policy,
+                    collection_policy=collection_policy,
+                    max_policy_lag=self.config.async_collection_max_policy_lag,
+                )
         else:
             if self.config.off_policy_init_random_frames and not self.on_policy:
                 raise TypeError(
@@ -571,9 +706,12 @@ class Experiment(CallbackNotifier):
     def _get_model_architecture_name(self, model_config: ModelConfig) -> str:
         """Generate a descriptive name for the model architecture."""
         # If we have an override from Hydra choices, use that
-        if hasattr(self, '_model_architecture_override') and self._model_architecture_override:
+        if (
+            hasattr(self, "_model_architecture_override")
+            and self._model_architecture_override
+        ):
             return self._model_architecture_override
-            
+
         # Otherwise, generate from model config
         if isinstance(model_config, SequenceModelConfig):
             # For sequence models, create a name from the sequence of models
@@ -595,7 +733,10 @@ class Experiment(CallbackNotifier):
         self.model_architecture = self._get_model_architecture_name(self.model_config)
         self.environment_name = self.task.env_name().lower()
         self.task_name = self.task.name.lower()
-        self._checkpointed_files = deque([])
+        self._checkpoint_writer = CheckpointWriter(
+            keep_checkpoints_num=self.config.keep_checkpoints_num,
+            async_write=self.config.async_checkpointing,
+        )
 
         if self.config.save_folder is not None:
             # If the user specified a folder for the experiment we use that
@@ -618,12 +759,12 @@ class Experiment(CallbackNotifier):
             # Generate standardized experiment name: model_architecture-task-algo-date-hostname-device
             import socket
             from datetime import datetime
-            
+
             date_str = datetime.now().strftime("%Y-%m-%d")
             hostname = socket.gethostname()
             # Extract device name from train_device (e.g., "cuda:1" -> "cuda1", "cpu" -> "cpu")
             device_name = self.config.train_device.replace(":", "")
-            
+
             self.name = f"{self.model_architecture}-{self.task_name}-{self.algorithm_name}-seed{self.seed}-{date_str}-{hostname}-{device_name}"
             self.folder_name = save_folder / self.name
 
@@ -699,6 +840,8 @@ class Experiment(CallbackNotifier):
         seed_everything(self.seed)
         self._evaluation_loop()
         self.logger.commit()
+        if self.logger.json_writer is not None:
+            self.logger.json_writer.compact()
         print(
             f"Evaluation results logged to loggers={self.config.loggers}"
             f"{' and to a json file in the experiment folder.' if self.config.create_json else ''}"
@@ -741,18 +884,28 @@ class Experiment(CallbackNotifier):
                         action_keys=self.rollout_env.action_keys,
                         done_keys=self.rollout_env.done_keys,
                     )
+                # As in collectors, private keys (e.g., hidden states) are not kept in the collected data
+                batch = batch.exclude(
+                    *[
+                        key
+                        for key in batch.keys(True)
+                        if any(
+                            sub_key.startswith("_")
+                            for sub_key in (key if isinstance(key, tuple) else (key,))
+                        )
+                    ]
+                )
 
             # Logging collection
             collection_time = time.time() - iteration_start
             current_frames = batch.numel()
             self.total_frames += current_frames
-            self.mean_return = self.logger.log_collection(
+            mean_return = self.logger.log_collection(
                 batch,
                 total_frames=self.total_frames,
                 task=self.task,
                 step=self.n_iters_performed,
             )
-            pbar.set_description(f"mean return = {self.mean_return}", refresh=False)
 
             # Callback
             self._on_batch_collected(batch)
@@ -760,27 +913,24 @@ class Experiment(CallbackNotifier):
 
             # Loop over groups
             training_start = time.time()
-            for group in self.train_group_map.keys():
-                group_batch = batch.exclude(*self._get_excluded_keys(group)).to(
-                    self.config.train_device
-                )
-                group_batch = self.algorithm.process_batch(group, group_batch)
-                if not self.algorithm.has_rnn:
-                    group_batch = group_batch.reshape(-1)
-
-                group_buffer = self.replay_buffers[group]
-                group_buffer.extend(group_batch.to(group_buffer.storage.device))
-
-                training_tds = []
-                for _ in range(self.config.n_optimizer_steps(self.on_policy)):
-                    for _ in range(
-                        -(
-                            -self.config.train_batch_size(self.on_policy)
-                            // self.config.train_minibatch_size(self.on_policy)
-                        )
-                    ):
-                        training_tds.append(self._optimizer_loop(group))
-                training_td = torch.stack(training_tds)
+            if self._group_executor is None:
+                group_results = {
+                    group: self._train_group(group, batch)
+                    for group in self.train_group_map.keys()
+                }
+            else:
+                futures = {
+                    group: self._group_executor.submit(self._train_group, group, batch)
+                    for group in self.train_group_map.keys()
+                }
+                group_results = {
+                    group: future.result() for group, future in futures.items()
+                }
+            group_training_times = {}
+            for group, (training_td, group_training_time) in group_results.items():
+                group_training_times[
+                    f"timers/{group}/training_time"
+                ] = group_training_time
                 self.logger.log_training(
                     group, training_td, step=self.n_iters_performed
                 )
@@ -817,25 +967,45 @@ class Experiment(CallbackNotifier):
             # End of step
             iteration_time = time.time() - iteration_start
             self.total_time += iteration_time
-            self.logger.log(
-                {
-                    "timers/collection_time": collection_time,
-                    "timers/training_time": training_time,
-                    "timers/iteration_time": iteration_time,
-                    "timers/total_time": self.total_time,
-                    "counters/current_frames": current_frames,
-                    "counters/total_frames": self.total_frames,
-                    "counters/iter": self.n_iters_performed,
-                },
-                step=self.n_iters_performed,
-            )
+            to_log = {
+                "timers/collection_time": collection_time,
+                "timers/training_time": training_time,
+                "timers/iteration_time": iteration_time,
+                "timers/total_time": self.total_time,
+                **group_training_times,
+                "counters/current_frames": current_frames,
+                "counters/total_frames": self.total_frames,
+                "counters/iter": self.n_iters_performed,
+            }
+            if self.config.async_collection and not self.config.collect_with_grad:
+                # collection_time is the time spent waiting for the batch,
+                # while async_collection_time is the time it took to collect it in the background
+                async_collection_time = self.collector.collection_time
+                to_log.update(
+                    {
+                        "timers/async_collection_time": async_collection_time,
+                        "timers/policy_lag": self.collector.policy_lag,
+                        "timers/async_speedup": (
+                            iteration_time - collection_time + async_collection_time
+                        )
+                        / iteration_time,
+                    }
+                )
+            self.logger.log(to_log, step=self.n_iters_performed)
             self.n_iters_performed += 1
-            self.logger.commit()
+            # Logged metrics and the mean return (saved in the checkpoint) are transferred to the host at once
+            (self.mean_return,) = self.logger.flush(mean_return)
             if (
                 self.config.checkpoint_interval > 0
                 and self.total_frames % self.config.checkpoint_interval == 0
             ):
-                self._save_experiment()
+                checkpoint_time = self._save_experiment()
+                self.logger.log(
+                    {"timers/checkpoint_time": checkpoint_time},
+                    step=self.n_iters_performed - 1,
+                )
+            self.logger.commit()
+            pbar.set_description(f"mean return = {self.mean_return}", refresh=False)
             pbar.update()
 
         if self.config.checkpoint_at_end:
@@ -849,22 +1019,66 @@ class Experiment(CallbackNotifier):
         else:
             self.rollout_env.close()
         self.test_env.close()
+        self._checkpoint_writer.wait()
+        if self._group_executor is not None:
+            self._group_executor.shutdown()
         self.logger.finish()
 
         for buffer in self.replay_buffers.values():
+            if isinstance(buffer, PrefetchTensorDictReplayBuffer):
+                buffer.shutdown()
             if hasattr(buffer.storage, "scratch_dir"):
                 shutil.rmtree(buffer.storage.scratch_dir, ignore_errors=False)
 
+    def _train_group(self, group: str, batch: TensorDictBase):
+        group_training_start = time.time()
+        group_batch = batch.exclude(*self._get_excluded_keys(group)).to(
+            self.config.train_device
+        )
+        group_batch = self.algorithm.process_batch(group, group_batch)
+        if not self.algorithm.has_rnn:
+            group_batch = group_batch.reshape(-1)
+        elif self.config.rnn_sequence_length is not None:
+            group_batch = _get_sequence_windows(
+                group_batch,
+                window_length=self.config.train_sequence_length(self.on_policy),
+                burn_in=self.config.rnn_burn_in,
+                # Losses averaging over the agents present leave the padding steps out,
+                # others are given an overlapping last window
+                pad_last_window=isinstance(self.losses[group], _AgentMaskedLoss),
+            )
+
+        group_buffer = self.replay_buffers[group]
+        group_buffer.extend(group_batch.to(group_buffer.storage.device))
+
+        training_tds = []
+        for _ in range(self.config.n_optimizer_steps(self.on_policy)):
+            for _ in range(
+                -(
+                    -self.config.train_batch_size(self.on_policy)
+                    // self.config.train_minibatch_size(self.on_policy)
+                )
+            ):
+                training_tds.append(self._optimizer_loop(group))
+        training_td = torch.stack(training_tds)
+        return training_td, time.time() - group_training_start
+
     def _get_excluded_keys(self, group: str):
         excluded_keys = []
         for other_group in self.group_map.keys():
             if other_group != group:
                 excluded_keys += [other_group, ("next", other_group)]
         excluded_keys += ["info", (group, "info"), ("next", group, "info")]
+        # Graphs are only reused for the inputs they were built from
+        excluded_keys += [("next", group, STORED_GRAPH_KEY)]
         return excluded_keys
 
     def _optimizer_loop(self, group: str) -> TensorDictBase:
         subdata = self.replay_buffers[group].sample().to(self.config.train_device)
+        if self.algorithm.has_rnn:
+            if self.config.rnn_burn_in > 0:
+                subdata = self._burn_in(group, subdata)
+            self._set_next_stored_states(group, subdata)
         loss_vals = self.losses[group](subdata)
         training_td = loss_vals.detach()
         loss_vals = self.algorithm.process_loss_vals(group, loss_vals)
@@ -875,12 +1089,12 @@ class Experiment(CallbackNotifier):
 
                 loss_value.backward()
 
+                # Each loss is clipped on its own right before its step, as the backward pass of the next
+                # loss can go through the parameters this step updates, so the norms of the losses of a group
+                # are not reduced together. The norm is kept on device
                 grad_norm = self._grad_clip(optimizer)
 
-                training_td.set(
-                    f"grad_norm_{loss_name}",
-                    torch.tensor(grad_norm, device=self.config.train_device),
-                )
+                training_td.set(f"grad_norm_{loss_name}", grad_norm)
 
                 optimizer.step()
                 optimizer.zero_grad()
@@ -888,33 +1102,106 @@ class Experiment(CallbackNotifier):
         if self.target_updaters[group] is not None:
             self.target_updaters[group].step()
 
-        callback_loss = self._on_train_step(subdata, group)
+        with self._callback_lock:
+            callback_loss = self._on_train_step(subdata, group)
         if callback_loss is not None:
             training_td.update(callback_loss)
 
         return training_td
 
-    def _grad_clip(self, optimizer: torch.optim.Optimizer) -> float:
-        params = []
-        for param_group in optimizer.param_groups:
-            params += param_group["params"]
+    @torch.no_grad()
+    def _set_next_stored_states(self, group: str, subdata: TensorDictBase):
+        # Hidden states are stored once per frame and models only read the ones of the first frames of the sequences.
+        # The next states of the first frames are computed by stepping the policy from the states the sequences
+        # start from (e.g., after a burn-in), as in collection, so they also hold before resets and truncations
+        state = self._get_initial_states(group, subdata)
+        stored_keys = [
+            key
+            for key in state.keys()
+            if (group, _stored_state_name(key)) in subdata.keys(True)
+        ]
+        if not len(stored_keys):
+            return
+        policy = self.algorithm.get_policy_for_loss(group)
+        next_state = _burn_in_states(policy, subdata, state, group=group, burn_in=1)
+        for key in stored_keys:
+            stored_key = (group, _stored_state_name(key))
+            stored_state = subdata.get(stored_key)
+            subdata.set(
+                ("next", *stored_key),
+                next_state.get(key)
+                .to(stored_state.dtype)
+                .unsqueeze(1)
+                .expand(stored_state.shape),
+            )
+
+    @torch.no_grad()
+    def _burn_in(self, group: str, subdata: TensorDictBase) -> TensorDictBase:
+        # The policy is stepped through the burn-in steps of the windows, as in collection,
+        # and its hidden states are given to the windows under the public keys that training sequences start from.
+        # The burn-in starts from the stored hidden states if there are any and from zeros otherwise
+        burn_in = self.config.rnn_burn_in
+        state = self._get_initial_states(group, subdata)
+        if len(state.keys()):
+            state = _burn_in_states(
+                self.algorithm.get_policy_for_loss(group),
+                subdata,
+                state,
+                group=group,
+                burn_in=burn_in,
+            )
+
+        # The padding after the end of the sequences is kept for the losses
+        subdata = subdata[:, burn_in:]
+        state = state.unsqueeze(1).expand(
+            subdata.shape[0], subdata.shape[1], *state.shape[1:]
+        )
+        for key, value in state.items():
+            subdata.set((group, _stored_state_name(key)), value)
+        return subdata
+
+    def _get_initial_states(
+        self, group: str, subdata: TensorDictBase
+    ) -> TensorDictBase:
+        # Hidden states at the first frames of the sequences in the dtype of the models,
+        # taken from the stored hidden states if there are any and zeros otherwise
+        state_spec = self.model_config._get_model_state_spec_inner(group=group)
+        state = (
+            state_spec.expand(
+                subdata.shape[0], len(self.group_map[group]), *state_spec.shape
+            )
+            .zero()
+            .to(subdata.device)
+        )
+        for key in state.keys():
+            stored_state = subdata.get((group, _stored_state_name(key)), None)
+            if stored_state is not None:
+                state.set(key, stored_state[:, 0].to(state.get(key).dtype))
+        return state
+
+    def _grad_clip(self, optimizer: torch.optim.Optimizer) -> torch.Tensor:
+        # Gradients of all the param groups of the optimizer are processed with multi-tensor (foreach) kernels
+        params = [
+            p
+            for param_group in optimizer.param_groups
+            for p in param_group["params"]
+            if p.grad is not None
+        ]
+        if not len(params):
+            return torch.zeros((), device=self.config.train_device)
 
         if self.config.clip_grad_norm and self.config.clip_grad_val is not None:
-            total_norm = torch.nn.utils.clip_grad_norm_(
-                params, self.config.clip_grad_val
+            return torch.nn.utils.clip_grad_norm_(
+                params, self.config.clip_grad_val, foreach=True
             )
-        else:
-            norm_type = 2.0
-            norms = [
-                torch.linalg.vector_norm(p.grad, norm_type)
-                for p in params
-                if p.grad is not None
-            ]
-            total_norm = torch.linalg.vector_norm(torch.stack(norms), norm_type)
-            if self.config.clip_grad_val is not None:
-                torch.nn.utils.clip_grad_value_(params, self.config.clip_grad_val)
-
-        return float(total_norm)
+        total_norm = torch.nn.utils.get_total_norm(
+            [p.grad for p in params], foreach=True
+        )
+        if self.config.clip_grad_val is not None:
+            torch.nn.utils.clip_grad_value_(
+                params, self.config.clip_grad_val, foreach=True
+            )
+        return total_norm
 
     @local_seed()
     @torch.no_grad()
@@ -1024,18 +1311,16 @@ class Experiment(CallbackNotifier):
         self.n_iters_performed = state_dict["state"]["n_iters_performed"]
         self.mean_return = state_dict["state"]["mean_return"]
 
-    def _save_experiment(self) -> None:
-        """Checkpoint trainer"""
-        if self.config.keep_checkpoints_num is not None:
-            while len(self._checkpointed_files) >= self.config.keep_checkpoints_num:
-                file_to_delete = self._checkpointed_files.popleft()
-                file_to_delete.unlink(missing_ok=False)
-
+    def _save_experiment(self) -> float:
+        """Checkpoint trainer and return the time the training loop was stalled for"""
+        checkpoint_start = time.time()
+        if self.logger.json_writer is not None:
+            self.logger.json_writer.sync()
         checkpoint_folder = self.folder_name / "checkpoints"
         checkpoint_folder.mkdir(parents=False, exist_ok=True)
         checkpoint_file = checkpoint_folder / f"checkpoint_{self.total_frames}.pt"
-        torch.save(self.state_dict(), checkpoint_file)
-        self._checkpointed_files.append(checkpoint_file)
+        self._checkpoint_writer.save(self.state_dict(), checkpoint_file)
+        return time.time() - checkpoint_start
 
     def _load_experiment(self) -> Experiment:
         """Load trainer from checkpoint"""
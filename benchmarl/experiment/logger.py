@@ -10,7 +10,7 @@ import warnings
 from collections.abc import MutableMapping, Sequence
 from pathlib import Path
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -24,6 +24,8 @@ from torchrl.record.loggers import get_logger
 from torchrl.record.loggers.wandb import WandbLogger
 
 from benchmarl.environments import Task
+from benchmarl.models.common import _mean_over_agents, AGENT_MASK_KEY
+from benchmarl.utils import _merge_dicts, _read_json_dict
 
 
 class Logger:
@@ -50,6 +52,8 @@ class Logger:
         self.model_architecture = model_architecture
         self.group_map = group_map
         self.seed = seed
+        # Values logged since the last flush with their step
+        self._pending_logs: List[Tuple[Dict, Optional[int]]] = []
 
         if experiment_config.create_json:
             self.json_writer = JsonWriter(
@@ -119,7 +123,7 @@ class Logger:
         task: Task,
         total_frames: int,
         step: int,
-    ) -> float:
+    ) -> Tensor:
         to_log = {}
         groups_episode_rewards = []
         gobal_done = self._get_global_done(batch)  # Does not have agent dim
@@ -145,16 +149,14 @@ class Logger:
             if "info" in batch.get(("next", group)).keys():
                 to_log.update(
                     {
-                        f"collection/{group}/info/{key}": value.to(torch.float)
-                        .mean()
-                        .item()
+                        f"collection/{group}/info/{key}": value.to(torch.float).mean()
                         for key, value in batch.get(("next", group, "info")).items()
                     }
                 )
         if "info" in batch.keys():
             to_log.update(
                 {
-                    f"collection/info/{key}": value.to(torch.float).mean().item()
+                    f"collection/info/{key}": value.to(torch.float).mean()
                     for key, value in batch.get(("next", "info")).items()
                 }
             )
@@ -165,14 +167,12 @@ class Logger:
         )
 
         self.log(to_log, step=step)
-        return global_episode_rewards.mean().item()
+        # Returned as a tensor to avoid a device sync, it can be read after commit()
+        return global_episode_rewards.mean()
 
     def log_training(self, group: str, training_td: TensorDictBase, step: int):
-        if not len(self.loggers):
-            return
         to_log = {
-            f"train/{group}/{key}": value.mean().item()
-            for key, value in training_td.items()
+            f"train/{group}/{key}": value.mean() for key, value in training_td.items()
         }
         self.log(to_log, step=step)
 
@@ -208,7 +208,13 @@ class Logger:
         for group in self.group_map.keys():
             # returns has shape (n_episodes)
             returns = torch.stack(
-                [self._get_reward(group, td).sum(0).mean() for td in rollouts],
+                [
+                    _mean_over_agents(
+                        self._get_reward(group, td).sum(0),
+                        self._get_agent_mask(group, td, over_time=True),
+                    ).mean()
+                    for td in rollouts
+                ],
                 dim=0,
             )
             self._log_min_mean_max(
@@ -233,7 +239,7 @@ class Logger:
                 evaluation_step=total_frames
                 // self.experiment_config.evaluation_interval,
             )
-            json_file = str(self.json_writer.path)
+            json_file = str(self.json_writer.jsonl_path)
             for logger in self.loggers:
                 if isinstance(logger, WandbLogger):
                     logger.experiment.save(
@@ -262,19 +268,79 @@ class Logger:
                     logger.log_video("eval_video", vid, step=step)
 
     def commit(self):
+        self.flush()
         for logger in self.loggers:
             if isinstance(logger, WandbLogger):
                 logger.experiment.log({}, commit=True)
 
     def log(self, dict_to_log: Dict, step: int = None):
-        for logger in self.loggers:
-            if isinstance(logger, WandbLogger):
-                logger.experiment.log(dict_to_log, commit=False)
-            else:
-                for key, value in dict_to_log.items():
-                    logger.log_scalar(key.replace("/", "_"), value, step=step)
+        """
+        Log a dictionary of values.
+
+        Scalar tensors are kept on their device and accumulated until the next :meth:`flush`
+        (called by :meth:`commit`), where they are transferred to the host together.
+
+        Args:
+            dict_to_log (dict): the values to log
+            step (int, optional): the step of the values
+
+        """
+        # Copied, as the scalar tensors are replaced by their host values on flush
+        self._pending_logs.append((dict(dict_to_log), step))
+
+    def flush(self, *values: Tensor) -> List[float]:
+        """Transfer the accumulated values to the host and write them to the loggers.
+
+        Args:
+            *values (Tensor): additional scalar tensors, transferred to the host together with the logged values
+
+        Returns:
+            the host values of ``values``
+
+        """
+        pending_logs, self._pending_logs = self._pending_logs, []
+        if not len(self.loggers):
+            pending_logs = []
+        # The additional values are converted as an extra dictionary that is not written
+        extra_values = dict(enumerate(values))
+
+        # Stack scalar tensors by device and dtype, to transfer each stack at once
+        scalars = {}
+        for dict_to_log in [extra_values] + [
+            dict_to_log for dict_to_log, _ in pending_logs
+        ]:
+            for key, value in dict_to_log.items():
+                if isinstance(value, Tensor) and value.numel() == 1:
+                    scalars.setdefault((value.device, value.dtype), []).append(
+                        (dict_to_log, key, value)
+                    )
+        for stacked_values in scalars.values():
+            host_values = torch.stack(
+                [value.detach().reshape(()) for _, _, value in stacked_values]
+            ).tolist()
+            for (dict_to_log, key, _), host_value in zip(stacked_values, host_values):
+                dict_to_log[key] = host_value
+
+        for dict_to_log, step in pending_logs:
+            for logger in self.loggers:
+                if isinstance(logger, WandbLogger):
+                    logger.experiment.log(dict_to_log, commit=False)
+                else:
+                    for key, value in dict_to_log.items():
+                        logger.log_scalar(key.replace("/", "_"), value, step=step)
+        return list(extra_values.values())
 
     def finish(self):
+        self.flush()
+        if self.json_writer is not None:
+            self.json_writer.finish()
+            if self.json_writer.path.exists():
+                json_file = str(self.json_writer.path)
+                for logger in self.loggers:
+                    if isinstance(logger, WandbLogger):
+                        logger.experiment.save(
+                            json_file, base_path=os.path.dirname(json_file)
+                        )
         for logger in self.loggers:
             if isinstance(logger, WandbLogger):
                 import wandb
@@ -289,7 +355,11 @@ class Logger:
             reward = (
                 td.get(("next", "reward")).expand(td.get(group).shape).unsqueeze(-1)
             )
-        return reward.mean(-2) if remove_agent_dim else reward
+        return (
+            _mean_over_agents(reward, self._get_agent_mask(group, td))
+            if remove_agent_dim
+            else reward
+        )
 
     def _get_agents_done(
         self, group: str, td: TensorDictBase, remove_agent_dim: bool = False
@@ -317,7 +387,22 @@ class Logger:
                 .expand(td.get(group).shape)
                 .unsqueeze(-1)
             )
-        return episode_reward.mean(-2) if remove_agent_dim else episode_reward
+        return (
+            _mean_over_agents(episode_reward, self._get_agent_mask(group, td))
+            if remove_agent_dim
+            else episode_reward
+        )
+
+    def _get_agent_mask(
+        self, group: str, td: TensorDictBase, over_time: bool = False
+    ) -> Optional[Tensor]:
+        # Mask of the agents present when the agent dimension of the group is padded, None otherwise.
+        # With over_time, the agents present at any step of the (first) time dimension
+        agent_mask = td.get((group, AGENT_MASK_KEY), None)
+        if agent_mask is None:
+            return None
+        agent_mask = agent_mask.to(torch.bool)
+        return agent_mask.any(0) if over_time else agent_mask
 
     def _log_individual_and_group_rewards(
         self,
@@ -331,6 +416,7 @@ class Logger:
     ):
         reward = self._get_reward(group, batch)  # Has agent dim
         episode_reward = self._get_episode_reward(group, batch)  # Has agent dim
+        agent_mask = self._get_agent_mask(group, batch)  # None if no padded agents
         n_agents_in_group = episode_reward.shape[-2]
 
         # Add multiagent dim
@@ -358,12 +444,18 @@ class Logger:
                     )
 
         # 2. Here we log rewards from group data taking the mean over agents
-        group_episode_reward = episode_reward.mean(-2)[global_done]
+        group_episode_reward = _mean_over_agents(episode_reward, agent_mask)[
+            global_done
+        ]
         if any_episode_ended:
             self._log_min_mean_max(
                 to_log, f"{prefix}/{group}/reward/episode_reward", group_episode_reward
             )
-        self._log_min_mean_max(to_log, f"{prefix}/reward/reward", reward)
+        self._log_min_mean_max(
+            to_log,
+            f"{prefix}/reward/reward",
+            reward if agent_mask is None else reward[agent_mask],
+        )
 
         return group_episode_reward
 
@@ -385,9 +477,9 @@ class Logger:
     def _log_min_mean_max(self, to_log: Dict[str, Tensor], key: str, value: Tensor):
         to_log.update(
             {
-                key + "_min": value.min().item(),
-                key + "_mean": value.mean().item(),
-                key + "_max": value.max().item(),
+                key + "_min": value.min(),
+                key + "_mean": value.mean(),
+                key + "_max": value.max(),
             }
         )
 
@@ -398,6 +490,12 @@ class JsonWriter:
 
     Follows conventions from https://github.com/instadeepai/marl-eval/tree/main#usage-
 
+    During the experiment, each evaluation step is appended as one line to a ``.jsonl`` file next to ``path``.
+    Each line is a marl-eval dictionary containing only that step (and the running ``absolute_metrics``),
+    so that merging the lines gives the full dictionary (see :func:`~benchmarl.eval_results.load_and_merge_json_dicts`).
+    :meth:`finish` compacts the lines into the marl-eval json file at ``path`` and removes the ``.jsonl`` file.
+    If the files already exist (e.g., when an experiment is reloaded), their content is kept.
+
     Args:
         folder (str): folder where to write the file
         name (str): file name
@@ -418,18 +516,25 @@ class JsonWriter:
         seed: int,
     ):
         self.path = Path(folder) / Path(name)
+        self.jsonl_path = self.path.with_suffix(".jsonl")
         self.run_data = {"absolute_metrics": {}}
         self.data = {
             environment_name: {
                 task_name: {algorithm_name: {f"seed_{seed}": self.run_data}}
             }
         }
+        self._keys = (environment_name, task_name, algorithm_name, f"seed_{seed}")
+
+        for file in (self.path, self.jsonl_path):
+            if file.exists():
+                _merge_dicts(self.data, _read_json_dict(str(file)))
+        self._file = None
 
     def write(
         self, total_frames: int, metrics: Dict[str, List[Tensor]], evaluation_step: int
     ):
         """
-        Writes a step into the json reporting file
+        Appends a step to the jsonl reporting file
 
         Args:
             total_frames (int): total frames collected so far in the experiment
@@ -456,5 +561,37 @@ class JsonWriter:
                     max_metric = max(max_metric, prev_max_metric)
                 self.run_data["absolute_metrics"][metric_name] = [max_metric]
 
-        with open(self.path, "w+") as f:
+        line = {
+            "absolute_metrics": self.run_data["absolute_metrics"],
+            step_str: step_metrics,
+        }
+        for key in reversed(self._keys):
+            line = {key: line}
+        if self._file is None:
+            self._file = open(self.jsonl_path, "a")
+        self._file.write(json.dumps(line) + "\n")
+        self._file.flush()
+
+    def sync(self):
+        """Makes sure that the written steps are stored on disk."""
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def compact(self):
+        """Writes the marl-eval json file at ``path`` with all the steps written so far."""
+        tmp_path = self.path.with_suffix(".json.tmp")
+        with open(tmp_path, "w+") as f:
             json.dump(self.data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        """Compacts the steps in the marl-eval json file and removes the jsonl file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self.jsonl_path.exists():
+            return
+        self.compact()
+        self.jsonl_path.unlink()
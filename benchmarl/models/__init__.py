@@ -4,6 +4,7 @@
 #  LICENSE file in the root directory of this source tree.
 #
 
+from .attention_gnn import AttentionGnn, AttentionGnnConfig
 from .cnn import Cnn, CnnConfig
 from .common import (
     EnsembleModelConfig,
@@ -31,6 +32,8 @@ classes = [
     "GruConfig",
     "Lstm",
     "LstmConfig",
+    "AttentionGnn",
+    "AttentionGnnConfig",
 ]
 
 model_config_registry = {
@@ -40,4 +43,5 @@ model_config_registry = {
     "deepsets": DeepsetsConfig,
     "gru": GruConfig,
     "lstm": LstmConfig,
+    "attentiongnn": AttentionGnnConfig,
 }
@@ -0,0 +1,326 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass, MISSING
+from typing import Optional
+
+import torch
+from tensordict import TensorDictBase
+from tensordict.utils import _unravel_key_to_tuple
+from torch import nn, Tensor
+
+from benchmarl.models.common import _mean_over_agents, Model, ModelConfig
+from benchmarl.models.gnn import (
+    _check_graph_model,
+    _dense_edge_attr,
+    _get_graph_inputs,
+    _get_radius_neighbours,
+    _is_vmapped,
+    _neighbours_to_adjacency,
+    _radius_graph_key,
+)
+
+
+class _AgentLinear(nn.Module):
+    """Linear layer applied to inputs of shape ``(*batch,n_agents,F)``, with different parameters for each agent.
+
+    If ``n_agents`` is 1, the parameters are shared by all agents and the input can have any shape.
+    """
+
+    def __init__(self, in_features: int, out_features: int, n_agents: int, device):
+        super().__init__()
+        self.weight = nn.Parameter(
+            torch.empty(n_agents, out_features, in_features, device=device)
+        )
+        self.bias = nn.Parameter(torch.empty(n_agents, out_features, device=device))
+        # Same initialization as nn.Linear
+        bound = 1 / math.sqrt(in_features) if in_features > 0 else 0
+        for weight in self.weight:
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, input: Tensor) -> Tensor:
+        if self.weight.shape[0] == 1:
+            return nn.functional.linear(input, self.weight[0], self.bias[0])
+        return torch.einsum("...ni,noi->...no", input, self.weight) + self.bias
+
+
+class AttentionGnn(Model):
+    """A graph attention model that computes multi-head attention over agents.
+
+    Each agent computes a query, key and value from its node features. Agents then attend to their neighbours
+    in the graph with :func:`torch.nn.functional.scaled_dot_product_attention`, where the graph is applied as an attention mask.
+    The output is a linear projection of the attention output and of the node features.
+    As the graph is never converted to an edge list, this model can scale to hundreds of agents.
+    When the topology is ``"full"`` and no edge features are used, no mask is needed and the flash attention kernel can be used.
+    Edge features are projected to a learned bias given to the same function as a float attention mask, which it
+    differentiates in training. Only when the model is run under :func:`torch.vmap` with gradients enabled
+    (e.g., in the functional value losses of off-policy algorithms) is the attention computed explicitly instead,
+    as the kernels chosen under vmap are not differentiable with respect to the mask.
+
+    When ``share_params`` is False, each agent uses its own parameters to compute the query, key and value of its node
+    and its output.
+    When ``centralised`` is True, the outputs of all nodes are mean pooled before the output projection.
+
+    Args:
+        topology (str): Topology of the graph adjacency matrix. Options: "full", "empty", "from_pos". "from_pos" builds
+            the topology dynamically based on ``position_key`` and ``edge_radius``.
+        self_loops (str): Whether the resulting adjacency matrix will have self loops.
+        num_heads (int): The number of attention heads.
+        embed_dim (int): The total dimension of the queries, keys and values (split among heads).
+            It has to be divisible by ``num_heads``.
+        position_key (str, optional): if provided, it will need to match a leaf key in the tensordict coming from the env
+            (in the `observation_spec`) representing the agent position.
+            This key will be processed as a node feature (unless exclude_pos_from_node_features=True) and it will be used
+            to compute relative positions (``pos_node_1 - pos_node_2``) and distances between agents,
+            which are projected to a per-head bias added to the attention scores.
+            If you want to use this feature in a :class:`~benchmarl.models.SequenceModel`, the model needs to be first in sequence.
+        pos_features (int, optional): Needed when position_key is specified.
+            It has to match to the last element of the shape the tensor under position_key.
+        exclude_pos_from_node_features (optional, bool): If ``position_key`` is provided,
+            whether to use it just to compute attention biases or also include it in node features.
+        velocity_key (str, optional): if provided, it will need to match a leaf key in the tensordict coming from the env
+            (in the `observation_spec`) representing the agent velocity.
+            This key will be processed as a node feature, and it will be used to compute relative velocities
+            (``vel_node_1 - vel_node_2``), which are projected to a per-head bias added to the attention scores.
+            If you want to use this feature in a :class:`~benchmarl.models.SequenceModel`, the model needs to be first in sequence.
+        vel_features (int, optional): Needed when velocity_key is specified.
+            It has to match to the last element of the shape the tensor under velocity_key.
+        edge_radius (float, optional): If topology is ``"from_pos"`` the radius to use to build the agent graph.
+            Agents within this radius distance will be neighbours.
+        max_num_neighbors (int, optional): If topology is ``"from_pos"``, the maximum number of neighbours of each agent.
+            If more agents are within ``edge_radius``, only the nearest ones are kept. If ``None``, all neighbours are kept.
+
+    """
+
+    def __init__(
+        self,
+        topology: str,
+        self_loops: bool,
+        num_heads: int,
+        embed_dim: int,
+        position_key: Optional[str],
+        exclude_pos_from_node_features: Optional[bool],
+        velocity_key: Optional[str],
+        edge_radius: Optional[float],
+        max_num_neighbors: Optional[int],
+        pos_features: Optional[int],
+        vel_features: Optional[int],
+        **kwargs,
+    ):
+        self.topology = topology
+        self.self_loops = self_loops
+        self.num_heads = num_heads
+        self.embed_dim = embed_dim
+        self.position_key = position_key
+        self.velocity_key = velocity_key
+        self.exclude_pos_from_node_features = exclude_pos_from_node_features
+        self.edge_radius = edge_radius
+        self.max_num_neighbors = max_num_neighbors
+        self.pos_features = pos_features
+        self.vel_features = vel_features
+
+        super().__init__(**kwargs)
+
+        if self.pos_features > 0:
+            self.pos_features += 1  # We will add also 1-dimensional distance
+        self.edge_features = self.pos_features + self.vel_features
+        self.input_features = sum(
+            [
+                spec.shape[-1]
+                for key, spec in self.input_spec.items(True, True)
+                if _unravel_key_to_tuple(key)[-1] not in (position_key, velocity_key)
+            ]
+        )  # Input keys
+        if self.position_key is not None and not self.exclude_pos_from_node_features:
+            self.input_features += self.pos_features - 1
+        if self.velocity_key is not None:
+            self.input_features += self.vel_features
+
+        self.output_features = self.output_leaf_spec.shape[-1]
+
+        n_params = self.n_agents if not self.share_params else 1
+        self.qkv = _AgentLinear(
+            self.input_features, 3 * self.embed_dim, n_params, device=self.device
+        )
+        self.edge_bias = (
+            _AgentLinear(
+                self.edge_features, self.num_heads, n_params, device=self.device
+            )
+            if self.edge_features > 0 and self.topology != "empty"
+            else None
+        )
+        self.out = _AgentLinear(
+            self.embed_dim + self.input_features,
+            self.output_features,
+            n_params,
+            device=self.device,
+        )
+        self._full_position_key = None
+        self._full_velocity_key = None
+
+    def _perform_checks(self):
+        super()._perform_checks()
+
+        _check_graph_model(self, model_name="AttentionGnn")
+        if self.num_heads <= 0 or self.embed_dim % self.num_heads != 0:
+            raise ValueError(
+                f"embed_dim ({self.embed_dim}) must be divisible by num_heads ({self.num_heads})"
+            )
+
+    def _forward(self, tensordict: TensorDictBase) -> TensorDictBase:
+        input, pos, vel = _get_graph_inputs(
+            self,
+            tensordict,
+            self.input_spec.keys(True, True),
+            model_name="AttentionGnn",
+        )
+        input = torch.cat(input, dim=-1)
+        batch_size = input.shape[:-2]
+        if self.topology == "from_pos":
+            adjacency = _neighbours_to_adjacency(
+                _get_radius_neighbours(
+                    tensordict,
+                    key=_radius_graph_key(
+                        self.agent_group,
+                        position_key=self.position_key,
+                        edge_radius=self.edge_radius,
+                        self_loops=self.self_loops,
+                        max_num_neighbors=self.max_num_neighbors,
+                    ),
+                    pos=pos,
+                    edge_radius=self.edge_radius,
+                    self_loops=self.self_loops,
+                    max_num_neighbors=self.max_num_neighbors,
+                )
+            ).reshape(-1, self.n_agents, self.n_agents)
+        else:
+            adjacency = None
+        # Attention is computed with one batch dimension
+        x = input.reshape(-1, self.n_agents, self.input_features)
+        if pos is not None:
+            pos = pos.reshape(-1, self.n_agents, pos.shape[-1])
+        if vel is not None:
+            vel = vel.reshape(-1, self.n_agents, vel.shape[-1])
+        agent_mask = self._get_agent_mask(tensordict)
+        if agent_mask is not None:
+            agent_mask = agent_mask.reshape(-1, self.n_agents)
+
+        res = self._attention(x, pos, vel, adjacency, agent_mask)
+        res = torch.cat([res, x], dim=-1)
+        if self.centralised:
+            res = _mean_over_agents(res, agent_mask)  # Mean pooling
+            if not self.share_params:
+                res = res.unsqueeze(-2).expand(-1, self.n_agents, res.shape[-1])
+        res = self.out(res)
+        if agent_mask is not None and self.output_has_agent_dim:
+            res = res.masked_fill(~agent_mask.unsqueeze(-1), 0)
+        res = res.view(*batch_size, *res.shape[1:])
+
+        tensordict.set(self.out_key, res)
+        return tensordict
+
+    def _attention(
+        self,
+        x: Tensor,
+        pos: Optional[Tensor],
+        vel: Optional[Tensor],
+        adjacency: Optional[Tensor],
+        agent_mask: Optional[Tensor] = None,
+    ):
+        """Computes the attention output of shape ``(batch,n_agents,embed_dim)`` from node features ``x`` of shape ``(batch,n_agents,F)``.
+
+        ``adjacency`` is the radius graph of the agents for the ``"from_pos"`` topology.
+        ``agent_mask`` of shape ``(batch,n_agents)`` marks the agents present when the agent dimension is padded:
+        padded agents are not attended to and their output is 0.
+        """
+        q, k, v = self.qkv(x).chunk(3, dim=-1)
+        if self.topology == "empty":
+            # Agents only attend to themselves (if they have a self loop)
+            res = v if self.self_loops else torch.zeros_like(v)
+            if agent_mask is not None:
+                res = res.masked_fill(~agent_mask.unsqueeze(-1), 0)
+            return res
+
+        # Queries, keys and values of shape (batch,num_heads,n_agents,head_dim)
+        q, k, v = (
+            t.unflatten(-1, (self.num_heads, -1)).transpose(-2, -3) for t in (q, k, v)
+        )
+        if self.topology == "full":
+            adjacency = (
+                None
+                if self.self_loops
+                else ~torch.eye(self.n_agents, dtype=torch.bool, device=x.device)
+            )
+
+        if agent_mask is not None:
+            # Padded agents neither attend (queries) nor are attended to (keys)
+            present = agent_mask.unsqueeze(-1) & agent_mask.unsqueeze(-2)
+            adjacency = present if adjacency is None else adjacency & present
+
+        has_neighbours = None
+        if adjacency is not None:
+            # Agents without neighbours (e.g., a single agent without self loops)
+            # attend to all agents to avoid nans, and their output is then set to 0
+            has_neighbours = adjacency.any(dim=-1, keepdim=True)
+            adjacency = adjacency | ~has_neighbours
+
+        attn_mask = adjacency
+        if self.edge_bias is not None:
+            # Bias of shape (batch,num_heads,n_agents,n_agents), with the agent dimension of the targets in -2
+            edge_attr = _dense_edge_attr(pos=pos, vel=vel)
+            attn_mask = self.edge_bias(edge_attr.transpose(-2, -3)).permute(0, 3, 2, 1)
+            if adjacency is not None:
+                attn_mask = attn_mask.masked_fill(
+                    ~adjacency.unsqueeze(-3), float("-inf")
+                )
+        elif attn_mask is not None:
+            attn_mask = attn_mask.unsqueeze(-3)
+
+        if (
+            self.edge_bias is not None
+            and torch.is_grad_enabled()
+            and _is_vmapped(attn_mask)
+        ):
+            # Vmapped tensors do not report requires_grad, so the fused kernel chosen under vmap
+            # (flash attention on CPU) is not differentiable with respect to the learned bias in the mask.
+            # In this case only, the attention is computed explicitly
+            scores = q @ k.transpose(-1, -2) / math.sqrt(q.shape[-1]) + attn_mask
+            res = torch.softmax(scores, dim=-1) @ v
+        else:
+            res = nn.functional.scaled_dot_product_attention(
+                q, k, v, attn_mask=attn_mask
+            )
+        res = res.transpose(-2, -3).flatten(-2)
+        if has_neighbours is not None:
+            res = res.masked_fill(~has_neighbours, 0)
+        return res
+
+
+@dataclass
+class AttentionGnnConfig(ModelConfig):
+    """Dataclass config for a :class:`~benchmarl.models.AttentionGnn`."""
+
+    topology: str = MISSING
+    self_loops: bool = MISSING
+
+    num_heads: int = MISSING
+    embed_dim: int = MISSING
+
+    position_key: Optional[str] = None
+    pos_features: Optional[int] = 0
+    velocity_key: Optional[str] = None
+    vel_features: Optional[int] = 0
+    exclude_pos_from_node_features: Optional[bool] = None
+    edge_radius: Optional[float] = None
+    max_num_neighbors: Optional[int] = None
+
+    @staticmethod
+    def associated_class():
+        return AttentionGnn
@@ -13,7 +13,7 @@ from tensordict import TensorDictBase
 from torch import nn
 from torchrl.modules import ConvNet, MLP, MultiAgentConvNet, MultiAgentMLP
 
-from benchmarl.models.common import Model, ModelConfig
+from benchmarl.models.common import _StackedModules, Model, ModelConfig
 
 
 def _number_conv_outputs(
@@ -155,17 +155,20 @@ class Cnn(Model):
             example_net = self.cnn._empty_net
 
         else:
-            self.cnn = nn.ModuleList(
-                [
-                    ConvNet(
-                        in_features=self.input_features_images,
-                        device=self.device,
-                        **cnn_net_kwargs,
-                    )
-                    for _ in range(self.n_agents if not self.share_params else 1)
-                ]
+            agent_networks = [
+                ConvNet(
+                    in_features=self.input_features_images,
+                    device=self.device,
+                    **cnn_net_kwargs,
+                )
+                for _ in range(self.n_agents if not self.share_params else 1)
+            ]
+            self.cnn = (
+                nn.ModuleList(agent_networks)
+                if self.share_params
+                else _StackedModules(agent_networks)
             )
-            example_net = self.cnn[0]
+            example_net = agent_networks[0]
 
         out_features = example_net.out_features
         out_x, out_y = _number_conv_outputs(
@@ -187,16 +190,19 @@ class Cnn(Model):
                 **mlp_net_kwargs,
             )
         else:
-            self.mlp = nn.ModuleList(
-                [
-                    MLP(
-                        in_features=cnn_output_size + self.input_features_tensors,
-                        out_features=self.output_features,
-                        device=self.device,
-                        **mlp_net_kwargs,
-                    )
-                    for _ in range(self.n_agents if not self.share_params else 1)
-                ]
+            agent_networks = [
+                MLP(
+                    in_features=cnn_output_size + self.input_features_tensors,
+                    out_features=self.output_features,
+                    device=self.device,
+                    **mlp_net_kwargs,
+                )
+                for _ in range(self.n_agents if not self.share_params else 1)
+            ]
+            self.mlp = (
+                nn.ModuleList(agent_networks)
+                if self.share_params
+                else _StackedModules(agent_networks)
             )
 
     def _perform_checks(self):
@@ -263,12 +269,18 @@ class Cnn(Model):
         ).to(torch.float)
         # BenchMARL images are X,Y,C -> we convert them to C, X, Y for processing in TorchRL models
         input = input.transpose(-3, -1).transpose(-2, -1)
+        agent_mask = self._get_agent_mask(tensordict)
+        if agent_mask is not None and self.input_has_agent_dim:
+            # Padded agents do not contribute to centralised outputs
+            input = input.masked_fill(~agent_mask[..., None, None, None], 0)
 
         # Gather tensor inputs
         if len(self.tensor_in_keys):
             tensor_inputs = torch.cat(
                 [tensordict.get(in_key) for in_key in self.tensor_in_keys], dim=-1
             )
+            if agent_mask is not None and self.input_has_agent_dim:
+                tensor_inputs = tensor_inputs.masked_fill(~agent_mask.unsqueeze(-1), 0)
             if self.input_has_agent_dim and not self.output_has_agent_dim:
                 tensor_inputs = tensor_inputs.reshape((*tensor_inputs.shape[:-2], -1))
             elif not self.input_has_agent_dim and self.output_has_agent_dim:
@@ -288,10 +300,7 @@ class Cnn(Model):
         # Does not have multi-agent input dimension
         else:
             if not self.share_params:
-                cnn_out = torch.stack(
-                    [net(input) for net in self.cnn],
-                    dim=-2,
-                )
+                cnn_out = self.cnn(input, in_dims=(None,), out_dim=-2)
             else:
                 cnn_out = self.cnn[0](input)
 
@@ -303,13 +312,12 @@ class Cnn(Model):
             res = self.mlp.forward(cnn_out)
         else:
             if not self.share_params:
-                res = torch.stack(
-                    [net(cnn_out) for net in self.mlp],
-                    dim=-2,
-                )
+                res = self.mlp(cnn_out, in_dims=(None,), out_dim=-2)
             else:
                 res = self.mlp[0](cnn_out)
 
+        if agent_mask is not None and self.output_has_agent_dim:
+            res = res.masked_fill(~agent_mask.unsqueeze(-1), 0)
         tensordict.set(self.out_key, res)
         return tensordict
 
@@ -4,35 +4,183 @@
 #  LICENSE file in the root directory of this source tree.
 #
 
+import copy
 import pathlib
+import time
 import warnings
 from abc import ABC, abstractmethod
 from dataclasses import asdict, dataclass
-from typing import Any, Dict, List, Optional, Sequence
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-from tensordict import TensorDictBase
+import torch
+from tensordict import TensorDict, TensorDictBase
 from tensordict.nn import TensorDictModuleBase, TensorDictSequential
 from tensordict.utils import NestedKey
+from torch import nn, Tensor
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils.flop_counter import flop_registry
 from torchrl.data import Composite, TensorSpec, Unbounded
 
 from benchmarl.utils import _class_from_name, _read_yaml_config, DEVICE_TYPING
 
 
+# Reserved key of the boolean mask of shape ``(*batch, n_agents)`` of the agents present, in the agent group of the input.
+# Tasks with a variable number of agents pad the agent dimension to ``n_agents`` and give this mask with the observations,
+# so that models ignore the padded agents
+AGENT_MASK_KEY = "agent_mask"
+
+
 def _check_spec(tensordict, spec):
     if not spec.is_in(tensordict):
         raise ValueError(f"TensorDict {tensordict} not in spec {spec}")
 
 
+class _FlopCounter(TorchDispatchMode):
+    """Counts the FLOPs of the operations run in the context (see :mod:`torch.utils.flop_counter`).
+
+    Unlike :class:`torch.utils.flop_counter.FlopCounterMode`, it does not track modules,
+    which fails on modules holding tensordicts.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.flops = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs if kwargs else {}
+        out = func(*args, **kwargs)
+        if func._overloadpacket in flop_registry:
+            self.flops += flop_registry[func._overloadpacket](
+                *args, **kwargs, out_val=out
+            )
+        return out
+
+
 def parse_model_config(cfg: Dict[str, Any]) -> Dict[str, Any]:
     del cfg["name"]
     kwargs = {}
     for key, value in cfg.items():
-        if key.endswith("class") and value is not None:
+        if key.endswith("class") and isinstance(value, list):
+            value = [_class_from_name(name) for name in value]
+        elif key.endswith("class") and value is not None:
             value = _class_from_name(cfg[key])
         kwargs.update({key: value})
     return kwargs
 
 
+def _stored_state_name(state_name: str) -> str:
+    """Name under which a model state is stored in the collected data.
+
+    Model states are private keys, which collectors do not keep in the collected data,
+    so the states that models store are written under the corresponding public keys.
+    """
+    return state_name.lstrip("_")
+
+
+class _StackedModules(nn.Module):
+    """Copies of a module with different parameters (e.g., one per agent), run together with :func:`torch.vmap`.
+
+    As in :class:`~benchmarl.models.gru.MultiAgentGRU`, the parameters of the copies are stacked once in
+    :class:`~tensordict.nn.TensorDictParams` and loaded in a copy of the module without parameters in the forward
+    pass, so all copies run in the same kernels instead of looping over them.
+    State dicts of the list of copies (e.g., ``"0.weight"``, ``"1.weight"``), saved before the parameters were stacked,
+    are stacked when loaded.
+
+    Args:
+        modules (list of nn.Module): the copies of the module, with the same structure and no buffers.
+
+    """
+
+    def __init__(self, modules: List[nn.Module]):
+        super().__init__()
+        for module in modules:
+            if next(module.buffers(), None) is not None:
+                raise ValueError(
+                    f"Module {module} has buffers (e.g., batch norm running statistics), "
+                    f"which cannot be updated when the agent networks are run together with torch.vmap"
+                )
+        self.n_modules = len(modules)
+        self.params = TensorDict.from_modules(*modules, as_module=True)
+        empty_module = copy.deepcopy(modules[0])
+        # Remove all parameters
+        TensorDict.from_module(empty_module).data.to("meta").to_module(empty_module)
+        # Not registered as a submodule, so it does not appear in the state_dict
+        self.__dict__["_empty_module"] = empty_module
+        self._register_load_state_dict_pre_hook(self._stack_state_dict)
+
+    def _stack_state_dict(self, state_dict, prefix, *args):
+        names = self.params.flatten_keys(".").keys(
+            include_nested=True, leaves_only=True
+        )
+        if not all(f"{prefix}0.{name}" in state_dict for name in names):
+            return
+        for name in names:
+            state_dict[f"{prefix}params.{name}"] = torch.stack(
+                [state_dict.pop(f"{prefix}{i}.{name}") for i in range(self.n_modules)]
+            )
+        state_dict[f"{prefix}params.__batch_size"] = self.params.batch_size
+        state_dict[f"{prefix}params.__device"] = self.params.device
+
+    def forward(
+        self,
+        *inputs: Optional[Tensor],
+        in_dims: Tuple[Optional[int], ...],
+        out_dim: int,
+    ) -> Tensor:
+        """Runs all the copies of the module.
+
+        Args:
+            inputs (Tensor): the inputs of the module.
+            in_dims (tuple of int or None): the dimension of each input indexing the copies,
+                or ``None`` for inputs given to all the copies.
+            out_dim (int): the dimension of the output indexing the copies.
+
+        """
+        return self.vmap(
+            lambda module, *inputs: module(*inputs),
+            *inputs,
+            in_dims=in_dims,
+            out_dim=out_dim,
+        )
+
+    def vmap(
+        self,
+        func: Callable[..., Tensor],
+        *inputs: Optional[Tensor],
+        in_dims: Tuple[Optional[int], ...],
+        out_dim: int,
+    ) -> Tensor:
+        """Runs ``func(module, *inputs)`` for all the copies of the module.
+
+        Args:
+            func (Callable): function called with a copy of the module and the inputs of that copy.
+            inputs (Tensor): the inputs of ``func``.
+            in_dims (tuple of int or None): the dimension of each input indexing the copies,
+                or ``None`` for inputs given to all the copies.
+            out_dim (int): the dimension of the output indexing the copies.
+
+        """
+
+        def exec_module(params, *inputs):
+            with params.to_module(self._empty_module):
+                return func(self._empty_module, *inputs)
+
+        return torch.vmap(
+            exec_module,
+            in_dims=(0, *in_dims),
+            out_dims=out_dim,
+            randomness="different",
+        )(self.params, *inputs)
+
+
+def _mean_over_agents(x: Tensor, agent_mask: Optional[Tensor]) -> Tensor:
+    """Mean of ``x`` of shape ``(*batch, n_agents, F)`` over the agents, only counting the agents present in ``agent_mask`` if given."""
+    if agent_mask is None:
+        return x.mean(dim=-2)
+    agent_mask = agent_mask.unsqueeze(-1).to(x.dtype)
+    return (x * agent_mask).sum(dim=-2) / agent_mask.sum(dim=-2).clamp(min=1)
+
+
 def output_has_agent_dim(share_params: bool, centralised: bool) -> bool:
     """
     This is a dynamically computed attribute that indicates if the output will have the agent dimension.
@@ -76,6 +224,12 @@ class Model(TensorDictModuleBase, ABC):
         action_spec (Composite): The action spec of the environment
         model_index (int): the index of the model in a sequence
         is_critic (bool): Whether the model is a critic
+
+    If the input spec contains :data:`AGENT_MASK_KEY` in the agent group, the agent dimension is padded:
+    the mask is removed from the ``input_spec`` of the model (it is not an input feature),
+    added to its ``in_keys`` and can be read in the forward pass with :meth:`_get_agent_mask`.
+    All BenchMARL models use it so that padded agents do not change the outputs of the agents present
+    and have zero outputs. Custom models that do not read it treat padded agents as present.
     """
 
     def __init__(
@@ -106,7 +260,15 @@ class Model(TensorDictModuleBase, ABC):
         self.model_index = model_index
         self.is_critic = is_critic
 
+        self.agent_mask_key = None
+        if (agent_group, AGENT_MASK_KEY) in self.input_spec.keys(True, True):
+            self.agent_mask_key = (agent_group, AGENT_MASK_KEY)
+            self.input_spec = self.input_spec.clone()
+            del self.input_spec[self.agent_mask_key]
+
         self.in_keys = list(self.input_spec.keys(True, True))
+        if self.agent_mask_key is not None:
+            self.in_keys.append(self.agent_mask_key)
         self.out_keys = list(self.output_spec.keys(True, True))
 
         self.out_key = self.out_keys[0]
@@ -134,6 +296,13 @@ class Model(TensorDictModuleBase, ABC):
     def input_leaf_spec(self) -> TensorSpec:
         return self.input_spec[self.in_key]
 
+    def _get_agent_mask(self, tensordict: TensorDictBase) -> Optional[Tensor]:
+        """Returns the boolean mask of shape ``(*batch, n_agents)`` of the agents present,
+        or ``None`` if the agent dimension is not padded."""
+        if self.agent_mask_key is None:
+            return None
+        return tensordict.get(self.agent_mask_key).to(torch.bool)
+
     def _perform_checks(self):
         if not self.input_has_agent_dim and not self.centralised:
             raise ValueError(
@@ -303,6 +472,99 @@ class ModelConfig(ABC):
             is_critic=self.is_critic,
         )
 
+    def estimate_cost(
+        self,
+        input_spec: Composite,
+        output_spec: Composite,
+        agent_group: str,
+        input_has_agent_dim: bool,
+        n_agents: int,
+        centralised: bool,
+        share_params: bool,
+        action_spec: Optional[Composite] = None,
+        batch_sizes: Sequence[int] = (1, 64, 1024),
+        n_iters: int = 20,
+    ) -> Dict[str, Any]:
+        """
+        Estimates the compute cost of the model built from the config.
+
+        The model is created on CPU with :meth:`get_model` and run on random inputs drawn from ``input_spec``.
+        RNN models are run on sequences of length 1.
+        FLOPs are counted with the formulas of :mod:`torch.utils.flop_counter`, which cover matrix products,
+        convolutions and attention, but not elementwise operations or graph aggregations.
+
+        Args:
+            input_spec (Composite): the input spec of the model
+            output_spec (Composite): the output spec of the model
+            agent_group (str): the name of the agent group the model is for
+            input_has_agent_dim (bool): whether the input will have a multi-agent dimension
+            n_agents (int): the number of agents this module is for
+            centralised (bool): whether the model has full observability
+            share_params (bool): whether the model has only one set of parameters for all agents
+            action_spec (Composite, optional): The action spec of the environment
+            batch_sizes (sequence of int): the batch sizes to estimate the cost for. Defaults to ``(1, 64, 1024)``.
+            n_iters (int): the number of forward passes used to measure the latency. Defaults to ``20``.
+
+        Returns: a dictionary with the number of trainable ``"params"`` and a ``"batch_sizes"`` dictionary, mapping each
+            batch size to the ``"flops"`` of one forward pass, the ``"activation_bytes"`` saved for the backward pass,
+            the measured forward ``"latency"`` (in seconds) and ``"throughput"`` (in samples per second).
+
+        """
+        model = self.get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_group,
+            input_has_agent_dim=input_has_agent_dim,
+            n_agents=n_agents,
+            centralised=centralised,
+            share_params=share_params,
+            device="cpu",
+            action_spec=action_spec,
+        )
+        params = {p.data_ptr() for p in model.parameters()}
+        # Tensors saved for backward that are not parameters, counting shared storages once
+        saved_tensors = {}
+
+        def pack(tensor: Tensor) -> Tensor:
+            if tensor.data_ptr() not in params:
+                saved_tensors[tensor.data_ptr()] = (
+                    tensor.numel() * tensor.element_size()
+                )
+            return tensor
+
+        costs = {}
+        for batch_size in batch_sizes:
+            batch_size = (batch_size, 1) if self.is_rnn else (batch_size,)
+            input_td = input_spec.expand(*batch_size, *input_spec.shape).rand()
+            if self.is_rnn:
+                input_td.set("is_init", torch.zeros(*batch_size, 1, dtype=torch.bool))
+
+            with _FlopCounter() as flop_counter:
+                model(input_td.clone())
+
+            saved_tensors.clear()
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+                model(input_td.clone())
+
+            with torch.no_grad():
+                for _ in range(2):  # Warmup
+                    model(input_td.clone())
+                start = time.perf_counter()
+                for _ in range(n_iters):
+                    model(input_td.clone())
+                latency = (time.perf_counter() - start) / n_iters
+
+            costs[batch_size[0]] = {
+                "flops": flop_counter.flops,
+                "activation_bytes": sum(saved_tensors.values()),
+                "latency": latency,
+                "throughput": batch_size[0] / latency,
+            }
+        return {
+            "params": sum(p.numel() for p in model.parameters() if p.requires_grad),
+            "batch_sizes": costs,
+        }
+
     @staticmethod
     @abstractmethod
     def associated_class():
@@ -354,6 +616,12 @@ class ModelConfig(ABC):
     ) -> Composite:
         return self.get_model_state_spec(model_index)
 
+    def _get_graph_spec(self, group: str, n_agents: int) -> Composite:
+        """Spec (with shape ``(n_agents,)``) of the agent graphs that the model outputs
+        during collection to store them in the data of ``group``.
+        """
+        return Composite(shape=(n_agents,))
+
     @staticmethod
     def _load_from_yaml(name: str) -> Dict[str, Any]:
         yaml_path = (
@@ -484,9 +752,26 @@ class SequenceModelConfig(ModelConfig):
             )
         ]
 
+        next_input_specs = intermediate_specs[:-1]
+        if (agent_group, AGENT_MASK_KEY) in input_spec.keys(
+            True, True
+        ) and out_has_agent_dim:
+            # The agent mask is given to all models in the sequence
+            agent_mask_spec = Composite(
+                {
+                    agent_group: Composite(
+                        {AGENT_MASK_KEY: input_spec[agent_group, AGENT_MASK_KEY]},
+                        shape=(n_agents,),
+                    )
+                }
+            )
+            next_input_specs = [
+                Composite({**spec, **agent_mask_spec}) for spec in next_input_specs
+            ]
+
         next_models = [
             self.model_configs[i].get_model(
-                input_spec=intermediate_specs[i - 1],
+                input_spec=next_input_specs[i - 1],
                 output_spec=intermediate_specs[i],
                 agent_group=agent_group,
                 input_has_agent_dim=out_has_agent_dim,
@@ -524,6 +809,12 @@ class SequenceModelConfig(ModelConfig):
             spec.update(model_config.get_model_state_spec(model_index=i))
         return spec
 
+    def _get_graph_spec(self, group: str, n_agents: int) -> Composite:
+        spec = Composite(shape=(n_agents,))
+        for model_config in self.model_configs:
+            spec.update(model_config._get_graph_spec(group, n_agents))
+        return spec
+
     @property
     def is_rnn(self) -> bool:
         is_rnn = False
@@ -576,6 +867,9 @@ class EnsembleModelConfig(ModelConfig):
             model_index=model_index
         )
 
+    def _get_graph_spec(self, group: str, n_agents: int) -> Composite:
+        return self.model_configs_map[group]._get_graph_spec(group, n_agents)
+
     @property
     def is_rnn(self) -> bool:
         is_rnn = False
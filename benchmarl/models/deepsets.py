@@ -7,14 +7,14 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, MISSING
-from typing import Optional, Sequence, Type
+from typing import List, Optional, Sequence, Type
 
 import torch
 from tensordict import TensorDictBase
 from torch import nn, Tensor
 from torchrl.modules import MLP
 
-from benchmarl.models.common import Model, ModelConfig
+from benchmarl.models.common import _StackedModules, Model, ModelConfig
 
 
 class Deepsets(Model):
@@ -99,7 +99,7 @@ class Deepsets(Model):
         self.output_features = self.output_leaf_spec.shape[-1]
 
         if self.input_local_set_features > 0:  # Need local deepsets
-            self.local_deepsets = nn.ModuleList(
+            self.local_deepsets = self._stack_agent_networks(
                 [
                     self._make_deepsets_net(
                         in_features=self.input_local_set_features,
@@ -121,7 +121,7 @@ class Deepsets(Model):
                 ]
             )
         if self.centralised:  # Need global deepsets
-            self.global_deepsets = nn.ModuleList(
+            self.global_deepsets = self._stack_agent_networks(
                 [
                     self._make_deepsets_net(
                         in_features=(
@@ -143,6 +143,11 @@ class Deepsets(Model):
                 ]
             )
 
+    def _stack_agent_networks(self, agent_networks: List[nn.Module]) -> nn.Module:
+        if self.share_params:
+            return nn.ModuleList(agent_networks)
+        return _StackedModules(agent_networks)
+
     def _make_deepsets_net(
         self,
         in_features: int,
@@ -259,6 +264,7 @@ class Deepsets(Model):
             raise ValueError()
 
     def _forward(self, tensordict: TensorDictBase) -> TensorDictBase:
+        agent_mask = self._get_agent_mask(tensordict)
         if len(self.set_in_keys_local):
             # Local deep sets
             input_local_sets = torch.cat(
@@ -275,13 +281,15 @@ class Deepsets(Model):
                     input_local_sets, input_local_tensors
                 )
             else:
-                local_output = torch.stack(
-                    [
-                        net(input_local_sets, input_local_tensors)[..., i, :]
-                        for i, net in enumerate(self.local_deepsets)
-                    ],
-                    dim=-2,
+                # Each agent network processes the sets of its agent
+                local_output = self.local_deepsets(
+                    input_local_sets,
+                    input_local_tensors,
+                    in_dims=(-3, -2 if input_local_tensors is not None else None),
+                    out_dim=-2,
                 )
+            if agent_mask is not None:
+                local_output = local_output.masked_fill(~agent_mask.unsqueeze(-1), 0)
         else:
             local_output = None
 
@@ -299,18 +307,23 @@ class Deepsets(Model):
                     [tensordict.get(in_key) for in_key in self.tensor_in_keys_global],
                     dim=-1,
                 )
+            # With agent inputs, the global set is the agents, so padded agents are left out of the reduction
             if self.share_params:
                 global_output = self.global_deepsets[0](
-                    local_output, input_global_tensors
+                    local_output, input_global_tensors, agent_mask
                 )
             else:
-                global_output = torch.stack(
-                    [
-                        net(local_output, input_global_tensors)
-                        for i, net in enumerate(self.global_deepsets)
-                    ],
-                    dim=-2,
+                global_output = self.global_deepsets(
+                    local_output,
+                    input_global_tensors,
+                    agent_mask,
+                    in_dims=(None, None, None),
+                    out_dim=-2,
                 )
+                if agent_mask is not None:
+                    global_output = global_output.masked_fill(
+                        ~agent_mask.unsqueeze(-1), 0
+                    )
             tensordict.set(self.out_key, global_output)
         else:
             tensordict.set(self.out_key, local_output)
@@ -334,16 +347,29 @@ class _DeepsetsNet(nn.Module):
         self.local_nn = local_nn
         self.global_nn = global_nn
 
-    def forward(self, x: Tensor, extra_global_input: Optional[Tensor]) -> Tensor:
+    def forward(
+        self,
+        x: Tensor,
+        extra_global_input: Optional[Tensor],
+        set_mask: Optional[Tensor] = None,
+    ) -> Tensor:
         x = self.local_nn(x)
-        x = self.reduce(x, dim=self.set_dim, aggr=self.aggr)
+        x = self.reduce(x, dim=self.set_dim, aggr=self.aggr, mask=set_mask)
         if extra_global_input is not None:
             x = torch.cat([x, extra_global_input], dim=-1)
         x = self.global_nn(x)
         return x
 
     @staticmethod
-    def reduce(x: Tensor, dim: int, aggr: str) -> Tensor:
+    def reduce(x: Tensor, dim: int, aggr: str, mask: Optional[Tensor] = None) -> Tensor:
+        if mask is not None:
+            # Only the set elements in the mask are reduced
+            mask = mask.unsqueeze(-1)
+            if aggr == "mean":
+                count = mask.sum(dim=dim).clamp(min=1)
+                return x.masked_fill(~mask, 0).sum(dim=dim) / count
+            fill = {"max": float("-inf"), "min": float("inf"), "mul": 1}.get(aggr, 0)
+            x = x.masked_fill(~mask, fill)
         if aggr == "sum" or aggr == "add":
             return torch.sum(x, dim=dim)
         elif aggr == "mean":
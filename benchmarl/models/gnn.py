@@ -8,44 +8,42 @@ from __future__ import annotations
 
 import importlib
 import inspect
+import itertools
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass, MISSING
 from math import prod
-from typing import List, Optional, Type
+from typing import Callable, List, Optional, Sequence, Tuple, Type, Union
 
 import torch
-from tensordict import TensorDictBase
+from tensordict import TensorDict, TensorDictBase
 from tensordict.utils import _unravel_key_to_tuple, NestedKey
 from torch import nn, Tensor
+from torchrl.data import Composite, Unbounded
 
-from benchmarl.models.common import Model, ModelConfig
+from benchmarl.models.common import (
+    _mean_over_agents,
+    _StackedModules,
+    Model,
+    ModelConfig,
+)
 
 _has_torch_geometric = importlib.util.find_spec("torch_geometric") is not None
 if _has_torch_geometric:
     import torch_geometric
-    from torch_geometric.transforms import BaseTransform
 
-    class _RelVel(BaseTransform):
-        """Transform that reads graph.vel and writes node1.vel - node2.vel in the edge attributes"""
 
-        def __init__(self):
-            pass
-
-        def __call__(self, data):
-            (row, col), vel, pseudo = data.edge_index, data.vel, data.edge_attr
-
-            cart = vel[row] - vel[col]
-            cart = cart.view(-1, 1) if cart.dim() == 1 else cart
-
-            if pseudo is not None:
-                pseudo = pseudo.view(-1, 1) if pseudo.dim() == 1 else pseudo
-                data.edge_attr = torch.cat([pseudo, cart.type_as(pseudo)], dim=-1)
-            else:
-                data.edge_attr = cart
-            return data
+TOPOLOGY_TYPES = {"full", "empty", "from_pos"}
 
+# Number of batch sizes for which the batched topology is cached
+_TOPOLOGY_CACHE_SIZE = 8
 
-TOPOLOGY_TYPES = {"full", "empty", "from_pos"}
+# Reserved key under which models store the graphs built from positions in the agent group of the input tensordict,
+# so that other models run on the same tensordict (e.g., the critic after the actor) can reuse them
+GRAPH_CACHE_KEY = "_graph"
+# Reserved key under which models with ``store_graph=True`` store their graphs instead.
+# Unlike private keys, it is kept in the collected data
+STORED_GRAPH_KEY = "graph"
 
 
 class Gnn(Model):
@@ -57,8 +55,17 @@ class Gnn(Model):
         topology (str): Topology of the graph adjacency matrix. Options: "full", "empty", "from_pos". "from_pos" builds
             the topology dynamically based on ``position_key`` and ``edge_radius``.
         self_loops (str): Whether the resulting adjacency matrix will have self loops.
-        gnn_class (Type[torch_geometric.nn.MessagePassing]): the gnn convolution class to use
-        gnn_kwargs (dict, optional): the dict of arguments to pass to the gnn conv class
+        gnn_class (Type[torch_geometric.nn.MessagePassing] or Sequence[Type[torch_geometric.nn.MessagePassing]]): the gnn
+            convolution class to use. If a sequence is given, it contains the class of each layer.
+        gnn_kwargs (dict or Sequence[dict], optional): the dict of arguments to pass to the gnn conv class.
+            If a sequence is given, it contains the arguments of each layer.
+        num_cells (Sequence[int], optional): the number of output features of each gnn layer in between the input
+            and output. If provided, the model runs ``len(num_cells) + 1`` message passing layers on the same graph, which is built only once.
+            This is cheaper than a :class:`~benchmarl.models.SequenceModel` of GNNs, where each GNN builds its own graph.
+            If ``gnn_class`` is a sequence, it should contain ``len(num_cells) + 1`` classes. Defaults to one layer.
+        activation_class (Type[nn.Module], optional): activation class applied between the gnn layers. Defaults to no activation.
+        residual (bool, optional): if ``True``, the input of each gnn layer is added to its output
+            when they have the same number of features. Defaults to ``False``.
         position_key (str, optional): if provided, it will need to match a leaf key in the tensordict coming from the env
             (in the `observation_spec`) representing the agent position.
             To do this, your environment needs to have dictionary observations and one of the keys needs to be `position_key`.
@@ -69,7 +76,7 @@ class Gnn(Model):
         pos_features (int, optional): Needed when position_key is specified.
             It has to match to the last element of the shape the tensor under position_key.
         exclude_pos_from_node_features (optional, bool): If ``position_key`` is provided,
-            wether to use it just to compute edge features or also include it in node features.
+            whether to use it just to compute edge features or also include it in node features.
         velocity_key (str, optional): if provided, it will need to match a leaf key in the tensordict coming from the env
             (in the `observation_spec`) representing the agent position.
             To do this, your environment needs to have dictionary observations and one of the keys needs to be `velocity_key`.
@@ -80,7 +87,16 @@ class Gnn(Model):
         vel_features (int, optional): Needed when velocity_key is specified.
             It has to match to the last element of the shape the tensor under velocity_key.
         edge_radius (float, optional): If topology is ``"from_pos"`` the radius to use to build the agent graph.
-            Agents within this radius distance will be neighnours.
+            Agents within this radius distance will be neighbours.
+        max_num_neighbors (int, optional): If topology is ``"from_pos"``, the maximum number of neighbours of each agent.
+            If more agents are within ``edge_radius``, only the nearest ones are kept.
+            This bounds the number of edges (and memory) in crowded scenarios. If ``None``, all neighbours are kept.
+            GATv2Conv layers run on radius graphs with their dense forward unless it bounds the edges to a small fraction of all agent pairs.
+        store_graph (bool, optional): If topology is ``"from_pos"``, whether to output the radius graph
+            (as padded neighbour lists and the positions it was built from) together with the model output.
+            Graphs built during collection are then stored in the replay buffer and reused in training instead of being rebuilt.
+            The graph is stored under :data:`STORED_GRAPH_KEY` instead of :data:`GRAPH_CACHE_KEY`,
+            so it is only reused by models with the same graph configuration and ``store_graph``. Defaults to ``False``.
 
     Examples:
 
@@ -124,22 +140,42 @@ class Gnn(Model):
         self,
         topology: str,
         self_loops: bool,
-        gnn_class: Type[torch_geometric.nn.MessagePassing],
-        gnn_kwargs: Optional[dict],
+        gnn_class: Union[
+            Type[torch_geometric.nn.MessagePassing],
+            Sequence[Type[torch_geometric.nn.MessagePassing]],
+        ],
+        gnn_kwargs: Optional[Union[dict, Sequence[dict]]],
         position_key: Optional[str],
         exclude_pos_from_node_features: Optional[bool],
         velocity_key: Optional[str],
         edge_radius: Optional[float],
         pos_features: Optional[int],
         vel_features: Optional[int],
+        max_num_neighbors: Optional[int],
+        num_cells: Optional[Sequence[int]] = None,
+        activation_class: Optional[Type[nn.Module]] = None,
+        residual: bool = False,
+        store_graph: bool = False,
         **kwargs,
     ):
         self.topology = topology
         self.self_loops = self_loops
+        self.num_cells = list(num_cells) if num_cells is not None else []
+        if isinstance(gnn_class, Sequence):
+            self.gnn_classes = list(gnn_class)
+        else:
+            self.gnn_classes = [gnn_class] * (len(self.num_cells) + 1)
+        if isinstance(gnn_kwargs, Sequence):
+            self.gnn_kwargs = [dict(layer_kwargs or {}) for layer_kwargs in gnn_kwargs]
+        else:
+            self.gnn_kwargs = [
+                dict(gnn_kwargs or {}) for _ in range(len(self.gnn_classes))
+            ]
         self.position_key = position_key
         self.velocity_key = velocity_key
         self.exclude_pos_from_node_features = exclude_pos_from_node_features
         self.edge_radius = edge_radius
+        self.max_num_neighbors = max_num_neighbors
         self.pos_features = pos_features
         self.vel_features = vel_features
 
@@ -162,14 +198,11 @@ class Gnn(Model):
 
         self.output_features = self.output_leaf_spec.shape[-1]
 
-        if gnn_kwargs is None:
-            gnn_kwargs = {}
-        gnn_kwargs.update(
-            {"in_channels": self.input_features, "out_channels": self.output_features}
-        )
-        self.gnn_supports_edge_attrs = (
-            "edge_dim" in inspect.getfullargspec(gnn_class).args
-        )
+        layer_supports_edge_attrs = [
+            "edge_dim" in inspect.getfullargspec(layer_class).args
+            for layer_class in self.gnn_classes
+        ]
+        self.gnn_supports_edge_attrs = any(layer_supports_edge_attrs)
         if (
             self.position_key is not None or self.velocity_key is not None
         ) and not self.gnn_supports_edge_attrs:
@@ -177,212 +210,465 @@ class Gnn(Model):
                 "Position key or velocity key provided but GNN class does not support edge attributes. "
                 "These keys will not be used for computing edge features."
             )
-        if (
-            position_key is not None or velocity_key is not None
-        ) and self.gnn_supports_edge_attrs:
-            gnn_kwargs.update({"edge_dim": self.edge_features})
+        use_edge_attr = position_key is not None or velocity_key is not None
+        sizes = [self.input_features, *self.num_cells, self.output_features]
+        for i, layer_kwargs in enumerate(self.gnn_kwargs):
+            layer_kwargs.update({"in_channels": sizes[i], "out_channels": sizes[i + 1]})
+            if use_edge_attr and layer_supports_edge_attrs[i]:
+                layer_kwargs.update({"edge_dim": self.edge_features})
 
-        self.gnns = nn.ModuleList(
-            [
-                gnn_class(**gnn_kwargs).to(self.device)
-                for _ in range(self.n_agents if not self.share_params else 1)
+        def make_gnn():
+            layers = [
+                layer_class(**layer_kwargs).to(self.device)
+                for layer_class, layer_kwargs in zip(self.gnn_classes, self.gnn_kwargs)
             ]
-        )
+            if len(layers) == 1:
+                return layers[0]
+            return _GnnStack(
+                layers,
+                activation_class=activation_class,
+                residual=residual,
+                edge_attr_layers=[
+                    use_edge_attr and supports for supports in layer_supports_edge_attrs
+                ],
+            ).to(self.device)
+
+        gnns = [
+            make_gnn() for _ in range(self.n_agents if not self.share_params else 1)
+        ]
+        # The parameters of the agent gnns are stacked once and the gnns are vmapped over agents
+        self.gnns = nn.ModuleList(gnns) if self.share_params else _StackedModules(gnns)
         self.edge_index = _get_edge_index(
             topology=self.topology,
             self_loops=self.self_loops,
             device=self.device,
             n_agents=self.n_agents,
         )
+        self._topology_cache = _BatchedTopologyCache(
+            edge_index=self.edge_index,
+            n_agents=self.n_agents,
+            max_size=_TOPOLOGY_CACHE_SIZE,
+        )
+        # Fully connected and radius graphs are run densely on the agent dimension when the gnn class allows it
+        self._dense_forward = (
+            _get_dense_forward(gnns[0])
+            if (self.topology == "full" and (self.n_agents > 1 or self.self_loops))
+            or self.topology == "from_pos"
+            else None
+        )
+        if self._dense_forward is not None and self.topology == "full":
+            self.register_buffer(
+                "_dense_adjacency",
+                _get_dense_adjacency(self.edge_index, n_agents=self.n_agents),
+                persistent=False,
+            )
+        # Radius graphs are run densely only if they can have enough edges for it to be faster.
+        # This is decided from their maximum number of edges, so that the graph is not read from the device
+        self._dense_radius_graph = (
+            self.topology == "from_pos"
+            and self._dense_forward is not None
+            and self.n_agents < _CELL_LIST_MIN_AGENTS
+            and _max_num_neighbours(
+                self.n_agents,
+                self_loops=self.self_loops,
+                max_num_neighbors=self.max_num_neighbors,
+            )
+            >= _dense_min_edge_density(gnns[0]) * self.n_agents
+        )
+        self._dense_needs_graph = self._dense_forward is not None and any(
+            _get_dense_forward(layer) is None
+            for layer in getattr(gnns[0], "layers", [])
+        )
+        graph_key_kwargs = {
+            "position_key": self.position_key,
+            "edge_radius": self.edge_radius,
+            "self_loops": self.self_loops,
+            "max_num_neighbors": self.max_num_neighbors,
+        }
+        self._graph_key = (
+            _radius_graph_key(self.agent_group, **graph_key_kwargs)
+            if self.topology == "from_pos"
+            else None
+        )
+        self._stored_graph_key = (
+            _radius_graph_key(self.agent_group, store_graph=True, **graph_key_kwargs)
+            if self.topology == "from_pos" and store_graph
+            else None
+        )
+        if self._stored_graph_key is not None:
+            # Read and output the graph, so that it is kept in the collected data and passed back to the model in training
+            graph_keys = [
+                self._stored_graph_key + ("neighbours",),
+                self._stored_graph_key + ("pos",),
+            ]
+            self.in_keys += graph_keys
+            self.out_keys += graph_keys
+        self._n_input_keys = len(self.input_spec.keys(True, True))
         self._full_position_key = None
         self._full_velocity_key = None
 
     def _perform_checks(self):
         super()._perform_checks()
 
-        if self.topology not in TOPOLOGY_TYPES:
-            raise ValueError(
-                f"Got topology: {self.topology} but only available options are {TOPOLOGY_TYPES}"
-            )
-        if self.topology == "from_pos" and self.position_key is None:
-            raise ValueError("If topology is from_pos, position_key must be provided")
-        if (
-            self.position_key is not None
-            and self.exclude_pos_from_node_features is None
-        ):
+        _check_graph_model(self, model_name="GNN")
+        if len(self.gnn_classes) != len(self.num_cells) + 1:
             raise ValueError(
-                "exclude_pos_from_node_features needs to be specified when position_key is provided"
+                f"Got {len(self.gnn_classes)} gnn classes for {len(self.num_cells) + 1} layers (num_cells={self.num_cells})"
             )
-        if self.position_key is not None and self.pos_features <= 0:
+        if len(self.gnn_kwargs) != len(self.gnn_classes):
             raise ValueError(
-                f"Position key specified but pos_features is {self.pos_features}"
+                f"Got {len(self.gnn_kwargs)} gnn kwargs for {len(self.gnn_classes)} layers"
             )
-        elif self.position_key is None and self.pos_features > 0:
-            raise ValueError(
-                f"If no position_key is given, pos_features needs to be 0, got: {self.pos_features}"
-            )
-        if self.velocity_key is not None and self.vel_features <= 0:
-            raise ValueError(
-                f"Velocity key specified but vel_features is {self.vel_features}"
+
+    def _forward(self, tensordict: TensorDictBase) -> TensorDictBase:
+        input, pos, vel = _get_graph_inputs(
+            self, tensordict, self.in_keys[: self._n_input_keys], model_name="GNN"
+        )
+        input = torch.cat(input, dim=-1)
+        batch_size = input.shape[:-2]
+        agent_mask = self._get_agent_mask(tensordict)
+        use_edge_attr = (
+            self.position_key is not None or self.velocity_key is not None
+        ) and self.gnn_supports_edge_attrs
+
+        dense = self._dense_forward is not None
+        if self.topology == "from_pos":
+            neighbours = _get_radius_neighbours(
+                tensordict,
+                key=self._graph_key,
+                stored_key=self._stored_graph_key,
+                pos=pos,
+                edge_radius=self.edge_radius,
+                self_loops=self.self_loops,
+                max_num_neighbors=self.max_num_neighbors,
             )
-        elif self.velocity_key is None and self.vel_features > 0:
-            raise ValueError(
-                f"If no velocity_key is given, vel_features needs to be 0, got: {self.vel_features}"
+            if _is_vmapped(pos):
+                # Graphs differ across the vmapped elements, so they can only be run densely, with fixed shapes
+                if not dense or self._dense_needs_graph:
+                    raise RuntimeError(
+                        f"from_pos graphs of {self.gnn_classes} cannot be run under torch.vmap "
+                        "(e.g., by the value estimator of on-policy algorithms), as these gnn classes "
+                        "have no dense forward. Use GraphConv or GATv2Conv layers."
+                    )
+            else:
+                dense = self._dense_radius_graph
+            batch_edge_index = (
+                _neighbours_to_edge_index(neighbours)
+                if not dense or self._dense_needs_graph
+                else None
             )
+        else:
+            batch_edge_index = None
 
-        if not self.input_has_agent_dim:
-            raise ValueError(
-                "The GNN module is not compatible with input that does not have the agent dimension,"
-                "such as the global state in centralised critics. Please choose another critic model"
-                "if your algorithm has a centralized critic and the task has a global state."
-                "If you are using the GNN in a centralized critic, it should be the first layer."
+        if dense:
+            edge_attr = _dense_edge_attr(pos=pos, vel=vel) if use_edge_attr else None
+            dense_kwargs = {}
+            if self._dense_needs_graph:
+                # Layers of the stack without a dense forward run on the batched graph
+                dense_kwargs["graph"] = _batch_from_dense_to_ptg(
+                    x=input,
+                    edge_index=self.edge_index,
+                    pos=pos if use_edge_attr else None,
+                    vel=vel if use_edge_attr else None,
+                    self_loops=self.self_loops,
+                    topology_cache=self._topology_cache,
+                    batch_edge_index=batch_edge_index,
+                    agent_mask=agent_mask,
+                )
+            if self.topology == "from_pos":
+                adjacency = _neighbours_to_adjacency(neighbours)
+            else:
+                adjacency = self._dense_adjacency
+            if agent_mask is not None:
+                # Padded agents neither send nor receive messages
+                adjacency = (
+                    adjacency & agent_mask.unsqueeze(-1) & agent_mask.unsqueeze(-2)
+                )
+
+            def run_gnn(gnn, targets=None):
+                return self._dense_forward(
+                    gnn,
+                    x=input,
+                    adjacency=adjacency,
+                    edge_attr=edge_attr,
+                    targets=targets,
+                    **dense_kwargs,
+                )
+
+        else:
+            graph = _batch_from_dense_to_ptg(
+                x=input,
+                edge_index=self.edge_index,
+                pos=pos,
+                vel=vel,
+                self_loops=self.self_loops,
+                edge_radius=self.edge_radius,
+                max_num_neighbors=self.max_num_neighbors,
+                topology_cache=self._topology_cache,
+                batch_edge_index=batch_edge_index,
+                agent_mask=agent_mask,
             )
+            forward_gnn_params = {
+                "x": graph.x,
+                "edge_index": graph.edge_index,
+            }
+            if use_edge_attr:
+                forward_gnn_params.update({"edge_attr": graph.edge_attr})
 
-        input_shape = None
-        for input_key, input_spec in self.input_spec.items(True, True):
-            if len(input_spec.shape) == 2:
-                if input_shape is None:
-                    input_shape = input_spec.shape[:-1]
-                else:
-                    if input_spec.shape[:-1] != input_shape:
-                        raise ValueError(
-                            f"GNN inputs should all have the same shape up to the last dimension, got {self.input_spec}"
-                        )
-            else:
-                raise ValueError(
-                    f"GNN input value {input_key} from {self.input_spec} has an invalid shape"
+            def run_gnn(gnn):
+                return gnn(**forward_gnn_params).view(
+                    *batch_size, self.n_agents, self.output_features
                 )
 
-        if input_shape[-1] != self.n_agents:
-            raise ValueError(
-                f"The second to last input spec dimension should be the number of agents, got {self.input_spec}"
+        if not self.share_params:
+            res = self._run_agent_gnns(
+                run_gnn,
+                device=input.device,
+                dense=dense,
+                agent_mask=agent_mask,
             )
-        if (
-            self.output_has_agent_dim
-            and self.output_leaf_spec.shape[-2] != self.n_agents
-        ):
-            raise ValueError(
-                "If the GNN output has the agent dimension,"
-                " the second to last spec dimension should be the number of agents"
+        else:
+            res = run_gnn(self.gnns[0])
+            if self.centralised:
+                res = _mean_over_agents(res, agent_mask)  # Mean pooling
+
+        if agent_mask is not None and self.output_has_agent_dim:
+            res = res.masked_fill(~agent_mask.unsqueeze(-1), 0)
+        tensordict.set(self.out_key, res)
+        return tensordict
+
+    def _run_agent_gnns(
+        self,
+        run_gnn: Callable,
+        device,
+        dense: bool,
+        agent_mask: Optional[Tensor] = None,
+    ) -> Tensor:
+        # When not centralised, agent i only needs the output of node i, so
+        # in the dense backend each agent gnn only computes the output of its node
+        def exec_gnn(gnn, agent):
+            if self.centralised:
+                # Mean pooling
+                return _mean_over_agents(run_gnn(gnn), agent_mask)
+            targets = agent.unsqueeze(0)
+            if dense:
+                return run_gnn(gnn, targets=targets).squeeze(-2)
+            return run_gnn(gnn).index_select(-2, targets).squeeze(-2)
+
+        return self.gnns.vmap(
+            exec_gnn,
+            torch.arange(self.n_agents, device=device),
+            in_dims=(0,),
+            out_dim=-2,
+        )
+
+
+class _GnnStack(nn.Module):
+    """Sequence of gnn layers run on the same graph.
+
+    The activation is applied between layers and, if ``residual``, the input of each layer is added to its output
+    when they have the same number of features. ``edge_attr_layers`` tells which layers take the edge attributes.
+    """
+
+    def __init__(
+        self,
+        layers: List[torch_geometric.nn.MessagePassing],
+        activation_class: Optional[Type[nn.Module]],
+        residual: bool,
+        edge_attr_layers: List[bool],
+    ):
+        super().__init__()
+        self.layers = nn.ModuleList(layers)
+        self.activations = nn.ModuleList(
+            [
+                activation_class() if activation_class is not None else nn.Identity()
+                for _ in range(len(layers) - 1)
+            ]
+        )
+        self.residual = residual
+        self.edge_attr_layers = edge_attr_layers
+
+    def _layer_output(self, layer: int, input: Tensor, output: Tensor) -> Tensor:
+        if layer < len(self.activations):
+            output = self.activations[layer](output)
+        if self.residual and input.shape[-1] == output.shape[-1]:
+            output = output + input
+        return output
+
+    def forward(
+        self, x: Tensor, edge_index: Tensor, edge_attr: Optional[Tensor] = None
+    ) -> Tensor:
+        for i, layer in enumerate(self.layers):
+            layer_kwargs = {}
+            if edge_attr is not None and self.edge_attr_layers[i]:
+                layer_kwargs["edge_attr"] = edge_attr
+            x = self._layer_output(
+                i, x, layer(x=x, edge_index=edge_index, **layer_kwargs)
             )
+        return x
 
-    def _forward(self, tensordict: TensorDictBase) -> TensorDictBase:
-        # Gather in_key
-        input = [
-            tensordict.get(in_key)
-            for in_key in self.in_keys
-            if _unravel_key_to_tuple(in_key)[-1]
-            not in (self.position_key, self.velocity_key)
-        ]
 
-        # Retrieve position
-        if self.position_key is not None:
-            if self._full_position_key is None:  # Run once to find full key
-                self._full_position_key = self._get_key_terminating_with(
-                    list(tensordict.keys(True, True)), self.position_key
-                )
-                pos = tensordict.get(self._full_position_key)
-                if pos.shape[-1] != self.pos_features - 1:
-                    raise ValueError(
-                        f"Position key in tensordict is {pos.shape[-1]}-dimensional, "
-                        f"while model was configured with pos_features={self.pos_features-1}"
-                    )
-            else:
-                pos = tensordict.get(self._full_position_key)
-            if not self.exclude_pos_from_node_features:
-                input.append(pos)
-        else:
-            pos = None
+def _check_graph_model(model: Model, model_name: str):
+    """Checks the graph configuration and the input and output specs of a graph model (a :class:`Gnn` or an :class:`~benchmarl.models.AttentionGnn`)."""
+    if model.topology not in TOPOLOGY_TYPES:
+        raise ValueError(
+            f"Got topology: {model.topology} but only available options are {TOPOLOGY_TYPES}"
+        )
+    if model.topology == "from_pos" and model.position_key is None:
+        raise ValueError("If topology is from_pos, position_key must be provided")
+    if model.topology == "from_pos" and (
+        model.edge_radius is None or model.edge_radius <= 0
+    ):
+        raise ValueError(
+            f"If topology is from_pos, edge_radius must be positive, got {model.edge_radius}"
+        )
+    if model.max_num_neighbors is not None and model.max_num_neighbors < 0:
+        raise ValueError(
+            f"max_num_neighbors must be non-negative, got {model.max_num_neighbors}"
+        )
+    if model.position_key is not None and model.exclude_pos_from_node_features is None:
+        raise ValueError(
+            "exclude_pos_from_node_features needs to be specified when position_key is provided"
+        )
+    if model.position_key is not None and model.pos_features <= 0:
+        raise ValueError(
+            f"Position key specified but pos_features is {model.pos_features}"
+        )
+    elif model.position_key is None and model.pos_features > 0:
+        raise ValueError(
+            f"If no position_key is given, pos_features needs to be 0, got: {model.pos_features}"
+        )
+    if model.velocity_key is not None and model.vel_features <= 0:
+        raise ValueError(
+            f"Velocity key specified but vel_features is {model.vel_features}"
+        )
+    elif model.velocity_key is None and model.vel_features > 0:
+        raise ValueError(
+            f"If no velocity_key is given, vel_features needs to be 0, got: {model.vel_features}"
+        )
 
-        # Retrieve velocity
-        if self.velocity_key is not None:
-            if self._full_velocity_key is None:  # Run once to find full key
-                self._full_velocity_key = self._get_key_terminating_with(
-                    list(tensordict.keys(True, True)), self.velocity_key
-                )
-                vel = tensordict.get(self._full_velocity_key)
-                if vel.shape[-1] != self.vel_features:
+    if not model.input_has_agent_dim:
+        raise ValueError(
+            f"The {model_name} module is not compatible with input that does not have the agent dimension,"
+            "such as the global state in centralised critics. Please choose another critic model"
+            "if your algorithm has a centralized critic and the task has a global state."
+            f"If you are using the {model_name} in a centralized critic, it should be the first layer."
+        )
+
+    input_shape = None
+    for input_key, input_spec in model.input_spec.items(True, True):
+        if len(input_spec.shape) == 2:
+            if input_shape is None:
+                input_shape = input_spec.shape[:-1]
+            else:
+                if input_spec.shape[:-1] != input_shape:
                     raise ValueError(
-                        f"Velocity key in tensordict is {vel.shape[-1]}-dimensional, "
-                        f"while model was configured with vel_features={self.vel_features}"
+                        f"{model_name} inputs should all have the same shape up to the last dimension, got {model.input_spec}"
                     )
-            else:
-                vel = tensordict.get(self._full_velocity_key)
-            input.append(vel)
         else:
-            vel = None
-
-        input = torch.cat(input, dim=-1)
-        batch_size = input.shape[:-2]
+            raise ValueError(
+                f"{model_name} input value {input_key} from {model.input_spec} has an invalid shape"
+            )
 
-        graph = _batch_from_dense_to_ptg(
-            x=input,
-            edge_index=self.edge_index,
-            pos=pos,
-            vel=vel,
-            self_loops=self.self_loops,
-            edge_radius=self.edge_radius,
+    if input_shape[-1] != model.n_agents:
+        raise ValueError(
+            f"The second to last input spec dimension should be the number of agents, got {model.input_spec}"
+        )
+    if (
+        model.output_has_agent_dim
+        and model.output_leaf_spec.shape[-2] != model.n_agents
+    ):
+        raise ValueError(
+            f"If the {model_name} output has the agent dimension,"
+            " the second to last spec dimension should be the number of agents"
         )
-        forward_gnn_params = {
-            "x": graph.x,
-            "edge_index": graph.edge_index,
-        }
-        if (
-            self.position_key is not None or self.velocity_key is not None
-        ) and self.gnn_supports_edge_attrs:
-            forward_gnn_params.update({"edge_attr": graph.edge_attr})
 
-        if not self.share_params:
-            if not self.centralised:
-                res = torch.stack(
-                    [
-                        gnn(**forward_gnn_params).view(
-                            *batch_size,
-                            self.n_agents,
-                            self.output_features,
-                        )[..., i, :]
-                        for i, gnn in enumerate(self.gnns)
-                    ],
-                    dim=-2,
-                )
-            else:
-                res = torch.stack(
-                    [
-                        gnn(**forward_gnn_params)
-                        .view(
-                            *batch_size,
-                            self.n_agents,
-                            self.output_features,
-                        )
-                        .mean(dim=-2)  # Mean pooling
-                        for i, gnn in enumerate(self.gnns)
-                    ],
-                    dim=-2,
-                )
 
+def _get_graph_inputs(
+    model: Model,
+    tensordict: TensorDictBase,
+    in_keys: Sequence[NestedKey],
+    model_name: str,
+) -> Tuple[List[Tensor], Optional[Tensor], Optional[Tensor]]:
+    """Gathers the node features, positions and velocities of a graph model from the tensordict.
+
+    The full position and velocity keys are looked up on the first call and stored in
+    ``model._full_position_key`` and ``model._full_velocity_key``.
+
+    Returns:
+        the list of node features (to concatenate), and the positions and velocities (``None`` if the model does not use them).
+
+    """
+    input = [
+        tensordict.get(in_key)
+        for in_key in in_keys
+        if _unravel_key_to_tuple(in_key)[-1]
+        not in (model.position_key, model.velocity_key)
+    ]
+
+    # Retrieve position
+    if model.position_key is not None:
+        if model._full_position_key is None:  # Run once to find full key
+            model._full_position_key = _get_key_terminating_with(
+                list(tensordict.keys(True, True)),
+                model.position_key,
+                agent_group=model.agent_group,
+                model_name=model_name,
+            )
+            pos = tensordict.get(model._full_position_key)
+            if pos.shape[-1] != model.pos_features - 1:
+                raise ValueError(
+                    f"Position key in tensordict is {pos.shape[-1]}-dimensional, "
+                    f"while model was configured with pos_features={model.pos_features-1}"
+                )
         else:
-            res = self.gnns[0](**forward_gnn_params).view(
-                *batch_size, self.n_agents, self.output_features
+            pos = tensordict.get(model._full_position_key)
+        if not model.exclude_pos_from_node_features:
+            input.append(pos)
+    else:
+        pos = None
+
+    # Retrieve velocity
+    if model.velocity_key is not None:
+        if model._full_velocity_key is None:  # Run once to find full key
+            model._full_velocity_key = _get_key_terminating_with(
+                list(tensordict.keys(True, True)),
+                model.velocity_key,
+                agent_group=model.agent_group,
+                model_name=model_name,
             )
-            if self.centralised:
-                res = res.mean(dim=-2)  # Mean pooling
+            vel = tensordict.get(model._full_velocity_key)
+            if vel.shape[-1] != model.vel_features:
+                raise ValueError(
+                    f"Velocity key in tensordict is {vel.shape[-1]}-dimensional, "
+                    f"while model was configured with vel_features={model.vel_features}"
+                )
+        else:
+            vel = tensordict.get(model._full_velocity_key)
+        input.append(vel)
+    else:
+        vel = None
 
-        tensordict.set(self.out_key, res)
-        return tensordict
+    return input, pos, vel
 
-    def _get_key_terminating_with(self, keys: List[NestedKey], key: str) -> NestedKey:
-        for k in keys:
-            k_tuple = _unravel_key_to_tuple(k)
-            if (
-                k_tuple[-1] == key
-                and self.agent_group in k_tuple
-                and not "next" == k_tuple[0]
-            ):
-                return k
-        raise KeyError(
-            f"Key terminating with {key} and containing {self.agent_group} not found in keys: {keys}. "
-            f"If you are using the GNN in a `SequenceModel` and want to use this key, it needs to be the first model."
-        )
+
+def _get_key_terminating_with(
+    keys: List[NestedKey], key: str, agent_group: str, model_name: str
+) -> NestedKey:
+    for k in keys:
+        k_tuple = _unravel_key_to_tuple(k)
+        if (
+            k_tuple[-1] == key
+            and agent_group in k_tuple
+            and not "next" == k_tuple[0]
+            and GRAPH_CACHE_KEY not in k_tuple
+            and STORED_GRAPH_KEY not in k_tuple
+        ):
+            return k
+    raise KeyError(
+        f"Key terminating with {key} and containing {agent_group} not found in keys: {keys}. "
+        f"If you are using the {model_name} in a `SequenceModel` and want to use this key, it needs to be the first model."
+    )
 
 
 def _get_edge_index(topology: str, self_loops: bool, n_agents: int, device: str):
@@ -408,6 +694,59 @@ def _get_edge_index(topology: str, self_loops: bool, n_agents: int, device: str)
     return edge_index
 
 
+def _batch_topology(
+    edge_index: Optional[Tensor], n_agents: int, batch_size: int, device
+) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+    """Returns the ``ptr``, ``batch`` and (if ``edge_index`` is given) batched ``edge_index`` of ``batch_size`` graphs."""
+    b = torch.arange(batch_size, device=device)
+    ptr = torch.arange(0, (batch_size + 1) * n_agents, n_agents, device=device)
+    batch = torch.repeat_interleave(b, n_agents)
+
+    if edge_index is not None:
+        edge_index = edge_index.to(device)
+        n_edges = edge_index.shape[1]
+        # Tensor of shape [batch_size * n_edges]
+        # in which edges corresponding to the same graph have the same index.
+        edge_batch = torch.repeat_interleave(b, n_edges)
+        # Edge index for the batched graphs of shape [2, n_edges * batch_size]
+        # we sum to each batch an offset of batch_num * n_agents to make sure that
+        # the adjacency matrices remain independent
+        batch_edge_index = edge_index.repeat(1, batch_size) + edge_batch * n_agents
+    else:
+        batch_edge_index = None
+    return ptr, batch, batch_edge_index
+
+
+class _BatchedTopologyCache:
+    """LRU cache of the batched topology tensors of a fixed graph, keyed by batch size and device.
+
+    Models are called with a few recurring batch sizes (collection, training minibatches, evaluation),
+    so the tensors returned by :func:`_batch_topology` can be reused across calls.
+    """
+
+    def __init__(self, edge_index: Optional[Tensor], n_agents: int, max_size: int):
+        self.edge_index = edge_index
+        self.n_agents = n_agents
+        self.max_size = max_size
+        self._cache = OrderedDict()
+
+    def get(self, batch_size: int, device) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+        key = (batch_size, torch.device(device))
+        topology = self._cache.get(key)
+        if topology is not None:
+            self._cache.move_to_end(key)
+            return topology
+        # Cached tensors are reused outside of inference mode, so they cannot be inference tensors
+        with torch.inference_mode(False):
+            topology = _batch_topology(
+                self.edge_index, self.n_agents, batch_size, device
+            )
+        self._cache[key] = topology
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return topology
+
+
 def _batch_from_dense_to_ptg(
     x: Tensor,
     edge_index: Optional[Tensor],
@@ -415,50 +754,580 @@ def _batch_from_dense_to_ptg(
     pos: Tensor = None,
     vel: Tensor = None,
     edge_radius: Optional[float] = None,
+    topology_cache: Optional[_BatchedTopologyCache] = None,
+    max_num_neighbors: Optional[int] = None,
+    batch_edge_index: Optional[Tensor] = None,
+    agent_mask: Optional[Tensor] = None,
 ) -> torch_geometric.data.Batch:
     batch_size = prod(x.shape[:-2])
     n_agents = x.shape[-2]
     x = x.view(-1, x.shape[-1])
+    if edge_index is None and batch_edge_index is None:
+        if pos is None:
+            raise RuntimeError("from_pos topology needs positions as input")
+        batch_edge_index = _radius_graph(
+            pos.reshape(batch_size, n_agents, pos.shape[-1]),
+            r=edge_radius,
+            loop=self_loops,
+            max_num_neighbors=max_num_neighbors,
+        )
     if pos is not None:
         pos = pos.view(-1, pos.shape[-1])
     if vel is not None:
         vel = vel.view(-1, vel.shape[-1])
 
-    b = torch.arange(batch_size, device=x.device)
+    if topology_cache is not None:
+        ptr, batch, cached_edge_index = topology_cache.get(batch_size, x.device)
+    else:
+        ptr, batch, cached_edge_index = _batch_topology(
+            edge_index, n_agents, batch_size, x.device
+        )
+    if edge_index is not None:
+        batch_edge_index = cached_edge_index
 
     graphs = torch_geometric.data.Batch()
-    graphs.ptr = torch.arange(0, (batch_size + 1) * n_agents, n_agents)
-    graphs.batch = torch.repeat_interleave(b, n_agents)
+    graphs.ptr = ptr
+    graphs.batch = batch
     graphs.x = x
     graphs.pos = pos
     graphs.vel = vel
     graphs.edge_attr = None
+    graphs.edge_index = batch_edge_index
 
-    if edge_index is not None:
-        n_edges = edge_index.shape[1]
-        # Tensor of shape [batch_size * n_edges]
-        # in which edges corresponding to the same graph have the same index.
-        batch = torch.repeat_interleave(b, n_edges)
-        # Edge index for the batched graphs of shape [2, n_edges * batch_size]
-        # we sum to each batch an offset of batch_num * n_agents to make sure that
-        # the adjacency matrices remain independent
-        batch_edge_index = edge_index.repeat(1, batch_size) + batch * n_agents
-        graphs.edge_index = batch_edge_index
+    graphs = graphs.to(x.device)
+    if agent_mask is not None:
+        # Padded agents neither send nor receive messages
+        node_mask = agent_mask.reshape(-1)
+        row, col = graphs.edge_index
+        graphs.edge_index = graphs.edge_index[:, node_mask[row] & node_mask[col]]
+    if pos is not None or vel is not None:
+        # Relative positions and velocities are gathered at once
+        node_features = torch.cat([t for t in (pos, vel) if t is not None], dim=-1)
+        row, col = graphs.edge_index
+        graphs.edge_attr = _relative_edge_attr(
+            node_features[row] - node_features[col],
+            pos_features=pos.shape[-1] if pos is not None else 0,
+        )
+
+    return graphs
+
+
+def _relative_edge_attr(relative_features: Tensor, pos_features: int) -> Tensor:
+    """Computes the edge features from the relative positions and velocities of the edges.
+
+    ``relative_features`` contains the position (first ``pos_features``) and velocity of the source node minus the ones
+    of the target node. The edge features are, in order, the relative position, the distance and the relative velocity.
+    """
+    edge_attr = relative_features.new_empty(
+        *relative_features.shape[:-1],
+        relative_features.shape[-1] + (1 if pos_features > 0 else 0),
+    )
+    if pos_features > 0:
+        rel_pos = relative_features[..., :pos_features]
+        edge_attr[..., :pos_features] = rel_pos
+        edge_attr[..., pos_features] = torch.linalg.vector_norm(rel_pos, dim=-1)
+        edge_attr[..., pos_features + 1 :] = relative_features[..., pos_features:]
     else:
-        if pos is None:
-            raise RuntimeError("from_pos topology needs positions as input")
-        graphs.edge_index = torch_geometric.nn.pool.radius_graph(
-            graphs.pos, batch=graphs.batch, r=edge_radius, loop=self_loops
+        edge_attr[...] = relative_features
+    return edge_attr
+
+
+# Number of agents from which radius graphs are built with a cell list instead of pairwise distances
+_CELL_LIST_MIN_AGENTS = 256
+
+
+def _radius_graph(
+    pos: Tensor, r: float, loop: bool, max_num_neighbors: Optional[int] = None
+) -> Tensor:
+    """Builds the batched radius graph of agents with positions ``pos`` of shape ``[batch_size, n_agents, pos_features]``.
+
+    Agents at a distance of at most ``r`` are connected. If ``max_num_neighbors`` is given,
+    only the nearest ``max_num_neighbors`` neighbours of each agent are kept.
+    Graphs with few agents are built from all pairwise distances, larger ones with a cell list.
+
+    Returns the ``edge_index`` of the batched graph (where agent ``i`` of batch element ``b`` is node ``b * n_agents + i``),
+    with edges from neighbours to agents, sorted by target and then source node.
+    """
+    if pos.shape[-2] < _CELL_LIST_MIN_AGENTS:
+        return _pairwise_radius_graph(pos, r, loop, max_num_neighbors)
+    return _cell_list_radius_graph(pos, r, loop, max_num_neighbors)
+
+
+def _radius_adjacency(
+    pos: Tensor, r: float, loop: bool, max_num_neighbors: Optional[int]
+) -> Tensor:
+    """Dense radius graph of agents with positions ``pos`` of shape ``[..., n_agents, pos_features]``.
+
+    Returns the boolean adjacency of shape ``[..., n_agents, n_agents]``,
+    where element ``[..., i, j]`` is True if agent ``j`` is a neighbour of agent ``i``.
+    """
+    n_agents = pos.shape[-2]
+    # Element [..., i, j] is the distance from agent j to agent i
+    dist = torch.linalg.vector_norm(pos.unsqueeze(-3) - pos.unsqueeze(-2), dim=-1)
+    adjacency = dist <= r
+    if not loop:
+        adjacency &= ~torch.eye(n_agents, dtype=torch.bool, device=pos.device)
+    if max_num_neighbors is not None and max_num_neighbors < n_agents:
+        nearest = dist.masked_fill(~adjacency, float("inf")).topk(
+            max_num_neighbors, dim=-1, largest=False
         )
+        adjacency &= torch.zeros_like(adjacency).scatter(-1, nearest.indices, True)
+    return adjacency
 
-    graphs = graphs.to(x.device)
-    if pos is not None:
-        graphs = torch_geometric.transforms.Cartesian(norm=False)(graphs)
-        graphs = torch_geometric.transforms.Distance(norm=False)(graphs)
-    if vel is not None:
-        graphs = _RelVel()(graphs)
 
-    return graphs
+def _pairwise_radius_graph(
+    pos: Tensor, r: float, loop: bool, max_num_neighbors: Optional[int]
+) -> Tensor:
+    n_agents = pos.shape[-2]
+    b, i, j = _radius_adjacency(pos, r, loop, max_num_neighbors).nonzero(as_tuple=True)
+    return torch.stack([b * n_agents + j, b * n_agents + i])
+
+
+def _radius_graph_key(
+    agent_group: str,
+    position_key: str,
+    edge_radius: float,
+    self_loops: bool,
+    max_num_neighbors: Optional[int],
+    store_graph: bool = False,
+) -> NestedKey:
+    """Key under which the radius graph with the given configuration is stored in the tensordict."""
+    return (
+        agent_group,
+        STORED_GRAPH_KEY if store_graph else GRAPH_CACHE_KEY,
+        f"{position_key}_radius_{edge_radius}_loops_{self_loops}_max_neighbors_{max_num_neighbors}",
+    )
+
+
+def _get_radius_neighbours(
+    tensordict: TensorDictBase,
+    key: NestedKey,
+    pos: Tensor,
+    edge_radius: float,
+    self_loops: bool,
+    max_num_neighbors: Optional[int],
+    stored_key: Optional[NestedKey] = None,
+) -> Tensor:
+    """Returns the neighbours in the radius graph of the agent positions ``pos`` of shape ``[..., n_agents, pos_features]``.
+
+    The graph is cached in ``tensordict`` under the private ``key`` (see :func:`_radius_graph_key`), with the
+    ``"neighbours"`` and the ``"pos"`` they were built from. It is reused only for the same ``pos`` tensor,
+    not modified in place since, which is checked without synchronising with the device.
+    If ``stored_key`` is given, the graph is also stored under it. As private keys are not kept in the collected data,
+    a graph found under ``stored_key`` without a cached one was built from the positions of the collected data and is reused.
+    See :func:`_edge_index_to_neighbours` for the format of the neighbours.
+    """
+    # Inference tensors do not track in place modifications, so their graphs are not reused
+    pos_version = pos._version if not pos.is_inference() else None
+    graph = tensordict.get(key, None)
+    if graph is not None:
+        if (
+            graph.get("pos") is pos
+            and pos_version is not None
+            and graph.get_non_tensor("pos_version", None) == pos_version
+        ):
+            return graph.get("neighbours")
+        neighbours = None
+    elif stored_key is not None and stored_key in tensordict.keys(True):
+        neighbours = tensordict.get(stored_key).get("neighbours")
+    else:
+        neighbours = None
+
+    if neighbours is None:
+        neighbours = _radius_neighbours(
+            pos, r=edge_radius, loop=self_loops, max_num_neighbors=max_num_neighbors
+        )
+    graph = TensorDict(
+        {"neighbours": neighbours, "pos": pos},
+        batch_size=pos.shape[:-1],
+        device=pos.device,
+    )
+    if stored_key is not None:
+        tensordict.set(stored_key, graph.copy())
+    graph.set_non_tensor("pos_version", pos_version)
+    tensordict.set(key, graph)
+    return neighbours
+
+
+def _radius_neighbours(
+    pos: Tensor, r: float, loop: bool, max_num_neighbors: Optional[int]
+) -> Tensor:
+    """Neighbours of the radius graph of agents with positions ``pos`` of shape ``[..., n_agents, pos_features]``.
+
+    Graphs with few agents (or under ``torch.vmap``) are built from the dense adjacency, which keeps fixed shapes.
+    See :func:`_edge_index_to_neighbours` for the format of the neighbours.
+    """
+    batch_size, (n_agents, pos_features) = pos.shape[:-2], pos.shape[-2:]
+    if n_agents < _CELL_LIST_MIN_AGENTS or _is_vmapped(pos):
+        return _adjacency_to_neighbours(
+            _radius_adjacency(pos, r, loop, max_num_neighbors),
+            max_num_neighbors=max_num_neighbors,
+        )
+    edge_index = _cell_list_radius_graph(
+        pos.reshape(-1, n_agents, pos_features), r, loop, max_num_neighbors
+    )
+    return _edge_index_to_neighbours(
+        edge_index,
+        batch_size=prod(batch_size),
+        n_agents=n_agents,
+        max_num_neighbors=max_num_neighbors,
+    ).view(*batch_size, n_agents, -1)
+
+
+def _is_vmapped(tensor: Tensor) -> bool:
+    """Whether ``tensor`` is batched by ``torch.vmap``, where data-dependent shapes are not supported."""
+    return torch._C._functorch.is_batchedtensor(tensor)
+
+
+def _adjacency_to_neighbours(
+    adjacency: Tensor, max_num_neighbors: Optional[int]
+) -> Tensor:
+    """Converts the boolean adjacency of :func:`_radius_adjacency` to the neighbours of :func:`_edge_index_to_neighbours`."""
+    n_agents = adjacency.shape[-1]
+    max_neighbours = n_agents
+    if max_num_neighbors is not None:
+        max_neighbours = min(max_neighbours, max_num_neighbors)
+    # The stable sort puts the neighbours first, in increasing order
+    index = (~adjacency).to(torch.uint8).argsort(dim=-1, stable=True)
+    index = index[..., :max_neighbours]
+    return index.to(torch.int32).masked_fill(~adjacency.gather(-1, index), -1)
+
+
+def _edge_index_to_neighbours(
+    edge_index: Tensor,
+    batch_size: int,
+    n_agents: int,
+    max_num_neighbors: Optional[int],
+) -> Tensor:
+    """Converts the ``edge_index`` of a batched graph sorted by target node to neighbour lists.
+
+    Returns a tensor of shape ``[batch_size, n_agents, max_neighbours]``, where row ``[b, i]`` contains the indices
+    of the neighbours of agent ``i`` in graph ``b`` in the order of ``edge_index``, padded with ``-1``.
+    """
+    max_neighbours = n_agents
+    if max_num_neighbors is not None:
+        max_neighbours = min(max_neighbours, max_num_neighbors)
+    sources, targets = edge_index
+    degree = torch.bincount(targets, minlength=batch_size * n_agents)
+    first_edge = degree.cumsum(0) - degree
+    slots = torch.arange(targets.shape[0], device=targets.device) - first_edge[targets]
+    neighbours = torch.full(
+        (batch_size * n_agents, max_neighbours),
+        -1,
+        dtype=torch.int32,
+        device=edge_index.device,
+    )
+    neighbours[targets, slots] = (sources % n_agents).to(torch.int32)
+    return neighbours.view(batch_size, n_agents, max_neighbours)
+
+
+def _neighbours_to_edge_index(neighbours: Tensor) -> Tensor:
+    """Inverse of :func:`_edge_index_to_neighbours`, returns the ``edge_index`` of the batched graph."""
+    n_agents, max_neighbours = neighbours.shape[-2:]
+    neighbours = neighbours.reshape(-1, max_neighbours)
+    targets, slots = (neighbours >= 0).nonzero(as_tuple=True)
+    sources = targets - targets % n_agents + neighbours[targets, slots].long()
+    return torch.stack([sources, targets])
+
+
+def _neighbours_to_adjacency(neighbours: Tensor) -> Tensor:
+    """Converts the neighbours of :func:`_edge_index_to_neighbours` to a boolean adjacency of shape ``[..., n_agents, n_agents]``."""
+    n_agents = neighbours.shape[-2]
+    # Padding entries are scattered to an extra column which is then removed
+    index = neighbours.long().masked_fill(neighbours < 0, n_agents)
+    adjacency = torch.zeros(
+        *neighbours.shape[:-1], n_agents + 1, dtype=torch.bool, device=neighbours.device
+    )
+    return adjacency.scatter(-1, index, True)[..., :n_agents]
+
+
+def _cell_list_radius_graph(
+    pos: Tensor, r: float, loop: bool, max_num_neighbors: Optional[int]
+) -> Tensor:
+    batch_size, n_agents, n_dims = pos.shape
+    n_nodes = batch_size * n_agents
+    device = pos.device
+    # Each agent is assigned to a cell of side r, so its neighbours are in the adjacent cells
+    cells = torch.floor((pos - pos.amin(dim=-2, keepdim=True)) / r).long()
+    cells = cells.view(n_nodes, n_dims)
+    grid_size = cells.amax(dim=0) + 1
+    strides = torch.cat(
+        [grid_size.flip(0).cumprod(0).flip(0)[1:], grid_size.new_ones(1)]
+    )
+    batch_offset = (
+        torch.arange(batch_size, device=device).repeat_interleave(n_agents)
+        * grid_size.prod()
+    )
+    sorted_keys, order = (batch_offset + (cells * strides).sum(-1)).sort()
+
+    nodes = torch.arange(n_nodes, device=device)
+    sources, targets = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=n_dims):
+        neighbour_cells = cells + torch.tensor(offset, device=device)
+        keys = batch_offset + (neighbour_cells * strides).sum(-1)
+        start = torch.searchsorted(sorted_keys, keys)
+        counts = torch.searchsorted(sorted_keys, keys, right=True) - start
+        counts = counts.masked_fill(
+            ((neighbour_cells < 0) | (neighbour_cells >= grid_size)).any(-1), 0
+        )
+        # Index of each candidate neighbour in the range of agents of its cell
+        range_index = torch.arange(
+            counts.sum(), device=device
+        ) - torch.repeat_interleave(counts.cumsum(0) - counts, counts)
+        sources.append(order[torch.repeat_interleave(start, counts) + range_index])
+        targets.append(torch.repeat_interleave(nodes, counts))
+    source, target = torch.cat(sources), torch.cat(targets)
+
+    pos = pos.view(n_nodes, n_dims)
+    dist = torch.linalg.vector_norm(pos[source] - pos[target], dim=-1)
+    keep = dist <= r
+    if not loop:
+        keep &= source != target
+    source, target, dist = source[keep], target[keep], dist[keep]
+
+    if max_num_neighbors is not None:
+        # Sort by target and then distance, and keep the first max_num_neighbors edges of each target
+        sort_index = dist.argsort(stable=True)
+        sort_index = sort_index[target[sort_index].argsort(stable=True)]
+        source, target = source[sort_index], target[sort_index]
+        counts = torch.bincount(target, minlength=n_nodes)
+        rank = (
+            torch.arange(len(target), device=device)
+            - (counts.cumsum(0) - counts)[target]
+        )
+        keep = rank < max_num_neighbors
+        source, target = source[keep], target[keep]
+
+    sort_index = (target * n_nodes + source).argsort()
+    return torch.stack([source[sort_index], target[sort_index]])
+
+
+def _get_dense_adjacency(edge_index: Tensor, n_agents: int) -> Tensor:
+    """Returns the boolean adjacency matrix of shape ``[n_agents, n_agents]``, where element ``[i, j]`` is True if node ``j`` sends messages to node ``i``."""
+    adjacency = torch.zeros(
+        n_agents, n_agents, dtype=torch.bool, device=edge_index.device
+    )
+    adjacency[edge_index[1], edge_index[0]] = True
+    return adjacency
+
+
+def _dense_edge_attr(pos: Optional[Tensor], vel: Optional[Tensor]) -> Tensor:
+    """Dense version of the edge features computed in :func:`_batch_from_dense_to_ptg`.
+
+    Returns a tensor of shape ``[..., n_agents, n_agents, edge_features]``,
+    where element ``[..., i, j, :]`` contains the features of the edge from ``j`` to ``i``.
+    """
+    node_features = torch.cat([t for t in (pos, vel) if t is not None], dim=-1)
+    return _relative_edge_attr(
+        node_features.unsqueeze(-3) - node_features.unsqueeze(-2),
+        pos_features=pos.shape[-1] if pos is not None else 0,
+    )
+
+
+def _dense_aggregate(x: Tensor, adjacency: Tensor, aggr: str) -> Tensor:
+    """Aggregates the neighbour features ``x`` of shape ``[..., n_agents, features]`` as in a PyG ``MessagePassing``.
+
+    ``adjacency`` has shape ``[..., n_targets, n_agents]`` and the result has shape ``[..., n_targets, features]``.
+    """
+    if aggr in ("add", "sum", "mean"):
+        out = adjacency.to(x.dtype) @ x
+        if aggr == "mean":
+            out = out / adjacency.sum(dim=-1, keepdim=True).clamp(min=1)
+        return out
+    fill = float("-inf") if aggr == "max" else float("inf")
+    neighbours = x.unsqueeze(-3).masked_fill(~adjacency.unsqueeze(-1), fill)
+    out = neighbours.amax(dim=-2) if aggr == "max" else neighbours.amin(dim=-2)
+    # Nodes without neighbours get 0, like in PyG
+    return out.masked_fill(~adjacency.any(dim=-1, keepdim=True), 0)
+
+
+def _dense_targets(
+    x: Tensor,
+    adjacency: Tensor,
+    edge_attr: Optional[Tensor],
+    targets: Optional[Tensor],
+) -> Tuple[Tensor, Tensor, Optional[Tensor], Tensor]:
+    """Restricts the dense graph inputs to the ``targets`` nodes.
+
+    Returns the target node features, the adjacency and edge attribute rows of the targets
+    and the mask of the self loops of the targets.
+    """
+    n_agents = x.shape[-2]
+    if targets is None:
+        loops = torch.eye(n_agents, dtype=torch.bool, device=x.device)
+        return x, adjacency, edge_attr, loops
+    loops = targets.unsqueeze(-1) == torch.arange(n_agents, device=x.device)
+    if edge_attr is not None:
+        edge_attr = edge_attr.index_select(-3, targets)
+    return (
+        x.index_select(-2, targets),
+        adjacency.index_select(-2, targets),
+        edge_attr,
+        loops,
+    )
+
+
+def _dense_graph_conv(
+    conv: torch_geometric.nn.GraphConv,
+    x: Tensor,
+    adjacency: Tensor,
+    edge_attr: Optional[Tensor] = None,
+    targets: Optional[Tensor] = None,
+) -> Tensor:
+    """Dense forward of a :class:`torch_geometric.nn.GraphConv` on ``x`` of shape ``[..., n_agents, features]``.
+
+    If ``targets`` is given, only the output of these nodes is computed.
+    """
+    x_target, adjacency, _, _ = _dense_targets(x, adjacency, None, targets)
+    out = conv.lin_rel(_dense_aggregate(x, adjacency, aggr=conv.aggr))
+    return out + conv.lin_root(x_target)
+
+
+def _dense_gatv2_conv(
+    conv: torch_geometric.nn.GATv2Conv,
+    x: Tensor,
+    adjacency: Tensor,
+    edge_attr: Optional[Tensor] = None,
+    targets: Optional[Tensor] = None,
+) -> Tensor:
+    """Dense forward of a :class:`torch_geometric.nn.GATv2Conv` on ``x`` of shape ``[..., n_agents, features]``.
+
+    Attention is computed for all agent pairs and masked with the ``adjacency`` matrix.
+    If ``targets`` is given, only the output of these nodes is computed.
+    """
+    x_target, adjacency, edge_attr, loops = _dense_targets(
+        x, adjacency, edge_attr, targets
+    )
+    H, C = conv.heads, conv.out_channels
+    x_l = conv.lin_l(x).unflatten(-1, (H, C))
+    lin_r = conv.lin_l if conv.share_weights else conv.lin_r
+    x_r = lin_r(x_target).unflatten(-1, (H, C))
+
+    if conv.add_self_loops:
+        if edge_attr is not None:
+            # Self loops get the attributes given by fill_value, like in torch_geometric.utils.add_self_loops
+            neighbours = (adjacency & ~loops).to(edge_attr.dtype).unsqueeze(-1)
+            if isinstance(conv.fill_value, str):
+                loop_attr = (edge_attr * neighbours).sum(dim=-2)
+                if conv.fill_value == "mean":
+                    loop_attr = loop_attr / neighbours.sum(dim=-2).clamp(min=1)
+            else:
+                loop_attr = torch.as_tensor(
+                    conv.fill_value, dtype=edge_attr.dtype, device=edge_attr.device
+                ).expand_as(edge_attr[..., 0, :])
+            edge_attr = torch.where(
+                loops.unsqueeze(-1), loop_attr.unsqueeze(-2), edge_attr
+            )
+        adjacency = adjacency | loops
+
+    # Element [..., i, j, h, c] is the message from j to i
+    e = x_r.unsqueeze(-3) + x_l.unsqueeze(-4)
+    if edge_attr is not None:
+        e = e + conv.lin_edge(edge_attr).unflatten(-1, (H, C))
+    e = torch.nn.functional.leaky_relu(e, conv.negative_slope)
+    alpha = (e * conv.att).sum(dim=-1)
+    mask = adjacency.unsqueeze(-1)
+    alpha = torch.softmax(alpha.masked_fill(~mask, float("-inf")), dim=-2)
+    alpha = alpha.masked_fill(~mask, 0)
+    alpha = torch.nn.functional.dropout(alpha, p=conv.dropout, training=conv.training)
+    out = torch.einsum("...ijh,...jhc->...ihc", alpha, x_l)
+
+    if conv.concat:
+        out = out.flatten(-2)
+    else:
+        out = out.mean(dim=-2)
+    if conv.res is not None:
+        out = out + conv.res(x_target)
+    if conv.bias is not None:
+        out = out + conv.bias
+    return out
+
+
+def _dense_gnn_stack(
+    stack: _GnnStack,
+    x: Tensor,
+    adjacency: Tensor,
+    edge_attr: Optional[Tensor] = None,
+    targets: Optional[Tensor] = None,
+    graph: Optional[torch_geometric.data.Batch] = None,
+) -> Tensor:
+    """Dense forward of a :class:`_GnnStack` on ``x`` of shape ``[..., n_agents, features]``.
+
+    Layers without a dense forward are run on the batched PyG ``graph`` with the same topology, which is then required.
+    If ``targets`` is given, only the output of these nodes is computed in the last layer.
+    """
+    for i, layer in enumerate(stack.layers):
+        layer_targets = targets if i == len(stack.layers) - 1 else None
+        dense_forward = _get_dense_forward(layer)
+        if dense_forward is not None:
+            output = dense_forward(
+                layer,
+                x=x,
+                adjacency=adjacency,
+                edge_attr=edge_attr if stack.edge_attr_layers[i] else None,
+                targets=layer_targets,
+            )
+        else:
+            layer_kwargs = {}
+            if stack.edge_attr_layers[i] and graph.edge_attr is not None:
+                layer_kwargs["edge_attr"] = graph.edge_attr
+            output = layer(
+                x=x.reshape(-1, x.shape[-1]),
+                edge_index=graph.edge_index,
+                **layer_kwargs,
+            )
+            output = output.view(*x.shape[:-1], output.shape[-1])
+            if layer_targets is not None:
+                output = output.index_select(-2, layer_targets)
+        if layer_targets is not None:
+            x = x.index_select(-2, layer_targets)
+        x = stack._layer_output(i, x, output)
+    return x
+
+
+def _get_dense_forward(
+    gnn: Union[torch_geometric.nn.MessagePassing, _GnnStack]
+) -> Optional[Callable]:
+    """Returns the dense forward function equivalent to ``gnn``, or ``None`` if ``gnn`` is not supported."""
+    if isinstance(gnn, _GnnStack):
+        # Stacks are run densely when at least one of their layers can be
+        if any(_get_dense_forward(layer) is not None for layer in gnn.layers):
+            return _dense_gnn_stack
+    elif type(gnn) is torch_geometric.nn.GraphConv:
+        if gnn.aggr in ("add", "sum", "mean", "max", "min"):
+            return _dense_graph_conv
+    elif type(gnn) is torch_geometric.nn.GATv2Conv:
+        if not isinstance(gnn.fill_value, str) or gnn.fill_value in ("add", "mean"):
+            return _dense_gatv2_conv
+    return None
+
+
+# Fraction of the possible edges of a radius graph from which the dense forward is faster than the batched graph,
+# see scripts/benchmark_gnn_dense.py. Graph convolutions are faster at any density, while the dense
+# attention computes the messages of all pairs of agents. As the number of edges of radius graphs changes at every step,
+# they are run densely when their maximum number of edges (bounded by ``max_num_neighbors``) reaches this fraction
+_DENSE_MIN_EDGE_DENSITY = {_dense_graph_conv: 0.0, _dense_gatv2_conv: 0.75}
+
+
+def _max_num_neighbours(
+    n_agents: int, self_loops: bool, max_num_neighbors: Optional[int]
+) -> int:
+    """Maximum number of neighbours of an agent in a radius graph of ``n_agents`` agents."""
+    max_neighbours = n_agents if self_loops else n_agents - 1
+    if max_num_neighbors is not None:
+        max_neighbours = min(max_neighbours, max_num_neighbors)
+    return max_neighbours
+
+
+def _dense_min_edge_density(gnn: Union[torch_geometric.nn.MessagePassing, _GnnStack]):
+    """Returns the edge density from which ``gnn`` is run on radius graphs with its dense forward."""
+    if isinstance(gnn, _GnnStack):
+        return max(
+            _DENSE_MIN_EDGE_DENSITY[_get_dense_forward(layer)]
+            for layer in gnn.layers
+            if _get_dense_forward(layer) is not None
+        )
+    return _DENSE_MIN_EDGE_DENSITY[_get_dense_forward(gnn)]
 
 
 @dataclass
@@ -468,8 +1337,11 @@ class GnnConfig(ModelConfig):
     topology: str = MISSING
     self_loops: bool = MISSING
 
-    gnn_class: Type[torch_geometric.nn.MessagePassing] = MISSING
-    gnn_kwargs: Optional[dict] = None
+    gnn_class: Union[
+        Type[torch_geometric.nn.MessagePassing],
+        Sequence[Type[torch_geometric.nn.MessagePassing]],
+    ] = MISSING
+    gnn_kwargs: Optional[Union[dict, Sequence[dict]]] = None
 
     position_key: Optional[str] = None
     pos_features: Optional[int] = 0
@@ -477,7 +1349,41 @@ class GnnConfig(ModelConfig):
     vel_features: Optional[int] = 0
     exclude_pos_from_node_features: Optional[bool] = None
     edge_radius: Optional[float] = None
+    max_num_neighbors: Optional[int] = None
+
+    num_cells: Optional[Sequence[int]] = None
+    activation_class: Optional[Type[nn.Module]] = None
+    residual: bool = False
+    store_graph: bool = False
 
     @staticmethod
     def associated_class():
         return Gnn
+
+    def _get_graph_spec(self, group: str, n_agents: int) -> Composite:
+        spec = Composite(shape=(n_agents,))
+        if self.store_graph and self.topology == "from_pos":
+            max_neighbours = n_agents
+            if self.max_num_neighbors is not None:
+                max_neighbours = min(max_neighbours, self.max_num_neighbors)
+            # The private graph is also in the spec: in collection it is always present,
+            # so the stored graphs (which are from the previous step) are not reused
+            for store_graph in (True, False):
+                key = _radius_graph_key(
+                    group,
+                    position_key=self.position_key,
+                    edge_radius=self.edge_radius,
+                    self_loops=self.self_loops,
+                    max_num_neighbors=self.max_num_neighbors,
+                    store_graph=store_graph,
+                )[1:]
+                spec[key] = Composite(
+                    {
+                        "neighbours": Unbounded(
+                            shape=(n_agents, max_neighbours), dtype=torch.int32
+                        ),
+                        "pos": Unbounded(shape=(n_agents, self.pos_features)),
+                    },
+                    shape=(n_agents,),
+                )
+        return spec
@@ -7,18 +7,18 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, MISSING
-from typing import Optional, Sequence, Type
+from typing import Callable, List, Optional, Sequence, Tuple, Type
 
 import torch
 import torch.nn.functional as F
 from tensordict import TensorDict, TensorDictBase
 from tensordict.utils import expand_as_right, unravel_key_list
-from torch import nn
+from torch import nn, Tensor
 from torchrl.data.tensor_specs import Composite, Unbounded
 
 from torchrl.modules import GRUCell, MLP, MultiAgentMLP
 
-from benchmarl.models.common import Model, ModelConfig
+from benchmarl.models.common import _stored_state_name, Model, ModelConfig
 from benchmarl.utils import DEVICE_TYPING
 
 
@@ -32,6 +32,7 @@ class GRU(torch.nn.Module):
         dropout: float,
         bias: bool,
         time_dim: int = -2,
+        fused: bool = False,
     ):
         super().__init__()
         self.input_size = input_size
@@ -41,6 +42,7 @@ class GRU(torch.nn.Module):
         self.n_layers = n_layers
         self.dropout = dropout
         self.bias = bias
+        self.fused = fused
 
         self.grus = torch.nn.ModuleList(
             [
@@ -59,7 +61,11 @@ class GRU(torch.nn.Module):
         input,
         is_init,
         h,
+        boundaries: Optional[List[int]] = None,
     ):
+        if self.fused:
+            return self._fused_forward(input, is_init, h, boundaries)
+
         hs = []
         h = list(h.unbind(dim=-2))
         for in_t, init_t in zip(
@@ -81,8 +87,93 @@ class GRU(torch.nn.Module):
 
         return output, h_n
 
+    def _fused_forward(self, input, is_init, h, boundaries):
+        # Same weight layout as torch.nn.GRU
+        weights = [
+            weight
+            for gru in self.grus
+            for weight in (
+                (gru.weight_ih, gru.weight_hh, gru.bias_ih, gru.bias_hh)
+                if self.bias
+                else (gru.weight_ih, gru.weight_hh)
+            )
+        ]
+
+        def run_gru(input, hx):
+            output, h = torch.gru(
+                input,
+                hx[0],
+                weights,
+                self.bias,
+                self.n_layers,
+                self.dropout,
+                self.training,
+                False,  # bidirectional
+                True,  # batch_first
+            )
+            return output, (h,)
+
+        output, (h_n,) = _run_segments(
+            run_gru,
+            input,
+            is_init,
+            (h.transpose(0, 1).contiguous(),),
+            boundaries=boundaries,
+        )
+        return output, h_n.transpose(0, 1)
+
+
+def _run_segments(
+    rnn: Callable[[Tensor, Tuple[Tensor, ...]], Tuple[Tensor, Tuple[Tensor, ...]]],
+    input: Tensor,
+    is_init: Tensor,
+    hx: Tuple[Tensor, ...],
+    boundaries: Optional[List[int]] = None,
+) -> Tuple[Tensor, Tuple[Tensor, ...]]:
+    """Runs a fused multi-layer ``rnn(input, hx) -> (output, hx)`` on sequences with resets.
+
+    The time dimension is split at every step where ``is_init`` is set for any of the sequences,
+    so that each ``rnn`` call runs through a segment of steps without resets.
+    The states of the sequences that are reset at the start of a segment are set to 0.
+    This gives the same results as stepping through time and resetting the states when ``is_init`` is set.
 
-def get_net(input_size, hidden_size, n_layers, bias, device, dropout, compile):
+    Args:
+        rnn (callable): the fused rnn, taking batch first inputs of shape ``[batch, seq, F]``
+            and states of shape ``[n_layers, batch, H]``
+        input (Tensor): the input of shape ``[batch, seq, F]``
+        is_init (Tensor): the resets of shape ``[batch, seq, 1]``
+        hx (tuple of Tensor): the initial states of shape ``[n_layers, batch, H]``
+        boundaries (list of int, optional): the segment boundaries from :func:`_segment_boundaries`.
+            If ``None``, they are computed from ``is_init``.
+
+    Returns: the output of shape ``[batch, seq, H]`` and the final states
+
+    """
+    if boundaries is None:
+        boundaries = _segment_boundaries(is_init)
+    is_init = is_init[..., 0]
+    outputs = []
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        hx = tuple(torch.where(is_init[None, :, start, None], 0, h) for h in hx)
+        output, hx = rnn(input[:, start:end], hx)
+        outputs.append(output)
+    return torch.cat(outputs, dim=1), hx
+
+
+def _segment_boundaries(is_init: Tensor) -> List[int]:
+    """The boundaries of the segments without resets of sequences of shape ``[batch, seq, ...]``.
+
+    Returns ``[0, *steps, seq]``, where ``steps`` are the steps at which ``is_init`` is set in any of the sequences
+    (the first step excluded). Reading them transfers the resets to the host, which waits for the device.
+    """
+    seq = is_init.shape[1]
+    resets = is_init[:, 1:].flatten(2).any(-1).any(0)
+    return [0, *(resets.nonzero().squeeze(-1) + 1).tolist(), seq]
+
+
+def get_net(
+    input_size, hidden_size, n_layers, bias, device, dropout, compile, fused=False
+):
     gru = GRU(
         input_size,
         hidden_size,
@@ -90,6 +181,7 @@ def get_net(input_size, hidden_size, n_layers, bias, device, dropout, compile):
         bias=bias,
         device=device,
         dropout=dropout,
+        fused=fused,
     )
     if compile:
         gru = torch.compile(gru, mode="reduce-overhead")
@@ -109,6 +201,7 @@ class MultiAgentGRU(torch.nn.Module):
         dropout: float,
         bias: bool,
         compile: bool,
+        fused: bool = False,
     ):
         super().__init__()
         self.input_size = input_size
@@ -121,6 +214,7 @@ class MultiAgentGRU(torch.nn.Module):
         self.bias = bias
         self.dropout = dropout
         self.compile = compile
+        self.fused = fused
 
         if self.centralised:
             input_size = input_size * self.n_agents
@@ -134,6 +228,7 @@ class MultiAgentGRU(torch.nn.Module):
                 device=self.device,
                 dropout=self.dropout,
                 compile=self.compile,
+                fused=self.fused,
             )
             for _ in range(self.n_agents if not self.share_params else 1)
         ]
@@ -148,6 +243,7 @@ class MultiAgentGRU(torch.nn.Module):
                 device="meta",
                 dropout=self.dropout,
                 compile=self.compile,
+                fused=self.fused,
             )
             # Remove all parameters
             TensorDict.from_module(self._empty_gru).data.to("meta").to_module(
@@ -159,22 +255,21 @@ class MultiAgentGRU(torch.nn.Module):
         input,
         is_init,
         h_0=None,
+        training: bool = True,
     ):
         # Input and output always have the multiagent dimension
         # Hidden states always have it apart from when it is centralized and share params
         # is_init never has it
+        # Training sequences have a time dimension, collected steps do not
 
         assert is_init is not None, "We need to pass is_init"
-        training = h_0 is None
 
-        missing_batch = False
-        if (
-            not training and len(input.shape) < 3
-        ):  # In evaluation the batch might be missing
-            missing_batch = True
-            input = input.unsqueeze(0)
-            h_0 = h_0.unsqueeze(0)
-            is_init = is_init.unsqueeze(0)
+        if not training:
+            # In collection the batch might be missing (in evaluation) or have several dimensions
+            batch_shape = input.shape[:-2]
+            input = input.reshape(-1, *input.shape[-2:])
+            h_0 = h_0.reshape(-1, *h_0.shape[len(batch_shape) :])
+            is_init = is_init.reshape(-1, 1)
 
         if (
             not training
@@ -197,7 +292,7 @@ class MultiAgentGRU(torch.nn.Module):
         assert is_init.shape == (batch, seq, 1)
         is_init = is_init.unsqueeze(-2).expand(batch, seq, self.n_agents, 1)
 
-        if training:
+        if training and h_0 is None:
             if self.centralised and self.share_params:
                 shape = (
                     batch,
@@ -214,7 +309,7 @@ class MultiAgentGRU(torch.nn.Module):
             h_0 = torch.zeros(
                 shape,
                 device=self.device,
-                dtype=torch.float,
+                dtype=next(self.parameters()).dtype,
             )
         if self.centralised:
             input = input.view(batch, seq, self.n_agents * self.input_size)
@@ -228,13 +323,13 @@ class MultiAgentGRU(torch.nn.Module):
             )
 
         if not training:
-            output = output.squeeze(1)
-        if missing_batch:
-            output = output.squeeze(0)
-            h_n = h_n.squeeze(0)
+            output = output.reshape(*batch_shape, *output.shape[2:])
+            h_n = h_n.reshape(*batch_shape, *h_n.shape[1:])
         return output, h_n
 
     def run_net(self, input, is_init, h_0):
+        if self.fused:
+            return self.run_fused_net(input, is_init, h_0)
         if not self.share_params:
             if self.centralised:
                 output, h_n = self.vmap_func_module(
@@ -259,6 +354,37 @@ class MultiAgentGRU(torch.nn.Module):
 
         return output, h_n
 
+    def run_fused_net(self, input, is_init, h_0):
+        # Fused kernels cannot be vmapped, so agents are moved to the batch dimension or looped over.
+        # The segments are shared by all agents, so that the resets are read from the device once
+        boundaries = _segment_boundaries(is_init)
+        if self.share_params:
+            with self.params.to_module(self._empty_gru):
+                if self.centralised:
+                    return self._empty_gru(input, is_init, h_0, boundaries)
+                batch, seq = input.shape[:2]
+                output, h_n = self._empty_gru(
+                    input.transpose(1, 2).reshape(batch * self.n_agents, seq, -1),
+                    is_init.transpose(1, 2).reshape(batch * self.n_agents, seq, 1),
+                    h_0.reshape(batch * self.n_agents, *h_0.shape[2:]),
+                    boundaries,
+                )
+            output = output.view(batch, self.n_agents, seq, -1).transpose(1, 2)
+            return output, h_n.view(h_0.shape)
+
+        outputs, h_ns = [], []
+        for i in range(self.n_agents):
+            with self.params[i].to_module(self._empty_gru):
+                output, h_n = self._empty_gru(
+                    input if self.centralised else input[..., i, :],
+                    is_init if self.centralised else is_init[..., i, :],
+                    h_0[..., i, :, :],
+                    boundaries,
+                )
+            outputs.append(output)
+            h_ns.append(h_n)
+        return torch.stack(outputs, dim=-2), torch.stack(h_ns, dim=-3)
+
     def vmap_func_module(self, module, *args, **kwargs):
         def exec_module(params, *input):
             with params.to_module(module):
@@ -294,6 +420,17 @@ class Gru(Model):
             GRU layer except the last layer, with dropout probability equal to
             :attr:`dropout`. Default: 0
         compile (bool): If ``True``, compiles underlying gru model. Default: ``False``
+        fused (bool): If ``True``, sequences are split at the steps where they are reset (``is_init``),
+            and the segments in between are run through the fused ``torch.nn.GRU`` kernel instead
+            of stepping through time with GRU cells. This gives the same outputs and is faster on long
+            training sequences. Finding the reset steps waits for the device once per forward pass (a host sync),
+            and without parameter sharing the agents are run one after the other, as the fused kernel takes
+            a single set of weights. Default: ``False``
+        store_hidden_state (bool): If ``True``, the policy outputs the hidden state that each collected step starts from,
+            so that it is kept in the collected data (once per frame), and training sequences start from the stored hidden
+            states instead of zeros. Default: ``False``
+        hidden_state_storage_dtype (str): The dtype of the stored hidden states (e.g., ``"bfloat16"`` or ``"float16"``
+            to halve their memory). Default: ``"float32"``
 
     """
 
@@ -304,6 +441,9 @@ class Gru(Model):
         bias: bool,
         dropout: float,
         compile: bool,
+        fused: bool = False,
+        store_hidden_state: bool = False,
+        hidden_state_storage_dtype: str = "float32",
         **kwargs,
     ):
 
@@ -321,8 +461,25 @@ class Gru(Model):
             is_critic=kwargs.pop("is_critic"),
         )
 
-        self.hidden_state_name = (self.agent_group, f"_hidden_gru_{self.model_index}")
-        self.rnn_keys = unravel_key_list(["is_init", self.hidden_state_name])
+        self.hidden_state_name = (
+            self.agent_group,
+            f"_hidden_gru{'_critic' if self.is_critic else ''}_{self.model_index}",
+        )
+        # Training sequences start from the hidden state given under the public key at their first step
+        # (stored in collection or after a burn-in)
+        self.stored_hidden_state_name = (
+            self.agent_group,
+            _stored_state_name(self.hidden_state_name[-1]),
+        )
+        self.rnn_keys = unravel_key_list(
+            ["is_init", self.hidden_state_name, self.stored_hidden_state_name]
+        )
+        # Critics are not run in collection, so they have no hidden states to store
+        self.store_hidden_state = store_hidden_state and not self.is_critic
+        self.hidden_state_storage_dtype = getattr(torch, hidden_state_storage_dtype)
+        if self.store_hidden_state:
+            # Output the hidden state each collected step starts from, so that it is kept in the collected data
+            self.out_keys.append(self.stored_hidden_state_name)
         self.in_keys += self.rnn_keys
 
         self.hidden_size = hidden_size
@@ -330,6 +487,7 @@ class Gru(Model):
         self.bias = bias
         self.dropout = dropout
         self.compile = compile
+        self.fused = fused
 
         self.input_features = sum(
             [spec.shape[-1] for spec in self.input_spec.values(True, True)]
@@ -348,6 +506,7 @@ class Gru(Model):
                 share_params=self.share_params,
                 dropout=self.dropout,
                 compile=self.compile,
+                fused=self.fused,
             )
         else:
             self.gru = nn.ModuleList(
@@ -360,6 +519,7 @@ class Gru(Model):
                         device=self.device,
                         dropout=self.dropout,
                         compile=self.compile,
+                        fused=self.fused,
                     )
                     for _ in range(self.n_agents if not self.share_params else 1)
                 ]
@@ -430,20 +590,28 @@ class Gru(Model):
     def _forward(self, tensordict: TensorDictBase) -> TensorDictBase:
         # Gather in_key
         input = torch.cat(
-            [
-                tensordict.get(in_key)
-                for in_key in self.in_keys
-                if in_key not in self.rnn_keys
-            ],
+            [tensordict.get(in_key) for in_key in self.input_spec.keys(True, True)],
             dim=-1,
         )
         h_0 = tensordict.get(self.hidden_state_name, None)
         is_init = tensordict.get("is_init")
+        dtype = next(self.parameters()).dtype
+        # Collected steps are given the hidden states of the previous steps, training sequences are not
         training = h_0 is None
+        if training:
+            h_0 = tensordict.get(self.stored_hidden_state_name, None)
+            if h_0 is not None:
+                # Sequences start from the hidden states given at their first step
+                h_0 = h_0[:, 0].to(dtype)
+
+        agent_mask = self._get_agent_mask(tensordict)
 
         # Has multi-agent input dimension
         if self.input_has_agent_dim:
-            output, h_n = self.gru(input, is_init, h_0)
+            if agent_mask is not None:
+                # Padded agents do not contribute to centralised outputs
+                input = input.masked_fill(~agent_mask.unsqueeze(-1), 0)
+            output, h_n = self.gru(input, is_init, h_0, training=training)
             if not self.output_has_agent_dim:
                 output = output[..., 0, :]
         else:  # Is a global input, this is a critic
@@ -456,14 +624,16 @@ class Gru(Model):
             h_0 = torch.zeros(
                 (batch, self.n_layers, self.hidden_size),
                 device=self.device,
-                dtype=torch.float,
+                dtype=dtype,
             )
             if self.share_params:
                 output, _ = self.gru[0](input, is_init, h_0)
             else:
+                # The segments are shared by all agents, so that the resets are read from the device once
+                boundaries = _segment_boundaries(is_init) if self.fused else None
                 outputs = []
                 for net in self.gru:
-                    output, _ = net(input, is_init, h_0)
+                    output, _ = net(input, is_init, h_0, boundaries)
                     outputs.append(output)
                 output = torch.stack(outputs, dim=-2)
 
@@ -479,9 +649,16 @@ class Gru(Model):
             else:
                 output = self.mlp[0](output)
 
+        if agent_mask is not None and self.output_has_agent_dim:
+            output = output.masked_fill(~agent_mask.unsqueeze(-1), 0)
         tensordict.set(self.out_key, output)
         if not training:
             tensordict.set(("next", *self.hidden_state_name), h_n)
+            if self.store_hidden_state:
+                tensordict.set(
+                    self.stored_hidden_state_name,
+                    h_0.to(self.hidden_state_storage_dtype),
+                )
         return tensordict
 
 
@@ -503,6 +680,10 @@ class GruConfig(ModelConfig):
     mlp_norm_class: Type[nn.Module] = None
     mlp_norm_kwargs: Optional[dict] = None
 
+    fused: bool = False
+    store_hidden_state: bool = False
+    hidden_state_storage_dtype: str = "float32"
+
     @staticmethod
     def associated_class():
         return Gru
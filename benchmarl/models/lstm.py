@@ -7,7 +7,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, MISSING
-from typing import Optional, Sequence, Type
+from typing import List, Optional, Sequence, Type
 
 import torch
 import torch.nn.functional as F
@@ -18,7 +18,8 @@ from torchrl.data.tensor_specs import Composite, Unbounded
 
 from torchrl.modules import LSTMCell, MLP, MultiAgentMLP
 
-from benchmarl.models.common import Model, ModelConfig
+from benchmarl.models.common import _stored_state_name, Model, ModelConfig
+from benchmarl.models.gru import _run_segments, _segment_boundaries
 from benchmarl.utils import DEVICE_TYPING
 
 
@@ -32,6 +33,7 @@ class LSTM(torch.nn.Module):
         dropout: float,
         bias: bool,
         time_dim: int = -2,
+        fused: bool = False,
     ):
         super().__init__()
         self.input_size = input_size
@@ -41,6 +43,7 @@ class LSTM(torch.nn.Module):
         self.n_layers = n_layers
         self.dropout = dropout
         self.bias = bias
+        self.fused = fused
 
         self.lstms = torch.nn.ModuleList(
             [
@@ -54,7 +57,10 @@ class LSTM(torch.nn.Module):
             ]
         )
 
-    def forward(self, input, is_init, h, c):
+    def forward(self, input, is_init, h, c, boundaries: Optional[List[int]] = None):
+        if self.fused:
+            return self._fused_forward(input, is_init, h, c, boundaries)
+
         hs = []
 
         h = list(h.unbind(dim=-2))
@@ -81,8 +87,45 @@ class LSTM(torch.nn.Module):
 
         return output, h_n, c_n
 
+    def _fused_forward(self, input, is_init, h, c, boundaries):
+        # Same weight layout as torch.nn.LSTM
+        weights = [
+            weight
+            for lstm in self.lstms
+            for weight in (
+                (lstm.weight_ih, lstm.weight_hh, lstm.bias_ih, lstm.bias_hh)
+                if self.bias
+                else (lstm.weight_ih, lstm.weight_hh)
+            )
+        ]
+
+        def run_lstm(input, hx):
+            output, h, c = torch.lstm(
+                input,
+                hx,
+                weights,
+                self.bias,
+                self.n_layers,
+                self.dropout,
+                self.training,
+                False,  # bidirectional
+                True,  # batch_first
+            )
+            return output, (h, c)
+
+        output, (h_n, c_n) = _run_segments(
+            run_lstm,
+            input,
+            is_init,
+            (h.transpose(0, 1).contiguous(), c.transpose(0, 1).contiguous()),
+            boundaries=boundaries,
+        )
+        return output, h_n.transpose(0, 1), c_n.transpose(0, 1)
 
-def get_net(input_size, hidden_size, n_layers, bias, device, dropout, compile):
+
+def get_net(
+    input_size, hidden_size, n_layers, bias, device, dropout, compile, fused=False
+):
     lstm = LSTM(
         input_size,
         hidden_size,
@@ -90,6 +133,7 @@ def get_net(input_size, hidden_size, n_layers, bias, device, dropout, compile):
         bias=bias,
         device=device,
         dropout=dropout,
+        fused=fused,
     )
     if compile:
         lstm = torch.compile(lstm, mode="reduce-overhead")
@@ -109,6 +153,7 @@ class MultiAgentLSTM(torch.nn.Module):
         dropout: float,
         bias: bool,
         compile: bool,
+        fused: bool = False,
     ):
         super().__init__()
         self.input_size = input_size
@@ -121,6 +166,7 @@ class MultiAgentLSTM(torch.nn.Module):
         self.bias = bias
         self.dropout = dropout
         self.compile = compile
+        self.fused = fused
 
         if self.centralised:
             input_size = input_size * self.n_agents
@@ -134,6 +180,7 @@ class MultiAgentLSTM(torch.nn.Module):
                 device=self.device,
                 dropout=self.dropout,
                 compile=self.compile,
+                fused=self.fused,
             )
             for _ in range(self.n_agents if not self.share_params else 1)
         ]
@@ -148,6 +195,7 @@ class MultiAgentLSTM(torch.nn.Module):
                 device="meta",
                 dropout=self.dropout,
                 compile=self.compile,
+                fused=self.fused,
             )
             # Remove all parameters
             TensorDict.from_module(self._empty_lstm).data.to("meta").to_module(
@@ -160,23 +208,22 @@ class MultiAgentLSTM(torch.nn.Module):
         is_init,
         h_0=None,
         c_0=None,
+        training: bool = True,
     ):
         # Input and output always have the multiagent dimension
         # Hidden states always have it apart from when it is centralized and share params
         # is_init never has it
+        # Training sequences have a time dimension, collected steps do not
 
         assert is_init is not None, "We need to pass is_init"
-        training = h_0 is None
 
-        missing_batch = False
-        if (
-            not training and len(input.shape) < 3
-        ):  # In evaluation the batch might be missing
-            missing_batch = True
-            input = input.unsqueeze(0)
-            h_0 = h_0.unsqueeze(0)
-            c_0 = c_0.unsqueeze(0)
-            is_init = is_init.unsqueeze(0)
+        if not training:
+            # In collection the batch might be missing (in evaluation) or have several dimensions
+            batch_shape = input.shape[:-2]
+            input = input.reshape(-1, *input.shape[-2:])
+            h_0 = h_0.reshape(-1, *h_0.shape[len(batch_shape) :])
+            c_0 = c_0.reshape(-1, *c_0.shape[len(batch_shape) :])
+            is_init = is_init.reshape(-1, 1)
 
         if (
             not training
@@ -199,7 +246,7 @@ class MultiAgentLSTM(torch.nn.Module):
         assert is_init.shape == (batch, seq, 1)
         is_init = is_init.unsqueeze(-2).expand(batch, seq, self.n_agents, 1)
 
-        if training:
+        if training and h_0 is None:
             if self.centralised and self.share_params:
                 shape = (
                     batch,
@@ -216,7 +263,7 @@ class MultiAgentLSTM(torch.nn.Module):
             h_0 = torch.zeros(
                 shape,
                 device=self.device,
-                dtype=torch.float,
+                dtype=next(self.parameters()).dtype,
             )
             c_0 = h_0.clone()
         if self.centralised:
@@ -231,14 +278,14 @@ class MultiAgentLSTM(torch.nn.Module):
             )
 
         if not training:
-            output = output.squeeze(1)
-        if missing_batch:
-            output = output.squeeze(0)
-            h_n = h_n.squeeze(0)
-            c_n = c_n.squeeze(0)
+            output = output.reshape(*batch_shape, *output.shape[2:])
+            h_n = h_n.reshape(*batch_shape, *h_n.shape[1:])
+            c_n = c_n.reshape(*batch_shape, *c_n.shape[1:])
         return output, h_n, c_n
 
     def run_net(self, input, is_init, h_0, c_0):
+        if self.fused:
+            return self.run_fused_net(input, is_init, h_0, c_0)
         if not self.share_params:
             if self.centralised:
                 output, h_n, c_n = self.vmap_func_module(
@@ -265,6 +312,44 @@ class MultiAgentLSTM(torch.nn.Module):
 
         return output, h_n, c_n
 
+    def run_fused_net(self, input, is_init, h_0, c_0):
+        # Fused kernels cannot be vmapped, so agents are moved to the batch dimension or looped over.
+        # The segments are shared by all agents, so that the resets are read from the device once
+        boundaries = _segment_boundaries(is_init)
+        if self.share_params:
+            with self.params.to_module(self._empty_lstm):
+                if self.centralised:
+                    return self._empty_lstm(input, is_init, h_0, c_0, boundaries)
+                batch, seq = input.shape[:2]
+                output, h_n, c_n = self._empty_lstm(
+                    input.transpose(1, 2).reshape(batch * self.n_agents, seq, -1),
+                    is_init.transpose(1, 2).reshape(batch * self.n_agents, seq, 1),
+                    h_0.reshape(batch * self.n_agents, *h_0.shape[2:]),
+                    c_0.reshape(batch * self.n_agents, *c_0.shape[2:]),
+                    boundaries,
+                )
+            output = output.view(batch, self.n_agents, seq, -1).transpose(1, 2)
+            return output, h_n.view(h_0.shape), c_n.view(c_0.shape)
+
+        outputs, h_ns, c_ns = [], [], []
+        for i in range(self.n_agents):
+            with self.params[i].to_module(self._empty_lstm):
+                output, h_n, c_n = self._empty_lstm(
+                    input if self.centralised else input[..., i, :],
+                    is_init if self.centralised else is_init[..., i, :],
+                    h_0[..., i, :, :],
+                    c_0[..., i, :, :],
+                    boundaries,
+                )
+            outputs.append(output)
+            h_ns.append(h_n)
+            c_ns.append(c_n)
+        return (
+            torch.stack(outputs, dim=-2),
+            torch.stack(h_ns, dim=-3),
+            torch.stack(c_ns, dim=-3),
+        )
+
     def vmap_func_module(self, module, *args, **kwargs):
         def exec_module(params, *input):
             with params.to_module(module):
@@ -300,6 +385,17 @@ class Lstm(Model):
             LSTM layer except the last layer, with dropout probability equal to
             :attr:`dropout`. Default: 0
         compile (bool): If ``True``, compiles underlying LSTM model. Default: ``False``
+        fused (bool): If ``True``, sequences are split at the steps where they are reset (``is_init``),
+            and the segments in between are run through the fused ``torch.nn.LSTM`` kernel instead
+            of stepping through time with LSTM cells. This gives the same outputs and is faster on long
+            training sequences. Finding the reset steps waits for the device once per forward pass (a host sync),
+            and without parameter sharing the agents are run one after the other, as the fused kernel takes
+            a single set of weights. Default: ``False``
+        store_hidden_state (bool): If ``True``, the policy outputs the hidden and cell states that each collected step starts from,
+            so that they are kept in the collected data (once per frame), and training sequences start from the stored
+            states instead of zeros. Default: ``False``
+        hidden_state_storage_dtype (str): The dtype of the stored states (e.g., ``"bfloat16"`` or ``"float16"``
+            to halve their memory). Default: ``"float32"``
 
     """
 
@@ -310,6 +406,9 @@ class Lstm(Model):
         bias: bool,
         dropout: float,
         compile: bool,
+        fused: bool = False,
+        store_hidden_state: bool = False,
+        hidden_state_storage_dtype: str = "float32",
         **kwargs,
     ):
 
@@ -329,16 +428,39 @@ class Lstm(Model):
 
         self.hidden_state_name_h = (
             self.agent_group,
-            f"_hidden_lstm_h_{self.model_index}",
+            f"_hidden_lstm_h{'_critic' if self.is_critic else ''}_{self.model_index}",
         )
         self.hidden_state_name_c = (
             self.agent_group,
-            f"_hidden_lstm_c_{self.model_index}",
+            f"_hidden_lstm_c{'_critic' if self.is_critic else ''}_{self.model_index}",
+        )
+
+        # Training sequences start from the states given under the public keys at their first step
+        # (stored in collection or after a burn-in)
+        self.stored_hidden_state_name_h = (
+            self.agent_group,
+            _stored_state_name(self.hidden_state_name_h[-1]),
+        )
+        self.stored_hidden_state_name_c = (
+            self.agent_group,
+            _stored_state_name(self.hidden_state_name_c[-1]),
         )
+        stored_keys = [self.stored_hidden_state_name_c, self.stored_hidden_state_name_h]
 
         self.rnn_keys = unravel_key_list(
-            ["is_init", self.hidden_state_name_c, self.hidden_state_name_h]
+            [
+                "is_init",
+                self.hidden_state_name_c,
+                self.hidden_state_name_h,
+                *stored_keys,
+            ]
         )
+        # Critics are not run in collection, so they have no hidden states to store
+        self.store_hidden_state = store_hidden_state and not self.is_critic
+        self.hidden_state_storage_dtype = getattr(torch, hidden_state_storage_dtype)
+        if self.store_hidden_state:
+            # Output the states each collected step starts from, so that they are kept in the collected data
+            self.out_keys += stored_keys
         self.in_keys += self.rnn_keys
 
         self.hidden_size = hidden_size
@@ -346,6 +468,7 @@ class Lstm(Model):
         self.bias = bias
         self.dropout = dropout
         self.compile = compile
+        self.fused = fused
 
         self.input_features = sum(
             [spec.shape[-1] for spec in self.input_spec.values(True, True)]
@@ -364,6 +487,7 @@ class Lstm(Model):
                 share_params=self.share_params,
                 dropout=self.dropout,
                 compile=self.compile,
+                fused=self.fused,
             )
         else:
             self.lstm = nn.ModuleList(
@@ -376,6 +500,7 @@ class Lstm(Model):
                         device=self.device,
                         dropout=self.dropout,
                         compile=self.compile,
+                        fused=self.fused,
                     )
                     for _ in range(self.n_agents if not self.share_params else 1)
                 ]
@@ -446,22 +571,32 @@ class Lstm(Model):
     def _forward(self, tensordict: TensorDictBase) -> TensorDictBase:
         # Gather in_key
         input = torch.cat(
-            [
-                tensordict.get(in_key)
-                for in_key in self.in_keys
-                if in_key not in self.rnn_keys
-            ],
+            [tensordict.get(in_key) for in_key in self.input_spec.keys(True, True)],
             dim=-1,
         )
         h_0 = tensordict.get(self.hidden_state_name_h, None)
         c_0 = tensordict.get(self.hidden_state_name_c, None)
         is_init = tensordict.get("is_init")
 
+        dtype = next(self.parameters()).dtype
+        # Collected steps are given the states of the previous steps, training sequences are not
         training = h_0 is None
+        if training:
+            h_0 = tensordict.get(self.stored_hidden_state_name_h, None)
+            c_0 = tensordict.get(self.stored_hidden_state_name_c, None)
+            if h_0 is not None:
+                # Sequences start from the states given at their first step
+                h_0 = h_0[:, 0].to(dtype)
+                c_0 = c_0[:, 0].to(dtype)
+
+        agent_mask = self._get_agent_mask(tensordict)
 
         # Has multi-agent input dimension
         if self.input_has_agent_dim:
-            output, h_n, c_n = self.lstm(input, is_init, h_0, c_0)
+            if agent_mask is not None:
+                # Padded agents do not contribute to centralised outputs
+                input = input.masked_fill(~agent_mask.unsqueeze(-1), 0)
+            output, h_n, c_n = self.lstm(input, is_init, h_0, c_0, training=training)
             if not self.output_has_agent_dim:
                 output = output[..., 0, :]
         else:  # Is a global input, this is a critic
@@ -474,15 +609,17 @@ class Lstm(Model):
             h_0 = torch.zeros(
                 (batch, self.n_layers, self.hidden_size),
                 device=self.device,
-                dtype=torch.float,
+                dtype=dtype,
             )
             c_0 = h_0.clone()
             if self.share_params:
                 output, _, _ = self.lstm[0](input, is_init, h_0, c_0)
             else:
+                # The segments are shared by all agents, so that the resets are read from the device once
+                boundaries = _segment_boundaries(is_init) if self.fused else None
                 outputs = []
                 for net in self.lstm:
-                    output, _, _ = net(input, is_init, h_0, c_0)
+                    output, _, _ = net(input, is_init, h_0, c_0, boundaries)
                     outputs.append(output)
                 output = torch.stack(outputs, dim=-2)
 
@@ -498,10 +635,21 @@ class Lstm(Model):
             else:
                 output = self.mlp[0](output)
 
+        if agent_mask is not None and self.output_has_agent_dim:
+            output = output.masked_fill(~agent_mask.unsqueeze(-1), 0)
         tensordict.set(self.out_key, output)
         if not training:
             tensordict.set(("next", *self.hidden_state_name_h), h_n)
             tensordict.set(("next", *self.hidden_state_name_c), c_n)
+            if self.store_hidden_state:
+                tensordict.set(
+                    self.stored_hidden_state_name_h,
+                    h_0.to(self.hidden_state_storage_dtype),
+                )
+                tensordict.set(
+                    self.stored_hidden_state_name_c,
+                    c_0.to(self.hidden_state_storage_dtype),
+                )
         return tensordict
 
 
@@ -523,6 +671,10 @@ class LstmConfig(ModelConfig):
     mlp_norm_class: Type[nn.Module] = None
     mlp_norm_kwargs: Optional[dict] = None
 
+    fused: bool = False
+    store_hidden_state: bool = False
+    hidden_state_storage_dtype: str = "float32"
+
     @staticmethod
     def associated_class():
         return Lstm
@@ -14,7 +14,7 @@ from tensordict import TensorDictBase
 from torch import nn
 from torchrl.modules import MLP, MultiAgentMLP
 
-from benchmarl.models.common import Model, ModelConfig
+from benchmarl.models.common import _StackedModules, Model, ModelConfig
 
 
 class Mlp(Model):
@@ -71,16 +71,19 @@ class Mlp(Model):
                 **kwargs,
             )
         else:
-            self.mlp = nn.ModuleList(
-                [
-                    MLP(
-                        in_features=self.input_features,
-                        out_features=self.output_features,
-                        device=self.device,
-                        **kwargs,
-                    )
-                    for _ in range(self.n_agents if not self.share_params else 1)
-                ]
+            agent_networks = [
+                MLP(
+                    in_features=self.input_features,
+                    out_features=self.output_features,
+                    device=self.device,
+                    **kwargs,
+                )
+                for _ in range(self.n_agents if not self.share_params else 1)
+            ]
+            self.mlp = (
+                nn.ModuleList(agent_networks)
+                if self.share_params
+                else _StackedModules(agent_networks)
             )
 
     def _perform_checks(self):
@@ -126,13 +129,17 @@ class Mlp(Model):
         input = torch.cat(
             [
                 torch.flatten(tensordict.get(in_key), start_dim=-self.num_feature_dims)
-                for in_key in self.in_keys
+                for in_key in self.input_spec.keys(True, True)
             ],
             dim=-1,
         )
+        agent_mask = self._get_agent_mask(tensordict)
 
         # Has multi-agent input dimension
         if self.input_has_agent_dim:
+            if agent_mask is not None:
+                # Padded agents do not contribute to centralised outputs
+                input = input.masked_fill(~agent_mask.unsqueeze(-1), 0)
             res = self.mlp.forward(input)
             if not self.output_has_agent_dim:
                 # If we are here the module is centralised and parameter shared.
@@ -143,13 +150,12 @@ class Mlp(Model):
         # Does not have multi-agent input dimension
         else:
             if not self.share_params:
-                res = torch.stack(
-                    [net(input) for net in self.mlp],
-                    dim=-2,
-                )
+                res = self.mlp(input, in_dims=(None,), out_dim=-2)
             else:
                 res = self.mlp[0](input)
 
+        if agent_mask is not None and self.output_has_agent_dim:
+            res = res.masked_fill(~agent_mask.unsqueeze(-1), 0)
         tensordict.set(self.out_key, res)
         return tensordict
 
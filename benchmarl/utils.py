@@ -3,14 +3,18 @@
 #  This source code is licensed under the license found in the
 #  LICENSE file in the root directory of this source tree.
 #
+import collections
 import contextlib
 import importlib
+import json
 import random
 import typing
 from typing import Any, Callable, Dict, List, Union
 
 import torch
 import yaml
+from tensordict import TensorDictBase
+from tensordict.utils import expand_as_right
 from torchrl.data import Composite
 from torchrl.envs import Compose, EnvBase, InitTracker, TensorDictPrimer, TransformedEnv
 
@@ -22,6 +26,10 @@ _has_numpy = importlib.util.find_spec("numpy") is not None
 
 DEVICE_TYPING = Union[torch.device, str, int]
 
+# Key of the windows marking the padding steps before the start of the sequences (in the burn-in)
+# and after their end (in the last window)
+SEQUENCE_PADDING_KEY = "sequence_padding"
+
 
 def _read_yaml_config(config_file: str) -> Dict[str, Any]:
     with open(config_file) as config:
@@ -34,6 +42,39 @@ def _read_yaml_config(config_file: str) -> Dict[str, Any]:
     return config_dict
 
 
+def _merge_dicts(d: Dict, u: Dict) -> Dict:
+    """Recursively updates ``d`` with ``u``."""
+    for k, v in u.items():
+        if isinstance(v, collections.abc.Mapping):
+            d[k] = _merge_dicts(d.get(k, {}), v)
+        else:
+            d[k] = v
+    return d
+
+
+def _read_json_dict(file: str) -> Dict:
+    """Reads a json file, or a jsonl file by merging the dictionaries in its lines.
+
+    A truncated last line, from a jsonl file that is being written, is ignored.
+    """
+    with open(file, "r") as f:
+        if not str(file).endswith(".jsonl"):
+            return json.load(f)
+        lines = f.read().split("\n")
+    full_dict = {}
+    for i, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            line_dict = json.loads(line)
+        except json.JSONDecodeError:
+            if i == len(lines) - 1:
+                break
+            raise
+        _merge_dicts(full_dict, line_dict)
+    return full_dict
+
+
 def _class_from_name(name: str):
     name_split = name.split(".")
     module_name = ".".join(name_split[:-1])
@@ -129,3 +170,138 @@ def _add_rnn_transforms(
         return out_env
 
     return model_fun
+
+
+def _add_graph_transforms(
+    env_fun: Callable[[], EnvBase],
+    group_map: Dict[str, List[str]],
+    model_config: "ModelConfig",
+) -> Callable[[], EnvBase]:
+    """
+    This function adds the transforms needed to keep the agent graphs output by the model in the collected data
+
+    Args:
+        env_fun (callable): a function that takes no args and creates an environment
+        group_map (Dict[str,List[str]]): the group_map of the agents
+        model_config (ModelConfig): the model configuration
+
+    Returns: a function that takes no args and creates an environment
+
+    """
+
+    def model_fun():
+        env = env_fun()
+        spec_graph = Composite(
+            {
+                group: model_config._get_graph_spec(group, len(agents))
+                for group, agents in group_map.items()
+            }
+        ).expand(*env.batch_size)
+
+        # Initial graphs have no neighbours and NaN positions
+        def default_value(spec):
+            return lambda: torch.full(
+                spec.shape,
+                -1 if spec.dtype == torch.int32 else float("nan"),
+                dtype=spec.dtype,
+                device=spec.device,
+            )
+
+        return TransformedEnv(
+            env,
+            TensorDictPrimer(
+                spec_graph,
+                default_value={
+                    key: default_value(spec)
+                    for key, spec in spec_graph.items(True, True)
+                },
+                reset_key="_reset",
+            ),
+        )
+
+    return model_fun
+
+
+def _get_sequence_windows(
+    batch: TensorDictBase,
+    window_length: int,
+    burn_in: int = 0,
+    pad_last_window: bool = False,
+) -> TensorDictBase:
+    """
+    This function splits a batch of sequences into windows, used to train recurrent models on shorter sequences
+
+    Windows start every ``window_length`` steps and are preceded by the ``burn_in`` steps before their start.
+    Burn-in steps before the start of the sequences are padding: they repeat the first step and have ``is_init`` set.
+    If the sequences are not split evenly, the last window either ends with the sequences, overlapping the previous one,
+    or, if ``pad_last_window``, is padded after the end of the sequences by repeating the last step.
+    Padding steps are marked in :data:`SEQUENCE_PADDING_KEY`, so that :func:`_burn_in_states` skips them
+    and losses can leave them out.
+
+    Args:
+        batch (TensorDictBase): the sequences, with batch size ``[n_sequences, sequence_length]``
+        window_length (int): the length of the windows (excluding burn-in)
+        burn_in (int): the number of burn-in steps before each window
+        pad_last_window (bool): whether to pad the last window instead of overlapping it with the previous one
+
+    Returns: the windows, with batch size ``[n_windows, burn_in + window_length]``
+
+    """
+    sequence_length = batch.shape[1]
+    starts = list(range(0, sequence_length, window_length))
+    if starts[-1] + window_length > sequence_length and not pad_last_window:
+        starts[-1] = sequence_length - window_length
+    time_index = torch.tensor(starts, device=batch.device).unsqueeze(-1) + torch.arange(
+        -burn_in, window_length, device=batch.device
+    )
+
+    windows = batch[:, time_index.clamp(min=0, max=sequence_length - 1)]
+    if burn_in > 0:
+        is_init = windows.get("is_init")
+        windows.set("is_init", is_init | expand_as_right(time_index < 0, is_init[0]))
+    if burn_in > 0 or starts[-1] + window_length > sequence_length:
+        padding = (time_index < 0) | (time_index >= sequence_length)
+        windows.set(SEQUENCE_PADDING_KEY, padding.expand(windows.shape))
+    return windows.reshape(-1, burn_in + window_length)
+
+
+def _burn_in_states(
+    policy: Callable[[TensorDictBase], TensorDictBase],
+    windows: TensorDictBase,
+    state: TensorDictBase,
+    group: str,
+    burn_in: int,
+) -> TensorDictBase:
+    """
+    Steps a recurrent policy through the burn-in steps of windows, as in collection
+
+    Padding steps (before the start of the sequences) keep the hidden states, so the first step of the sequences
+    starts from the initial hidden states (e.g., stored ones) as it does without burn-in.
+
+    Args:
+        policy (callable): the policy, stepping the hidden states of the group from the root to ``"next"``
+        windows (TensorDictBase): the windows, with batch size ``[n_windows, burn_in + window_length]``
+        state (TensorDictBase): the hidden states of the group at the first step of the windows
+        group (str): the agent group
+        burn_in (int): the number of burn-in steps
+
+    Returns: the hidden states at the end of the burn-in
+
+    """
+    padding = windows.get(SEQUENCE_PADDING_KEY, None)
+    for step in range(burn_in):
+        step_td = windows[:, step].select(*policy.in_keys, strict=False)
+        step_td.get(group).update(state)
+        next_state = policy(step_td).get(("next", group)).select(*state.keys())
+        if padding is not None:
+            for key, value in state.items():
+                next_state.set(
+                    key,
+                    torch.where(
+                        expand_as_right(padding[:, step], value),
+                        value,
+                        next_state.get(key),
+                    ),
+                )
+        state = next_state
+    return state
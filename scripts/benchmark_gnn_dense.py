@@ -0,0 +1,145 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Benchmark of the dense GNN backend on fully connected and radius agent graphs.
+
+Compares the forward and backward time of ``GraphConv`` and ``GATv2Conv`` layers run
+on the batched PyG graph (scatter/gather over the edges) with their dense counterparts,
+which operate directly on the ``[batch, n_agents, features]`` tensor.
+With ``--topology from_pos``, the time includes building the radius graph from positions
+spread so that each agent has ``--neighbours`` neighbours on average.
+
+Usage:
+    python scripts/benchmark_gnn_dense.py --device cuda
+    python scripts/benchmark_gnn_dense.py --topology from_pos --n-agents 16 32 64 128
+"""
+
+import argparse
+import math
+import time
+from functools import partial
+
+import torch
+import torch_geometric
+
+from benchmarl.models.gnn import (
+    _batch_from_dense_to_ptg,
+    _BatchedTopologyCache,
+    _dense_edge_attr,
+    _get_dense_adjacency,
+    _get_dense_forward,
+    _get_edge_index,
+    _radius_adjacency,
+)
+
+
+def sparse_forward(x, conv, edge_index, pos, edge_pos, cache, radius):
+    graph = _batch_from_dense_to_ptg(
+        x=x,
+        edge_index=edge_index,
+        self_loops=False,
+        pos=edge_pos if edge_index is not None else pos,
+        edge_radius=radius,
+        topology_cache=cache,
+    )
+    edge_attr = {"edge_attr": graph.edge_attr} if edge_pos is not None else {}
+    return conv(x=graph.x, edge_index=graph.edge_index, **edge_attr)
+
+
+def dense_forward(x, conv, adjacency, pos, edge_pos, radius):
+    if adjacency is None:
+        adjacency = _radius_adjacency(pos, r=radius, loop=False, max_num_neighbors=None)
+    edge_attr = (
+        _dense_edge_attr(pos=edge_pos, vel=None) if edge_pos is not None else None
+    )
+    return _get_dense_forward(conv)(conv, x=x, adjacency=adjacency, edge_attr=edge_attr)
+
+
+def benchmark(forward, x: torch.Tensor, args) -> float:
+    def run(n_iters: int):
+        for _ in range(n_iters):
+            forward(x).sum().backward()
+
+    run(5)  # Warmup
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    run(args.iters)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--topology", default="full", choices=["full", "from_pos"])
+    parser.add_argument("--neighbours", type=float, default=4)
+    parser.add_argument("--n-agents", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    parser.add_argument("--batch-size", type=int, default=400)
+    parser.add_argument("--features", type=int, default=18)
+    parser.add_argument("--out-features", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'layer':>10} {'n_agents':>8} {'pyg':>14} {'dense':>14}")
+    for gnn_class in [torch_geometric.nn.GraphConv, torch_geometric.nn.GATv2Conv]:
+        for n_agents in args.n_agents:
+            kwargs = {}
+            if gnn_class is torch_geometric.nn.GATv2Conv:
+                kwargs["edge_dim"] = 3  # Relative position and distance
+            conv = gnn_class(args.features, args.out_features, **kwargs).to(args.device)
+            from_pos = args.topology == "from_pos"
+            edge_index = (
+                _get_edge_index(
+                    topology="full",
+                    self_loops=False,
+                    n_agents=n_agents,
+                    device=args.device,
+                )
+                if not from_pos
+                else None
+            )
+            cache = _BatchedTopologyCache(edge_index, n_agents=n_agents, max_size=1)
+            adjacency = (
+                _get_dense_adjacency(edge_index, n_agents=n_agents)
+                if not from_pos
+                else None
+            )
+            # Agents in the unit square, with the radius giving the requested mean degree
+            pos = torch.rand(args.batch_size, n_agents, 2, device=args.device)
+            radius = math.sqrt(args.neighbours / (math.pi * (n_agents - 1)))
+
+            x = torch.randn(
+                args.batch_size,
+                n_agents,
+                args.features,
+                device=args.device,
+                requires_grad=True,
+            )
+            edge_pos = pos if "edge_dim" in kwargs else None
+            forward_kwargs = {
+                "conv": conv,
+                "pos": pos,
+                "edge_pos": edge_pos,
+                "radius": radius,
+            }
+            sparse_time = benchmark(
+                partial(
+                    sparse_forward, edge_index=edge_index, cache=cache, **forward_kwargs
+                ),
+                x,
+                args,
+            )
+            dense_time = benchmark(
+                partial(dense_forward, adjacency=adjacency, **forward_kwargs),
+                x,
+                args,
+            )
+            print(
+                f"{gnn_class.__name__:>10} {n_agents:>8} {sparse_time * 1e3:11.2f} ms "
+                f"{dense_time * 1e3:11.2f} ms (x{sparse_time / dense_time:.2f})"
+            )
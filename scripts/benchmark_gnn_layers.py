@@ -0,0 +1,109 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Benchmark of a multi-layer GNN model against the equivalent sequence of GNN models.
+
+Compares the forward and backward time of a ``SequenceModel`` of single-layer ``Gnn`` models,
+where each model concatenates its inputs and builds its own graph, with one ``Gnn``
+running all the layers on a graph built once.
+
+Usage:
+    python scripts/benchmark_gnn_layers.py --device cuda --gnn-classes GraphConv GCNConv GATv2Conv
+"""
+
+import argparse
+import time
+
+import torch
+import torch_geometric
+from torchrl.data.tensor_specs import Composite, Unbounded
+
+from benchmarl.models import GnnConfig, SequenceModelConfig
+
+
+def benchmark(model, input_td, args) -> float:
+    def run(n_iters: int):
+        for _ in range(n_iters):
+            model(input_td.clone()).get(("agents", "out")).sum().backward()
+
+    run(5)  # Warmup
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    run(args.iters)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--topology", default="full", choices=["full", "empty"])
+    parser.add_argument("--gnn-classes", nargs="+", default=["GraphConv", "GATv2Conv"])
+    parser.add_argument("--n-agents", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--batch-size", type=int, default=400)
+    parser.add_argument("--features", type=int, default=18)
+    parser.add_argument("--hidden-features", type=int, default=48)
+    parser.add_argument("--out-features", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    gnn_classes = [getattr(torch_geometric.nn, name) for name in args.gnn_classes]
+    hidden_sizes = [args.hidden_features] * (len(gnn_classes) - 1)
+
+    print(f"{'n_agents':>8} {'sequence':>14} {'multi-layer':>14}")
+    for n_agents in args.n_agents:
+        input_spec = Composite(
+            {
+                "agents": Composite(
+                    {"observation": Unbounded(shape=(n_agents, args.features))},
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                "agents": Composite(
+                    {"out": Unbounded(shape=(n_agents, args.out_features))},
+                    shape=(n_agents,),
+                )
+            }
+        )
+        model_kwargs = {
+            "input_spec": input_spec,
+            "output_spec": output_spec,
+            "agent_group": "agents",
+            "input_has_agent_dim": True,
+            "n_agents": n_agents,
+            "centralised": False,
+            "share_params": True,
+            "device": args.device,
+            "action_spec": None,
+        }
+        sequence = SequenceModelConfig(
+            model_configs=[
+                GnnConfig(topology=args.topology, self_loops=False, gnn_class=gnn_class)
+                for gnn_class in gnn_classes
+            ],
+            intermediate_sizes=hidden_sizes,
+        )
+        multi_layer = GnnConfig(
+            topology=args.topology,
+            self_loops=False,
+            gnn_class=gnn_classes,
+            num_cells=hidden_sizes,
+        )
+
+        input_td = input_spec.expand(args.batch_size).rand().to(args.device)
+        sequence_time = benchmark(sequence.get_model(**model_kwargs), input_td, args)
+        multi_layer_time = benchmark(
+            multi_layer.get_model(**model_kwargs), input_td, args
+        )
+        print(
+            f"{n_agents:>8} {sequence_time * 1e3:11.2f} ms "
+            f"{multi_layer_time * 1e3:11.2f} ms (x{sequence_time / multi_layer_time:.2f})"
+        )
@@ -0,0 +1,73 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Benchmark of the construction of batched graphs in the GNN model for static topologies.
+
+Compares building the batched ``edge_index``, ``batch`` and ``ptr`` tensors at every call of
+``_batch_from_dense_to_ptg`` with reusing them from the model's topology cache.
+
+Usage:
+    python scripts/benchmark_gnn_topology.py --device cuda
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarl.models.gnn import (
+    _batch_from_dense_to_ptg,
+    _BatchedTopologyCache,
+    _get_edge_index,
+)
+
+
+def benchmark(x: torch.Tensor, edge_index: torch.Tensor, cache, args) -> float:
+    def run(n_iters: int):
+        for _ in range(n_iters):
+            _batch_from_dense_to_ptg(
+                x=x, edge_index=edge_index, self_loops=False, topology_cache=cache
+            )
+
+    run(10)  # Warmup
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    run(args.iters)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--topology", default="full", choices=["full", "empty"])
+    parser.add_argument("--n-agents", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 400, 6000])
+    parser.add_argument("--features", type=int, default=18)
+    parser.add_argument("--iters", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'n_agents':>8} {'batch_size':>10} {'uncached':>14} {'cached':>14}")
+    for n_agents in args.n_agents:
+        edge_index = _get_edge_index(
+            topology=args.topology,
+            self_loops=False,
+            n_agents=n_agents,
+            device=args.device,
+        )
+        cache = _BatchedTopologyCache(
+            edge_index=edge_index, n_agents=n_agents, max_size=len(args.batch_sizes)
+        )
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, n_agents, args.features, device=args.device)
+            uncached = benchmark(x, edge_index, None, args)
+            cached = benchmark(x, edge_index, cache, args)
+            print(
+                f"{n_agents:>8} {batch_size:>10} {uncached * 1e6:11.1f} us "
+                f"{cached * 1e6:11.1f} us (x{uncached / cached:.2f})"
+            )
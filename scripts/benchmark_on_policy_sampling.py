@@ -0,0 +1,94 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Benchmark of the on-policy minibatch sampling overhead.
+
+Compares the default on-policy buffer (one ``SamplerWithoutReplacement`` gather per minibatch)
+with the :class:`~benchmarl.algorithms.replay_buffer.EpochTensorDictReplayBuffer`
+(one gather per epoch and minibatches as views).
+The default sizes match the on-policy defaults of ``base_experiment.yaml``.
+
+Usage:
+    python scripts/benchmark_on_policy_sampling.py --device cuda
+"""
+
+import argparse
+import time
+
+import torch
+from tensordict import TensorDict
+from torchrl.data import LazyTensorStorage, TensorDictReplayBuffer
+from torchrl.data.replay_buffers import SamplerWithoutReplacement
+
+from benchmarl.algorithms.replay_buffer import EpochTensorDictReplayBuffer
+
+
+def make_batch(frames: int, n_agents: int, obs_size: int, device: str):
+    return TensorDict(
+        {
+            "agents": TensorDict(
+                {
+                    "observation": torch.randn(frames, n_agents, obs_size),
+                    "action": torch.randn(frames, n_agents, 2),
+                    "sample_log_prob": torch.randn(frames, n_agents),
+                    "advantage": torch.randn(frames, n_agents, 1),
+                    "value_target": torch.randn(frames, n_agents, 1),
+                },
+                batch_size=[frames, n_agents],
+            ),
+        },
+        batch_size=[frames],
+        device=device,
+    )
+
+
+def benchmark(buffer_class, batch, args) -> float:
+    buffer = buffer_class(
+        storage=LazyTensorStorage(args.frames, device=args.device),
+        sampler=SamplerWithoutReplacement(),
+        batch_size=args.minibatch_size,
+    )
+    buffer.extend(batch)
+    n_minibatches = -(-args.frames // args.minibatch_size)
+
+    def run_epochs(n_epochs: int):
+        for _ in range(n_epochs):
+            for _ in range(n_minibatches):
+                buffer.sample().to(args.device)
+
+    run_epochs(1)  # Warmup
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    run_epochs(args.epochs)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / (args.epochs * n_minibatches)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--frames", type=int, default=6000)
+    parser.add_argument("--minibatch-size", type=int, default=400)
+    parser.add_argument("--epochs", type=int, default=45)
+    parser.add_argument("--n-agents", type=int, default=4)
+    parser.add_argument("--obs-size", type=int, default=18)
+    args = parser.parse_args()
+
+    batch = make_batch(args.frames, args.n_agents, args.obs_size, args.device)
+    results = {
+        "SamplerWithoutReplacement": benchmark(TensorDictReplayBuffer, batch, args),
+        "EpochTensorDictReplayBuffer": benchmark(
+            EpochTensorDictReplayBuffer, batch, args
+        ),
+    }
+    baseline = results["SamplerWithoutReplacement"]
+    for name, time_per_sample in results.items():
+        print(
+            f"{name:>30}: {time_per_sample * 1e6:9.1f} us/minibatch "
+            f"(x{baseline / time_per_sample:.2f})"
+        )
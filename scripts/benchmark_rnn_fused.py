@@ -0,0 +1,114 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Compares the training step time of the GRU and LSTM models with and without ``fused``.
+
+For each model, runs forward and backward passes on a batch of sequences (as sampled from a recurrent replay buffer
+during training), with resets (``is_init``) at random steps, and reports the mean time of the cell loop and of the
+fused segments, together with the largest difference between their outputs.
+
+Usage:
+    python scripts/benchmark_rnn_fused.py --batch-size 32 --seq-len 600 --reset-prob 0.01
+"""
+
+import argparse
+import time
+
+import torch
+from torchrl.data.tensor_specs import Composite, Unbounded
+
+from benchmarl.models import GruConfig, LstmConfig
+
+
+def _time_training_step(model, input_td, n_iters):
+    def step():
+        model.zero_grad()
+        model(input_td.clone()).get(model.out_key).sum().backward()
+
+    step()  # Warm-up
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        step()
+    return (time.perf_counter() - start) / n_iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--models", nargs="+", default=["gru", "lstm"])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seq-len", type=int, default=600)
+    parser.add_argument("--reset-prob", type=float, default=0.01)
+    parser.add_argument("--n-agents", type=int, default=3)
+    parser.add_argument("--obs-size", type=int, default=16)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--n-layers", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--no-share-params", dest="share_params", action="store_false")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    input_spec = Composite(
+        {
+            "agents": Composite(
+                {"observation": Unbounded(shape=(args.n_agents, args.obs_size))},
+                shape=(args.n_agents,),
+            )
+        }
+    )
+    output_spec = Composite(
+        {
+            "agents": Composite(
+                {"out": Unbounded(shape=(args.n_agents, 2))},
+                shape=(args.n_agents,),
+            )
+        }
+    )
+    input_td = input_spec.expand(args.batch_size, args.seq_len).rand()
+    input_td["is_init"] = torch.rand(args.batch_size, args.seq_len, 1) < args.reset_prob
+    input_td["is_init"][:, 0] = True
+
+    print(
+        f"Batch: {args.batch_size}, sequence length: {args.seq_len}, "
+        f"reset steps: {input_td['is_init'][:, 1:].any(0).sum().item()}"
+    )
+    print(f"{'model':>6} {'loop':>11} {'fused':>11} {'speedup':>8} {'max diff':>9}")
+    for model_name in args.models:
+        config = {"gru": GruConfig, "lstm": LstmConfig}[model_name].get_from_yaml()
+        config.hidden_size = args.hidden_size
+        config.n_layers = args.n_layers
+        model_kwargs = {
+            "input_spec": input_spec,
+            "output_spec": output_spec,
+            "agent_group": "agents",
+            "input_has_agent_dim": True,
+            "n_agents": args.n_agents,
+            "centralised": False,
+            "share_params": args.share_params,
+            "device": "cpu",
+            "action_spec": None,
+        }
+        config.fused = False
+        model = config.get_model(**model_kwargs)
+        config.fused = True
+        fused_model = config.get_model(**model_kwargs)
+        fused_model.load_state_dict(model.state_dict())
+
+        with torch.no_grad():
+            max_diff = (
+                (
+                    model(input_td.clone()).get(model.out_key)
+                    - fused_model(input_td.clone()).get(fused_model.out_key)
+                )
+                .abs()
+                .max()
+                .item()
+            )
+        loop_time = _time_training_step(model, input_td, args.iters)
+        fused_time = _time_training_step(fused_model, input_td, args.iters)
+        print(
+            f"{model_name:>6} {loop_time * 1e3:>8.1f} ms {fused_time * 1e3:>8.1f} ms "
+            f"{loop_time / fused_time:>7.2f}x {max_diff:>9.1e}"
+        )
@@ -0,0 +1,148 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Compares the training step time of models without parameter sharing when agent networks run stacked or one by one.
+
+For each model and number of agents, builds the model with ``share_params=False`` (a centralised critic with a global
+input for ``mlp`` and ``cnn``, a policy for ``deepsets``), runs forward and backward passes with the agent networks
+stacked in one :func:`torch.vmap` call and looping over them, and reports the mean times together with the largest
+difference between their outputs.
+
+Usage:
+    python scripts/benchmark_stacked_agent_networks.py --models mlp cnn deepsets --n-agents 2 8 32
+"""
+
+import argparse
+import copy
+import time
+from unittest.mock import patch
+
+import torch
+
+from benchmarl.models import model_config_registry
+from benchmarl.models.common import _StackedModules
+from torch import nn
+from torchrl.data.tensor_specs import Composite, Unbounded
+
+
+def _loop_forward(self, *inputs, in_dims, out_dim):
+    outputs = []
+    for i, module in enumerate(self.__dict__["_agent_modules"]):
+        outputs.append(
+            module(
+                *[
+                    input if in_dim is None else input.select(in_dim, i)
+                    for input, in_dim in zip(inputs, in_dims)
+                ]
+            )
+        )
+    return torch.stack(outputs, dim=out_dim)
+
+
+def _unstack_agent_networks(model):
+    # One module with its own parameters per agent, as looped over before the networks were stacked
+    for stacked in model.modules():
+        if isinstance(stacked, _StackedModules):
+            agent_modules = []
+            for i in range(stacked.n_modules):
+                module = copy.deepcopy(stacked._empty_module)
+                stacked.params[i].detach().clone().apply(nn.Parameter).to_module(module)
+                agent_modules.append(module)
+            stacked.__dict__["_agent_modules"] = agent_modules
+
+
+def _get_specs(model_name, n_agents, input_has_agent_dim, obs_size):
+    if model_name == "cnn":
+        observation_shape = (8, 8, 3)
+    elif model_name == "deepsets":
+        observation_shape = (n_agents, obs_size)
+    else:
+        observation_shape = (obs_size * n_agents,)
+    if input_has_agent_dim:
+        input_spec = Composite(
+            {
+                "agents": Composite(
+                    {"observation": Unbounded(shape=(n_agents, *observation_shape))},
+                    shape=(n_agents,),
+                )
+            }
+        )
+    else:
+        # Global input
+        input_spec = Composite({"state": Unbounded(shape=observation_shape)})
+    output_spec = Composite(
+        {
+            "agents": Composite(
+                {"out": Unbounded(shape=(n_agents, 2))},
+                shape=(n_agents,),
+            )
+        }
+    )
+    return input_spec, output_spec
+
+
+def _time_training_step(model, input_td, n_iters):
+    def step():
+        model.zero_grad()
+        model(input_td.clone()).get(model.out_key).sum().backward()
+
+    step()  # Warm-up
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        step()
+    return (time.perf_counter() - start) / n_iters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--models", nargs="+", default=["mlp", "cnn", "deepsets"])
+    parser.add_argument("--n-agents", type=int, nargs="+", default=[2, 8, 32])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--obs-size", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print(f"Batch: {args.batch_size}")
+    print(
+        f"{'model':>9} {'agents':>6} {'loop':>11} {'stacked':>11} {'speedup':>8} {'max diff':>9}"
+    )
+    for model_name in args.models:
+        input_has_agent_dim = model_name == "deepsets"
+        for n_agents in args.n_agents:
+            input_spec, output_spec = _get_specs(
+                model_name, n_agents, input_has_agent_dim, args.obs_size
+            )
+            model = (
+                model_config_registry[model_name]
+                .get_from_yaml()
+                .get_model(
+                    input_spec=input_spec,
+                    output_spec=output_spec,
+                    agent_group="agents",
+                    input_has_agent_dim=input_has_agent_dim,
+                    n_agents=n_agents,
+                    centralised=not input_has_agent_dim,
+                    share_params=False,
+                    device="cpu",
+                    action_spec=None,
+                )
+            )
+            input_td = input_spec.expand(args.batch_size).rand()
+            _unstack_agent_networks(model)
+
+            with torch.no_grad():
+                output = model(input_td.clone()).get(model.out_key)
+                with patch.object(_StackedModules, "forward", _loop_forward):
+                    loop_output = model(input_td.clone()).get(model.out_key)
+            max_diff = (output - loop_output).abs().max().item()
+            stacked_time = _time_training_step(model, input_td, args.iters)
+            with patch.object(_StackedModules, "forward", _loop_forward):
+                loop_time = _time_training_step(model, input_td, args.iters)
+            print(
+                f"{model_name:>9} {n_agents:>6} {loop_time * 1e3:>8.2f} ms {stacked_time * 1e3:>8.2f} ms "
+                f"{loop_time / stacked_time:>7.2f}x {max_diff:>9.1e}"
+            )
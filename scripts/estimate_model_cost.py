@@ -0,0 +1,87 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Estimates and compares the compute cost of model configurations on a task.
+
+For each model config (a name of a config in ``benchmarl/conf/model``), builds the policy model of the first agent
+group of the task and reports its parameters, the FLOPs and activation memory of one forward pass, and the measured
+CPU latency and throughput at several batch sizes (see :meth:`benchmarl.models.ModelConfig.estimate_cost`).
+
+Usage:
+    python scripts/estimate_model_cost.py --task vmas/navigation --models layers/mlp layers/gnn multi_gnn_stack
+"""
+
+import argparse
+
+from hydra import compose, initialize
+from torchrl.data.tensor_specs import Composite, Unbounded
+
+from benchmarl.hydra_config import (
+    load_model_config_from_hydra,
+    load_task_config_from_hydra,
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--task", default="vmas/navigation")
+    parser.add_argument("--models", nargs="+", default=["layers/mlp", "layers/gnn"])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 64, 1024])
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--no-share-params", dest="share_params", action="store_false")
+    args = parser.parse_args()
+
+    with initialize(version_base=None, config_path="../benchmarl/conf"):
+        cfgs = {
+            model: compose(
+                config_name="config",
+                overrides=["algorithm=mappo", f"task={args.task}", f"model={model}"],
+            )
+            for model in args.models
+        }
+    task = load_task_config_from_hydra(next(iter(cfgs.values())).task, args.task)
+    env = task.get_env_fun(num_envs=1, continuous_actions=True, seed=0, device="cpu")()
+    group, agents = next(iter(task.group_map(env).items()))
+    n_agents = len(agents)
+    input_spec = Composite({group: task.observation_spec(env)[group]})
+    action_spec = task.action_spec(env)
+    output_spec = Composite(
+        {
+            group: Composite(
+                {
+                    "out": Unbounded(
+                        shape=(n_agents, action_spec[group, "action"].shape[-1])
+                    )
+                },
+                shape=(n_agents,),
+            )
+        }
+    )
+    env.close()
+
+    print(f"Task: {args.task}, group: {group}, n_agents: {n_agents}")
+    print(
+        f"{'model':>20} {'params':>10} {'batch':>6} {'MFLOPs':>10} {'act. KiB':>10} "
+        f"{'latency':>11} {'samples/s':>11}"
+    )
+    for model, cfg in cfgs.items():
+        cost = load_model_config_from_hydra(cfg.model).estimate_cost(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=group,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=args.share_params,
+            action_spec=action_spec,
+            batch_sizes=args.batch_sizes,
+            n_iters=args.iters,
+        )
+        for batch_size, batch_cost in cost["batch_sizes"].items():
+            print(
+                f"{model:>20} {cost['params']:>10,} {batch_size:>6} "
+                f"{batch_cost['flops'] / 1e6:>10.2f} {batch_cost['activation_bytes'] / 1024:>10.1f} "
+                f"{batch_cost['latency'] * 1e3:>8.2f} ms {batch_cost['throughput']:>11,.0f}"
+            )
@@ -0,0 +1,136 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+"""
+Measures the memory taken by the hidden states of recurrent policies in the collected data.
+
+For each model config (a name of a config in ``benchmarl/conf/model``), collects a batch on the task with the policy
+of the first agent group and reports the bytes per frame of the hidden states and of the rest of the frame, when the
+hidden states are kept at the root and in ``next`` in float32 (as in ``env.rollout``) and when they are stored once
+per frame (``store_hidden_state``) in each ``hidden_state_storage_dtype``.
+
+Usage:
+    python scripts/measure_rnn_state_storage.py --task vmas/balance --models gru_balanced lstm_balanced
+"""
+
+import argparse
+
+import torch
+from hydra import compose, initialize
+from torchrl.data.tensor_specs import Composite
+
+from benchmarl.hydra_config import (
+    load_model_config_from_hydra,
+    load_task_config_from_hydra,
+)
+from benchmarl.models.common import _stored_state_name
+from benchmarl.utils import _add_rnn_transforms
+
+
+def _bytes_per_frame(tensordict, keys):
+    return sum(
+        tensordict.get(key).element_size() * tensordict.get(key)[0].numel()
+        for key in keys
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--task", default="vmas/balance")
+    parser.add_argument(
+        "--models", nargs="+", default=["gru_balanced", "lstm_balanced"]
+    )
+    parser.add_argument(
+        "--dtypes", nargs="+", default=["float32", "bfloat16", "float16"]
+    )
+    parser.add_argument("--n-envs", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=100)
+    args = parser.parse_args()
+
+    with initialize(version_base=None, config_path="../benchmarl/conf"):
+        cfgs = {
+            model: compose(
+                config_name="config",
+                overrides=["algorithm=mappo", f"task={args.task}", f"model={model}"],
+            )
+            for model in args.models
+        }
+    task = load_task_config_from_hydra(next(iter(cfgs.values())).task, args.task)
+
+    print(f"Task: {args.task}, frames: {args.frames} x {args.n_envs} envs")
+    print(
+        f"{'model':>14} {'states':>18} {'state B/frame':>14} {'rest B/frame':>13} "
+        f"{'state share':>12} {'batch MiB':>10}"
+    )
+    for model, cfg in cfgs.items():
+        for dtype in [None, *args.dtypes]:
+            model_config = load_model_config_from_hydra(cfg.model)
+            for layer_config in getattr(model_config, "model_configs", [model_config]):
+                if hasattr(layer_config, "store_hidden_state"):
+                    layer_config.store_hidden_state = dtype is not None
+                    layer_config.hidden_state_storage_dtype = dtype or "float32"
+            env_fun = task.get_env_fun(
+                num_envs=args.n_envs, continuous_actions=True, seed=0, device="cpu"
+            )
+            env = env_fun()
+            group_map = task.group_map(env)
+            observation_spec = task.observation_spec(env)
+            action_spec = task.action_spec(env)
+            env.close()
+            env = _add_rnn_transforms(env_fun, group_map, model_config)()
+            group, agents = next(iter(group_map.items()))
+            n_agents = len(agents)
+            state_spec = model_config._get_model_state_spec_inner(group=group)
+            policy = model_config.get_model(
+                input_spec=Composite({group: observation_spec[group]}),
+                output_spec=Composite(
+                    {
+                        group: Composite(
+                            {"action": action_spec[group, "action"]},
+                            shape=(n_agents,),
+                        )
+                    }
+                ),
+                agent_group=group,
+                input_has_agent_dim=True,
+                n_agents=n_agents,
+                centralised=False,
+                share_params=True,
+                device="cpu",
+                action_spec=action_spec,
+            )
+            with torch.no_grad():
+                batch = env.rollout(
+                    args.frames, policy=policy, break_when_any_done=False
+                )
+            env.close()
+
+            if dtype is None:
+                # The states are kept at the root and in next, as in env.rollout
+                state_keys = [
+                    (*prefix, group, key)
+                    for prefix in [(), ("next",)]
+                    for key in state_spec.keys()
+                ]
+            else:
+                # Collectors drop the private states, only the stored ones are kept
+                batch = batch.exclude(
+                    *[
+                        (*prefix, group, key)
+                        for prefix in [(), ("next",)]
+                        for key in state_spec.keys()
+                    ]
+                )
+                state_keys = [
+                    (group, _stored_state_name(key)) for key in state_spec.keys()
+                ]
+            batch = batch.reshape(-1)
+            state_bytes = _bytes_per_frame(batch, state_keys)
+            total_bytes = _bytes_per_frame(batch, batch.keys(True, True))
+            print(
+                f"{model:>14} {'root+next float32' if dtype is None else f'stored {dtype}':>18} "
+                f"{state_bytes:>14,} {total_bytes - state_bytes:>13,} "
+                f"{state_bytes / total_bytes:>11.1%} {total_bytes * batch.shape[0] / 2 ** 20:>10.2f}"
+            )
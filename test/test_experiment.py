@@ -0,0 +1,115 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+#
+
+import pytest
+import torch
+from benchmarl.algorithms import MappoConfig
+from benchmarl.environments import VmasTask
+from benchmarl.experiment import Experiment
+from tensordict import TensorDict
+from torch import nn
+
+from utils import _has_vmas
+
+
+class ScalarRecorder:
+    """Logger recording the scalars it is given."""
+
+    def __init__(self):
+        self.scalars = []
+
+    def log_scalar(self, name, value, step=None):
+        self.scalars.append((name, value, step))
+
+
+@pytest.fixture
+def experiment(experiment_config, mlp_sequence_config) -> Experiment:
+    experiment_config.loggers = []
+    experiment_config.create_json = False
+    experiment = Experiment(
+        algorithm_config=MappoConfig.get_from_yaml(),
+        model_config=mlp_sequence_config,
+        seed=0,
+        config=experiment_config,
+        task=VmasTask.BALANCE.get_from_yaml(),
+    )
+    experiment.logger.loggers = [ScalarRecorder()]
+    return experiment
+
+
+def _grad_clip_reference(params, clip_grad_norm, clip_grad_val) -> float:
+    """Gradient clipping without foreach kernels, as done before ``Experiment._grad_clip`` used them."""
+    if clip_grad_norm and clip_grad_val is not None:
+        total_norm = torch.nn.utils.clip_grad_norm_(params, clip_grad_val)
+    else:
+        norms = [torch.linalg.vector_norm(p.grad, 2.0) for p in params]
+        total_norm = torch.linalg.vector_norm(torch.stack(norms), 2.0)
+        if clip_grad_val is not None:
+            torch.nn.utils.clip_grad_value_(params, clip_grad_val)
+    return float(total_norm)
+
+
+@pytest.mark.skipif(not _has_vmas, reason="VMAS not found")
+class TestExperiment:
+    @pytest.mark.parametrize("clip_grad_norm", [True, False])
+    @pytest.mark.parametrize("clip_grad_val", [None, 0.1])
+    def test_grad_clip(self, experiment, clip_grad_norm, clip_grad_val):
+        experiment.config.clip_grad_norm = clip_grad_norm
+        experiment.config.clip_grad_val = clip_grad_val
+
+        torch.manual_seed(0)
+        model = nn.Sequential(nn.Linear(4, 8), nn.Tanh(), nn.Linear(8, 2))
+        reference_model = nn.Sequential(nn.Linear(4, 8), nn.Tanh(), nn.Linear(8, 2))
+        reference_model.load_state_dict(model.state_dict())
+        input = torch.randn(16, 4)
+        for m in (model, reference_model):
+            (m(input) ** 2).sum().backward()
+
+        grad_norm = experiment._grad_clip(torch.optim.Adam(model.parameters(), lr=1e-3))
+        reference_grad_norm = _grad_clip_reference(
+            list(reference_model.parameters()), clip_grad_norm, clip_grad_val
+        )
+        assert grad_norm.item() == pytest.approx(reference_grad_norm, rel=1e-5)
+        for param, reference_param in zip(
+            model.parameters(), reference_model.parameters()
+        ):
+            torch.testing.assert_close(param.grad, reference_param.grad)
+
+        # The logged value is the norm before clipping
+        experiment.logger.log_training(
+            "agents", TensorDict({"grad_norm_loss_objective": grad_norm}, []), step=0
+        )
+        experiment.logger.commit()
+        ((name, value, step),) = experiment.logger.loggers[0].scalars
+        assert name == "train_agents_grad_norm_loss_objective"
+        assert value == pytest.approx(reference_grad_norm, rel=1e-5)
+
+    def test_logger_commit(self, experiment):
+        logger = experiment.logger
+        logger.log({"a": torch.tensor(1.5), "b": 2.0}, step=0)
+        logger.log(
+            {"c": torch.tensor([0.25], dtype=torch.float64), "d": torch.tensor(3.0)},
+            step=1,
+        )
+        assert not len(logger.loggers[0].scalars)
+
+        logger.commit()
+        logger.commit()
+        scalars = logger.loggers[0].scalars
+        assert scalars == [("a", 1.5, 0), ("b", 2.0, 0), ("c", 0.25, 1), ("d", 3.0, 1)]
+        assert all(type(value) is float for _, value, _ in scalars)
+
+    def test_logger_flush_values(self, experiment):
+        logger = experiment.logger
+        logger.log({"a": torch.tensor(1.5)}, step=0)
+        assert logger.flush(torch.tensor(2.5), torch.tensor([3.0])) == [2.5, 3.0]
+        assert logger.loggers[0].scalars == [("a", 1.5, 0)]
+
+        # Values are returned without loggers as well
+        logger.loggers = []
+        logger.log({"a": torch.tensor(1.5)}, step=1)
+        assert logger.flush(torch.tensor(2.5)) == [2.5]
+        assert not len(logger._pending_logs)
@@ -4,19 +4,51 @@
 #  LICENSE file in the root directory of this source tree.
 #
 import contextlib
+import copy
 from typing import List
 
 import pytest
 import torch
 import torch_geometric.nn
 
+import benchmarl.models.gnn
 from benchmarl.hydra_config import load_model_config_from_hydra
-from benchmarl.models import GnnConfig, model_config_registry
+from benchmarl.models import (
+    AttentionGnnConfig,
+    GnnConfig,
+    model_config_registry,
+    MlpConfig,
+)
 
-from benchmarl.models.common import output_has_agent_dim, SequenceModelConfig
+from benchmarl.models.common import (
+    _StackedModules,
+    _stored_state_name,
+    AGENT_MASK_KEY,
+    output_has_agent_dim,
+    SequenceModelConfig,
+)
+from benchmarl.models.gnn import (
+    _batch_from_dense_to_ptg,
+    _cell_list_radius_graph,
+    _dense_edge_attr,
+    _get_edge_index,
+    _neighbours_to_edge_index,
+    _pairwise_radius_graph,
+    _radius_graph,
+    GRAPH_CACHE_KEY,
+    STORED_GRAPH_KEY,
+)
+from benchmarl.models.gru import _segment_boundaries
+from benchmarl.utils import (
+    _burn_in_states,
+    _get_sequence_windows,
+    SEQUENCE_PADDING_KEY,
+)
 from hydra import compose, initialize
+from tensordict import TensorDict
 
 from torchrl.data.tensor_specs import Composite, Unbounded
+from torchrl.modules import MLP
 
 
 def _get_input_and_output_specs(
@@ -286,6 +318,603 @@ def test_share_params_between_models(
         assert torch.eq(param, second_param).all()
 
 
+@pytest.mark.parametrize("share_params", [True, False])
+@pytest.mark.parametrize(
+    "model_name", [*model_config_registry.keys(), ["cnn", "gru", "mlp"]]
+)
+def test_estimate_cost(share_params, model_name, n_agents=3):
+    torch.manual_seed(0)
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=False,
+        input_has_agent_dim=True,
+        model_name=model_name if isinstance(model_name, str) else model_name[0],
+        share_params=share_params,
+        n_agents=n_agents,
+    )
+    if isinstance(model_name, List):
+        config = SequenceModelConfig(
+            model_configs=[
+                model_config_registry[config].get_from_yaml() for config in model_name
+            ],
+            intermediate_sizes=[4] * (len(model_name) - 1),
+        )
+    else:
+        config = model_config_registry[model_name].get_from_yaml()
+    model_kwargs = {
+        "input_spec": input_spec,
+        "output_spec": output_spec,
+        "share_params": share_params,
+        "centralised": False,
+        "input_has_agent_dim": True,
+        "n_agents": n_agents,
+        "agent_group": "agents",
+        "action_spec": None,
+    }
+    cost = config.estimate_cost(**model_kwargs, batch_sizes=[1, 4], n_iters=2)
+
+    model = config.get_model(**model_kwargs, device="cpu")
+    assert cost["params"] == sum(p.numel() for p in model.parameters())
+    assert cost["batch_sizes"].keys() == {1, 4}
+    # All models process the samples of a batch independently
+    assert cost["batch_sizes"][1]["flops"] > 0
+    assert cost["batch_sizes"][4]["flops"] == 4 * cost["batch_sizes"][1]["flops"]
+    assert cost["batch_sizes"][4]["activation_bytes"] > 0
+    for batch_size, batch_cost in cost["batch_sizes"].items():
+        assert batch_cost["latency"] > 0
+        assert batch_cost["throughput"] == pytest.approx(
+            batch_size / batch_cost["latency"]
+        )
+
+
+@pytest.mark.parametrize(
+    "model_name",
+    [*model_config_registry.keys(), ["gnn", "mlp"], ["attentiongnn", "gru"]],
+)
+@pytest.mark.parametrize("centralised", [True, False])
+@pytest.mark.parametrize("share_params", [True, False])
+@pytest.mark.parametrize("batch_size", [(), (2,), (3, 2)])
+def test_agent_mask(
+    model_name, centralised, share_params, batch_size, n_agents=3, n_padded=2
+):
+    torch.manual_seed(0)
+    layer_names = model_name if isinstance(model_name, list) else [model_name]
+    is_rnn = any(name in ("gru", "lstm") for name in layer_names)
+    if is_rnn and centralised and len(batch_size) < 2:
+        pytest.skip("Centralised recurrent critics are only run on sequences")
+
+    def get_model(n_agents, agent_mask):
+        input_spec, output_spec = _get_input_and_output_specs(
+            centralised=centralised,
+            input_has_agent_dim=True,
+            model_name=layer_names[0],
+            share_params=share_params,
+            n_agents=n_agents,
+        )
+        if agent_mask:
+            input_spec["agents", AGENT_MASK_KEY] = Unbounded(
+                shape=(n_agents,), dtype=torch.bool
+            )
+        if len(layer_names) > 1:
+            config = SequenceModelConfig(
+                model_configs=[
+                    model_config_registry[name].get_from_yaml() for name in layer_names
+                ],
+                intermediate_sizes=[4] * (len(layer_names) - 1),
+            )
+        else:
+            config = model_config_registry[layer_names[0]].get_from_yaml()
+        if centralised:
+            config.is_critic = True
+        model = config.get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            share_params=share_params,
+            centralised=centralised,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            device="cpu",
+            agent_group="agents",
+            action_spec=None,
+        )
+        data_spec = input_spec.clone()
+        if is_rnn and len(batch_size) < 2:
+            # Collection steps take the hidden states as input
+            for key, spec in config.get_model_state_spec().items():
+                data_spec["agents", key] = spec.expand(n_agents, *spec.shape)
+        return model, data_spec
+
+    model, input_spec = get_model(n_agents + n_padded, agent_mask=True)
+    assert ("agents", AGENT_MASK_KEY) in model.in_keys
+    input_td = input_spec.expand(batch_size).rand()
+    if is_rnn:
+        input_td["is_init"] = torch.randint(0, 2, (*batch_size, 1), dtype=torch.bool)
+    agent_mask = torch.zeros(*batch_size, n_agents + n_padded, dtype=torch.bool)
+    agent_mask[..., :n_agents] = True
+    input_td["agents", AGENT_MASK_KEY] = agent_mask
+    output = model(input_td.clone()).get(model.out_key)
+
+    # The inputs of the padded agents do not change the outputs
+    padded_td = input_td.clone()
+    padded_td["agents"][..., n_agents:] = input_spec["agents"][..., n_agents:].rand(
+        batch_size
+    )
+    padded_td["agents", AGENT_MASK_KEY] = agent_mask
+    torch.testing.assert_close(model(padded_td).get(model.out_key), output)
+
+    if output_has_agent_dim(share_params=share_params, centralised=centralised):
+        assert (output[..., n_agents:, :] == 0).all()
+        output = output[..., :n_agents, :]
+
+    if share_params and not (
+        centralised and layer_names[0] in ("mlp", "cnn", "gru", "lstm")
+    ):
+        # Models with shared parameters that do not depend on the number of agents
+        # (not concatenating the inputs of all agents) give the outputs of the model without the padded agents
+        unpadded_model, _ = get_model(n_agents, agent_mask=False)
+        unpadded_model.load_state_dict(model.state_dict())
+        unpadded_td = TensorDict(
+            {"agents": input_td["agents"][..., :n_agents].exclude(AGENT_MASK_KEY)},
+            batch_size=batch_size,
+        )
+        if is_rnn:
+            unpadded_td["is_init"] = input_td["is_init"]
+        torch.testing.assert_close(
+            unpadded_model(unpadded_td).get(unpadded_model.out_key), output
+        )
+
+
+@pytest.mark.parametrize("model_name", ["mlp", "cnn", "deepsets"])
+@pytest.mark.parametrize("input_has_agent_dim", [True, False])
+@pytest.mark.parametrize("batch_size", [(), (2,), (3, 2)])
+def test_stacked_agent_networks(
+    model_name, input_has_agent_dim, batch_size, monkeypatch, n_agents=3
+):
+    if model_name != "deepsets" and input_has_agent_dim:
+        pytest.skip("Multi-agent inputs are processed by torchrl multi-agent networks")
+    torch.manual_seed(0)
+    # Policies with agent inputs and critics with global inputs
+    centralised = not input_has_agent_dim
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=centralised,
+        input_has_agent_dim=input_has_agent_dim,
+        model_name=model_name,
+        share_params=False,
+        n_agents=n_agents,
+    )
+    model = (
+        model_config_registry[model_name]
+        .get_from_yaml()
+        .get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            share_params=False,
+            centralised=centralised,
+            input_has_agent_dim=input_has_agent_dim,
+            n_agents=n_agents,
+            device="cpu",
+            agent_group="agents",
+            action_spec=None,
+        )
+    )
+    assert any(isinstance(module, _StackedModules) for module in model.modules())
+    input_td = input_spec.expand(batch_size).rand()
+    output = model(input_td.clone()).get(model.out_key)
+
+    def loop_forward(self, *inputs, in_dims, out_dim):
+        outputs = []
+        for i in range(self.n_modules):
+            with self.params[i].to_module(self._empty_module):
+                outputs.append(
+                    self._empty_module(
+                        *[
+                            input if in_dim is None else input.select(in_dim, i)
+                            for input, in_dim in zip(inputs, in_dims)
+                        ]
+                    )
+                )
+        return torch.stack(outputs, dim=out_dim)
+
+    # Running the agent networks one by one gives the same outputs
+    monkeypatch.setattr(_StackedModules, "forward", loop_forward)
+    torch.testing.assert_close(model(input_td.clone()).get(model.out_key), output)
+
+
+def test_stacked_agent_networks_load_state_dict(n_agents=3, in_features=2):
+    # Non-shared centralised Mlp critics have always stored one MLP per agent in a ModuleList,
+    # the state_dicts saved in this layout load in the stacked networks
+    torch.manual_seed(0)
+    config = MlpConfig.get_from_yaml()
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=True,
+        input_has_agent_dim=False,
+        model_name="mlp",
+        share_params=False,
+        n_agents=n_agents,
+        in_features=in_features,
+    )
+    model = config.get_model(
+        input_spec=input_spec,
+        output_spec=output_spec,
+        share_params=False,
+        centralised=True,
+        input_has_agent_dim=False,
+        n_agents=n_agents,
+        device="cpu",
+        agent_group="agents",
+        action_spec=None,
+    )
+    agent_mlps = torch.nn.ModuleList(
+        [
+            MLP(
+                in_features=model.input_features,
+                out_features=model.output_features,
+                num_cells=config.num_cells,
+                layer_class=config.layer_class,
+                activation_class=config.activation_class,
+            )
+            for _ in range(n_agents)
+        ]
+    )
+    state_dict = {f"mlp.{key}": value for key, value in agent_mlps.state_dict().items()}
+    assert "mlp.0.0.weight" in state_dict
+    assert "mlp.params.0.weight" in model.state_dict()
+    model.load_state_dict(state_dict)
+    # The stacked state_dict loads back
+    model.load_state_dict(model.state_dict())
+
+    input_td = input_spec.expand(4).rand()
+    input = torch.cat([input_td.get(key) for key in model.in_keys], dim=-1)
+    torch.testing.assert_close(
+        model(input_td).get(model.out_key),
+        torch.stack([mlp(input) for mlp in agent_mlps], dim=-2),
+    )
+
+
+def test_stacked_agent_networks_buffers(n_agents=3):
+    # Batch norm running statistics cannot be updated under vmap
+    config = MlpConfig.get_from_yaml()
+    config.num_cells = [8, 8]
+    config.norm_class = torch.nn.BatchNorm1d
+    config.norm_kwargs = {"num_features": 8}
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=True,
+        input_has_agent_dim=False,
+        model_name="mlp",
+        share_params=False,
+        n_agents=n_agents,
+    )
+    with pytest.raises(ValueError, match="buffers"):
+        config.get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            share_params=False,
+            centralised=True,
+            input_has_agent_dim=False,
+            n_agents=n_agents,
+            device="cpu",
+            agent_group="agents",
+            action_spec=None,
+        )
+
+
+@pytest.mark.parametrize("model_name", ["gru", "lstm"])
+@pytest.mark.parametrize("n_layers", [1, 2])
+@pytest.mark.parametrize("share_params", [True, False])
+@pytest.mark.parametrize(
+    "centralised,input_has_agent_dim", [(False, True), (True, True), (True, False)]
+)
+@pytest.mark.parametrize("batch_size", [(4,), (4, 10)])
+def test_rnn_fused(
+    model_name,
+    n_layers,
+    share_params,
+    centralised,
+    input_has_agent_dim,
+    batch_size,
+    monkeypatch,
+    n_agents=3,
+):
+    if centralised and len(batch_size) == 1:
+        pytest.skip("Centralised recurrent critics are only run on sequences")
+    torch.manual_seed(0)
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=centralised,
+        input_has_agent_dim=input_has_agent_dim,
+        model_name=model_name,
+        share_params=share_params,
+        n_agents=n_agents,
+    )
+    config = model_config_registry[model_name].get_from_yaml()
+    config.n_layers = n_layers
+    config.hidden_size = 8
+    config.is_critic = centralised
+    model_kwargs = {
+        "input_spec": input_spec,
+        "output_spec": output_spec,
+        "share_params": share_params,
+        "centralised": centralised,
+        "input_has_agent_dim": input_has_agent_dim,
+        "n_agents": n_agents,
+        "device": "cpu",
+        "agent_group": "agents",
+        "action_spec": None,
+    }
+    model = config.get_model(**model_kwargs)
+    config.fused = True
+    fused_model = config.get_model(**model_kwargs)
+    fused_model.load_state_dict(model.state_dict())
+
+    input_td = input_spec.expand(batch_size).rand()
+    input_td["is_init"] = torch.rand(*batch_size, 1) < 0.2
+    if len(batch_size) == 1:
+        for key, spec in config.get_model_state_spec().items():
+            input_td["agents", key] = torch.randn(*batch_size, n_agents, *spec.shape)
+
+    # The resets are read from the device once per forward pass, also when agents are looped over
+    n_boundaries_calls = 0
+
+    def segment_boundaries(is_init):
+        nonlocal n_boundaries_calls
+        n_boundaries_calls += 1
+        return _segment_boundaries(is_init)
+
+    monkeypatch.setattr("benchmarl.models.gru._segment_boundaries", segment_boundaries)
+    monkeypatch.setattr("benchmarl.models.lstm._segment_boundaries", segment_boundaries)
+
+    output = model(input_td.clone())
+    fused_output = fused_model(input_td.clone())
+    assert n_boundaries_calls <= 1
+    for key in output.keys(True, True):
+        torch.testing.assert_close(output[key], fused_output[key])
+    fused_output.get(fused_model.out_key).sum().backward()
+    assert all(param.grad is not None for param in fused_model.parameters())
+
+
+@pytest.mark.parametrize("model_name", ["gru", "lstm"])
+@pytest.mark.parametrize("burn_in", [0, 4, 8])
+def test_rnn_sequence_windows(
+    model_name, burn_in, n_agents=3, sequence_length=12, window_length=4
+):
+    torch.manual_seed(0)
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=False,
+        input_has_agent_dim=True,
+        model_name=model_name,
+        share_params=False,
+        n_agents=n_agents,
+    )
+    config = model_config_registry[model_name].get_from_yaml()
+    config.hidden_size = 8
+    config.n_layers = 2
+    model = config.get_model(
+        input_spec=input_spec,
+        output_spec=output_spec,
+        share_params=False,
+        centralised=False,
+        input_has_agent_dim=True,
+        n_agents=n_agents,
+        device="cpu",
+        agent_group="agents",
+        action_spec=None,
+    )
+    input_td = input_spec.expand(2, sequence_length).rand()
+    input_td["is_init"] = torch.rand(2, sequence_length, 1) < 0.15
+    output = model(input_td.clone()).get(model.out_key)
+
+    windows = _get_sequence_windows(input_td, window_length, burn_in)
+    assert windows.shape == (6, burn_in + window_length)
+    # Burn-in: the model is stepped as in collection to get the initial hidden states
+    state_spec = config._get_model_state_spec_inner(group="agents")
+    state = state_spec.expand(6, n_agents, *state_spec.shape).zero()
+    with torch.no_grad():
+        state = _burn_in_states(model, windows, state, group="agents", burn_in=burn_in)
+    windows = windows[:, burn_in:].exclude(SEQUENCE_PADDING_KEY)
+    # Windows start from the hidden states after the burn-in, given under the public keys
+    state = state.unsqueeze(1).expand(6, window_length, *state.shape[1:])
+    for key, value in state.items():
+        windows.set(("agents", _stored_state_name(key)), value)
+    windows_output = (
+        model(windows).get(model.out_key).reshape(2, sequence_length, *output.shape[2:])
+    )
+
+    if burn_in == 8:
+        # The burn-in covers the whole history of the windows
+        torch.testing.assert_close(windows_output, output)
+    else:
+        # Only the first window starts from the hidden states of the whole sequences
+        torch.testing.assert_close(
+            windows_output[:, :window_length], output[:, :window_length]
+        )
+
+
+@pytest.mark.parametrize("pad_last_window", [True, False])
+@pytest.mark.parametrize("burn_in", [0, 2])
+def test_sequence_windows_last_window(
+    pad_last_window, burn_in, sequence_length=10, window_length=4
+):
+    sequences = TensorDict(
+        {
+            "step": torch.arange(sequence_length).expand(2, sequence_length),
+            "is_init": torch.zeros(2, sequence_length, 1, dtype=torch.bool),
+        },
+        batch_size=(2, sequence_length),
+    )
+    windows = _get_sequence_windows(
+        sequences, window_length, burn_in, pad_last_window=pad_last_window
+    )
+    assert windows.shape == (6, burn_in + window_length)
+    padding = windows.get(
+        SEQUENCE_PADDING_KEY, torch.zeros(windows.shape, dtype=torch.bool)
+    )
+    steps = windows.get("step")[:, burn_in:]
+    if pad_last_window:
+        # Each step is in the windows once, the last window is padded after the end of the sequences
+        assert (
+            steps[~padding[:, burn_in:]] == torch.arange(sequence_length).repeat(2)
+        ).all()
+        assert padding[:, burn_in:].sum() == 2 * (3 * window_length - sequence_length)
+        assert (steps[padding[:, burn_in:]] == sequence_length - 1).all()
+    else:
+        # The last window ends with the sequences
+        assert not padding[:, burn_in:].any()
+        assert (
+            steps[2] == torch.arange(sequence_length - window_length, sequence_length)
+        ).all()
+    # Only the burn-in before the start of the sequences resets the hidden states
+    assert (
+        windows.get("is_init")[..., 0] == (padding & (windows.get("step") == 0))
+    ).all()
+
+
+@pytest.mark.parametrize("model_name", ["gru", "lstm"])
+@pytest.mark.parametrize("storage_dtype", ["float32", "bfloat16", "float64"])
+def test_rnn_store_hidden_state(
+    model_name, storage_dtype, n_agents=3, sequence_length=8, start=4
+):
+    torch.manual_seed(0)
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=False,
+        input_has_agent_dim=True,
+        model_name=model_name,
+        share_params=True,
+        n_agents=n_agents,
+    )
+    config = model_config_registry[model_name].get_from_yaml()
+    config.hidden_size = 8
+    config.store_hidden_state = True
+    config.hidden_state_storage_dtype = storage_dtype
+    model = config.get_model(
+        input_spec=input_spec,
+        output_spec=output_spec,
+        share_params=True,
+        centralised=False,
+        input_has_agent_dim=True,
+        n_agents=n_agents,
+        device="cpu",
+        agent_group="agents",
+        action_spec=None,
+    )
+    # Stored states are cast back to the dtype of the model
+    dtype = torch.float64 if storage_dtype == "float64" else torch.float32
+    model = model.to(dtype)
+    tolerance = {"atol": 1e-2, "rtol": 0} if storage_dtype == "bfloat16" else {}
+    input_td = input_spec.expand(2, sequence_length).rand().to(dtype)
+    input_td["is_init"] = torch.zeros(2, sequence_length, 1, dtype=torch.bool)
+    input_td["is_init"][:, 0] = True
+    output = model(input_td.clone()).get(model.out_key)
+
+    # Collection: the model outputs the hidden states each step starts from
+    state_spec = config._get_model_state_spec_inner(group="agents")
+    state = state_spec.expand(2, n_agents, *state_spec.shape).zero().to(dtype)
+    stored_states = []
+    with torch.no_grad():
+        for step in range(sequence_length):
+            step_td = input_td[:, step].select(*model.in_keys, strict=False)
+            step_td.get("agents").update(state)
+            step_td = model(step_td)
+            stored_states.append(
+                step_td.get("agents").select(
+                    *[_stored_state_name(key) for key in state.keys()]
+                )
+            )
+            state = step_td.get(("next", "agents")).select(*state.keys())
+    stored_states = torch.stack(stored_states, dim=1)
+    assert all(
+        value.dtype == getattr(torch, storage_dtype) for value in stored_states.values()
+    )
+
+    # Training: sequences starting mid-episode start from the stored hidden states
+    sequences = input_td[:, start:].clone()
+    sequences.get("agents").update(stored_states[:, start:])
+    sequences_output = model(sequences).get(model.out_key)
+    torch.testing.assert_close(
+        sequences_output,
+        output[:, start:],
+        **tolerance,
+    )
+
+    # Burn-in: windows of the sequences starting mid-episode start from the stored hidden states,
+    # the burn-in before the start of the sequences does not change them
+    sequences = input_td[:, start - 2 :].clone()
+    sequences.get("agents").update(stored_states[:, start - 2 :])
+    windows = _get_sequence_windows(sequences, window_length=3, burn_in=2)
+    state = windows.get("agents")[:, 0].select(*stored_states.keys())
+    state = TensorDict(
+        {
+            key: state.get(_stored_state_name(key)).to(dtype)
+            for key in state_spec.keys()
+        },
+        batch_size=state.batch_size,
+    )
+    with torch.no_grad():
+        state = _burn_in_states(model, windows, state, group="agents", burn_in=2)
+    # The two windows of each sequence start at its steps 0 and 3
+    expected_state = stored_states[:, [start - 2, start + 1]].flatten(0, 1)
+    for key in state_spec.keys():
+        torch.testing.assert_close(
+            state.get(key),
+            expected_state.get(_stored_state_name(key)).to(dtype),
+            **tolerance,
+        )
+    windows = windows[:, 2:].exclude(SEQUENCE_PADDING_KEY)
+    state = state.unsqueeze(1).expand(4, 3, *state.shape[1:])
+    for key, value in state.items():
+        windows.set(("agents", _stored_state_name(key)), value)
+    windows_output = model(windows).get(model.out_key).reshape(2, -1, *output.shape[2:])
+    torch.testing.assert_close(
+        windows_output,
+        output[:, start - 2 :],
+        **tolerance,
+    )
+
+
+@pytest.mark.parametrize("model_name", ["gru", "lstm"])
+def test_rnn_collection_batch_dims(model_name, n_agents=3):
+    # Collected steps of envs with several batch dimensions are stepped from their hidden states
+    torch.manual_seed(0)
+    input_spec, output_spec = _get_input_and_output_specs(
+        centralised=False,
+        input_has_agent_dim=True,
+        model_name=model_name,
+        share_params=True,
+        n_agents=n_agents,
+    )
+    config = model_config_registry[model_name].get_from_yaml()
+    model = config.get_model(
+        input_spec=input_spec,
+        output_spec=output_spec,
+        share_params=True,
+        centralised=False,
+        input_has_agent_dim=True,
+        n_agents=n_agents,
+        device="cpu",
+        agent_group="agents",
+        action_spec=None,
+    )
+    state_spec = config._get_model_state_spec_inner(group="agents")
+    step_td = input_spec.expand(2, 4).rand()
+    step_td["is_init"] = torch.rand(2, 4, 1) > 0.5
+    step_td.get("agents").update(
+        state_spec.expand(2, 4, n_agents, *state_spec.shape).rand()
+    )
+    keys = [model.out_key, *[("next", "agents", key) for key in state_spec.keys()]]
+    output = model(step_td.clone()).select(*keys)
+    flat_output = model(step_td.reshape(-1)).select(*keys)
+    torch.testing.assert_close(output.reshape(-1), flat_output)
+
+
+def _agent_gnns(gnn) -> List[torch.nn.Module]:
+    """The gnn of each agent of a Gnn model (a single one if parameters are shared), to run them one by one."""
+    if gnn.share_params:
+        return list(gnn.gnns)
+    agent_gnns = []
+    for i in range(gnn.n_agents):
+        agent_gnn = copy.deepcopy(gnn.gnns._empty_module)
+        gnn.gnns.params[i].to_module(agent_gnn)
+        agent_gnns.append(agent_gnn)
+    return agent_gnns
+
+
 class TestGnn:
     @pytest.mark.parametrize("batch_size", [(), (2,), (3, 2)])
     @pytest.mark.parametrize("share_params", [True, False])
@@ -386,6 +1015,1100 @@ class TestGnn:
         output = gnn(obs_input)
         assert output_spec.expand(batch_size).is_in(output)
 
+    @pytest.mark.parametrize("topology", ["full", "empty", "from_pos"])
+    @pytest.mark.parametrize("self_loops", [True, False])
+    def test_gnn_topology_cache(
+        self,
+        topology,
+        self_loops,
+        n_agents=3,
+        obs_size=4,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        gnn = GnnConfig(
+            topology=topology,
+            self_loops=self_loops,
+            gnn_class=torch_geometric.nn.GCNConv,
+            position_key="pos",
+            pos_features=2,
+            exclude_pos_from_node_features=False,
+            edge_radius=0.5,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=True,
+            device="cpu",
+            action_spec=None,
+        )
+        cache = gnn._topology_cache
+
+        # Entries created in inference mode can be used with gradients
+        with torch.inference_mode():
+            gnn(input_spec.expand(4, 2).rand())
+        for batch_size in [(4, 2), (3,), (4, 2)]:
+            obs_input = input_spec.expand(batch_size).rand()
+            output = gnn(obs_input.clone())
+            output.get((agent_goup, "out")).sum().backward()
+            # The cached topology matches the one built from scratch
+            x = obs_input.get((agent_goup, "observation"))
+            pos = obs_input.get((agent_goup, "pos"))
+            graph = _batch_from_dense_to_ptg(
+                x=torch.cat([x, pos], dim=-1),
+                edge_index=gnn.edge_index,
+                pos=pos,
+                self_loops=self_loops,
+                edge_radius=0.5,
+            )
+            cached_graph = _batch_from_dense_to_ptg(
+                x=torch.cat([x, pos], dim=-1),
+                edge_index=gnn.edge_index,
+                pos=pos,
+                self_loops=self_loops,
+                edge_radius=0.5,
+                topology_cache=cache,
+            )
+            for key in ["ptr", "batch", "edge_index", "edge_attr"]:
+                assert torch.equal(graph[key], cached_graph[key])
+        assert list(cache._cache.keys()) == [
+            (3, torch.device("cpu")),
+            (8, torch.device("cpu")),
+        ]
+
+    @pytest.mark.parametrize("pos_features", [0, 2])
+    @pytest.mark.parametrize("vel_features", [0, 2])
+    @pytest.mark.parametrize("topology", ["full", "from_pos"])
+    def test_gnn_edge_features(
+        self, pos_features, vel_features, topology, batch_size=(3, 2), n_agents=4
+    ):
+        if pos_features == 0 and (vel_features == 0 or topology == "from_pos"):
+            pytest.skip("no edge features")
+        torch.manual_seed(0)
+        x = torch.rand(*batch_size, n_agents, 3)
+        pos = torch.rand(*batch_size, n_agents, pos_features) if pos_features else None
+        vel = torch.rand(*batch_size, n_agents, vel_features) if vel_features else None
+        edge_index = _get_edge_index(
+            topology=topology, self_loops=False, n_agents=n_agents, device="cpu"
+        )
+        graph = _batch_from_dense_to_ptg(
+            x=x,
+            edge_index=edge_index,
+            self_loops=False,
+            pos=pos,
+            vel=vel,
+            edge_radius=0.8,
+        )
+
+        # Edge features are the relative position, the distance and the relative velocity
+        source, target = graph.edge_index
+        expected_edge_attr = []
+        if pos is not None:
+            expected_graph = torch_geometric.transforms.Distance(norm=False)(
+                torch_geometric.transforms.Cartesian(norm=False)(
+                    torch_geometric.data.Data(
+                        pos=pos.reshape(-1, pos_features), edge_index=graph.edge_index
+                    )
+                )
+            )
+            expected_edge_attr.append(expected_graph.edge_attr)
+        if vel is not None:
+            vel = vel.reshape(-1, vel_features)
+            expected_edge_attr.append(vel[source] - vel[target])
+        torch.testing.assert_close(
+            graph.edge_attr, torch.cat(expected_edge_attr, dim=-1)
+        )
+
+        if topology == "full":
+            # The dense edge features are the same
+            dense_edge_attr = _dense_edge_attr(
+                pos=pos if pos_features else None,
+                vel=vel.view(*batch_size, n_agents, vel_features)
+                if vel_features
+                else None,
+            ).flatten(0, -4)
+            batch = source // n_agents
+            torch.testing.assert_close(
+                dense_edge_attr[batch, target % n_agents, source % n_agents],
+                graph.edge_attr,
+            )
+
+    @pytest.mark.parametrize("pos_features", [1, 2, 3])
+    @pytest.mark.parametrize("self_loops", [True, False])
+    @pytest.mark.parametrize("max_num_neighbors", [None, 0, 2])
+    def test_radius_graph(
+        self, pos_features, self_loops, max_num_neighbors, batch_size=4, n_agents=20
+    ):
+        torch.manual_seed(0)
+        pos = torch.rand(batch_size, n_agents, pos_features)
+        edge_radius = 0.3
+
+        expected_edges = []
+        for b in range(batch_size):
+            for i in range(n_agents):
+                neighbours = [
+                    (torch.linalg.vector_norm(pos[b, j] - pos[b, i]), j)
+                    for j in range(n_agents)
+                    if (self_loops or j != i)
+                ]
+                neighbours = sorted(
+                    (dist, j) for dist, j in neighbours if dist <= edge_radius
+                )[:max_num_neighbors]
+                expected_edges += [
+                    (b * n_agents + j, b * n_agents + i)
+                    for _, j in sorted(neighbours, key=lambda n: n[1])
+                ]
+        expected_edge_index = torch.tensor(expected_edges, dtype=torch.long).view(-1, 2)
+
+        for radius_graph in [_pairwise_radius_graph, _cell_list_radius_graph]:
+            edge_index = radius_graph(
+                pos, r=edge_radius, loop=self_loops, max_num_neighbors=max_num_neighbors
+            )
+            assert torch.equal(edge_index, expected_edge_index.T)
+
+    @pytest.mark.parametrize(
+        "gnn_class", [torch_geometric.nn.GraphConv, torch_geometric.nn.GATv2Conv]
+    )
+    @pytest.mark.parametrize(
+        "gnn_kwargs", [{}, {"aggr": "max"}, {"heads": 2, "concat": False}]
+    )
+    @pytest.mark.parametrize("self_loops", [True, False])
+    @pytest.mark.parametrize("position_key", ["pos", None])
+    def test_gnn_dense(
+        self,
+        gnn_class,
+        gnn_kwargs,
+        self_loops,
+        position_key,
+        batch_size=(3, 2),
+        n_agents=4,
+        obs_size=4,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        if ("aggr" in gnn_kwargs) != (gnn_class is torch_geometric.nn.GraphConv):
+            pytest.skip("gnn_kwargs not supported by gnn_class")
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        gnn = GnnConfig(
+            topology="full",
+            self_loops=self_loops,
+            gnn_class=gnn_class,
+            gnn_kwargs=gnn_kwargs,
+            position_key=position_key,
+            pos_features=2 if position_key is not None else 0,
+            exclude_pos_from_node_features=False,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=True,
+            device="cpu",
+            action_spec=None,
+        )
+        assert gnn._dense_forward is not None
+
+        obs_input = input_spec.expand(batch_size).rand()
+        output = gnn(obs_input.clone()).get((agent_goup, "out"))
+
+        # The dense output matches the one of the sparse PyG path
+        pos = obs_input.get((agent_goup, "pos"))
+        x = torch.cat([obs_input.get((agent_goup, "observation")), pos], dim=-1)
+        graph = _batch_from_dense_to_ptg(
+            x=x,
+            edge_index=gnn.edge_index,
+            pos=pos if position_key is not None else None,
+            self_loops=self_loops,
+        )
+        forward_gnn_params = {"x": graph.x, "edge_index": graph.edge_index}
+        if position_key is not None and gnn.gnn_supports_edge_attrs:
+            forward_gnn_params["edge_attr"] = graph.edge_attr
+        sparse_output = gnn.gnns[0](**forward_gnn_params).view(output.shape)
+        torch.testing.assert_close(output, sparse_output)
+
+    @pytest.mark.parametrize(
+        "gnn_class", [torch_geometric.nn.GraphConv, torch_geometric.nn.GATv2Conv]
+    )
+    @pytest.mark.parametrize("edge_radius", [0.3, 10.0])
+    @pytest.mark.parametrize("max_num_neighbors", [None, 2])
+    @pytest.mark.parametrize("share_params", [True, False])
+    def test_gnn_dense_radius_graph(
+        self,
+        gnn_class,
+        edge_radius,
+        max_num_neighbors,
+        share_params,
+        batch_size=(3, 2),
+        n_agents=6,
+        obs_size=4,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        gnn = GnnConfig(
+            topology="from_pos",
+            self_loops=False,
+            gnn_class=gnn_class,
+            position_key="pos",
+            pos_features=2,
+            exclude_pos_from_node_features=False,
+            edge_radius=edge_radius,
+            max_num_neighbors=max_num_neighbors,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=share_params,
+            device="cpu",
+            action_spec=None,
+        )
+        n_dense_calls = 0
+        dense_forward = gnn._dense_forward
+
+        def counting_dense_forward(*args, **kwargs):
+            nonlocal n_dense_calls
+            n_dense_calls += 1
+            return dense_forward(*args, **kwargs)
+
+        gnn._dense_forward = counting_dense_forward
+
+        obs_input = input_spec.expand(batch_size).rand()
+        output = gnn(obs_input.clone()).get((agent_goup, "out"))
+        # Radius graphs with few possible edges are run densely only by graph convolutions
+        assert (n_dense_calls > 0) == (
+            gnn_class is torch_geometric.nn.GraphConv or max_num_neighbors is None
+        )
+
+        # The output matches the one of the sparse PyG path
+        pos = obs_input.get((agent_goup, "pos"))
+        x = torch.cat([obs_input.get((agent_goup, "observation")), pos], dim=-1)
+        graph = _batch_from_dense_to_ptg(
+            x=x,
+            edge_index=None,
+            pos=pos,
+            self_loops=False,
+            edge_radius=edge_radius,
+            max_num_neighbors=max_num_neighbors,
+        )
+        forward_gnn_params = {"x": graph.x, "edge_index": graph.edge_index}
+        if gnn.gnn_supports_edge_attrs:
+            forward_gnn_params["edge_attr"] = graph.edge_attr
+        sparse_outputs = [
+            agent_gnn(**forward_gnn_params).view(output.shape)
+            for agent_gnn in _agent_gnns(gnn)
+        ]
+        if share_params:
+            sparse_output = sparse_outputs[0]
+        else:
+            sparse_output = torch.stack(
+                [sparse_outputs[i][..., i, :] for i in range(n_agents)], dim=-2
+            )
+        torch.testing.assert_close(output, sparse_output)
+
+    @pytest.mark.parametrize(
+        "gnn_class",
+        [
+            torch_geometric.nn.GraphConv,
+            torch_geometric.nn.GATv2Conv,
+            torch_geometric.nn.GCNConv,
+        ],
+    )
+    def test_gnn_radius_graph_vmap(
+        self,
+        gnn_class,
+        batch_size=3,
+        n_agents=6,
+        obs_size=4,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        graph_config = {
+            "topology": "from_pos",
+            "self_loops": False,
+            "position_key": "pos",
+            "pos_features": 2,
+            "exclude_pos_from_node_features": False,
+            "edge_radius": 0.5,
+        }
+        model = GnnConfig(gnn_class=gnn_class, **graph_config).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=True,
+            device="cpu",
+            action_spec=None,
+        )
+        # Each vmapped element has a different graph, as in the value estimator of on-policy algorithms
+        obs_input = input_spec.expand(2, batch_size).rand()
+
+        def forward(td):
+            return model(td).get((agent_goup, "out"))
+
+        if gnn_class is torch_geometric.nn.GCNConv:
+            with pytest.raises(RuntimeError, match="no dense forward"):
+                torch.vmap(forward)(obs_input.clone())
+            return
+        output = torch.vmap(forward)(obs_input.clone())
+        expected_output = torch.stack([forward(td) for td in obs_input.clone()])
+        torch.testing.assert_close(output, expected_output)
+
+    @pytest.mark.parametrize(
+        "gnn_class",
+        [
+            torch_geometric.nn.GraphConv,
+            torch_geometric.nn.GATv2Conv,
+            torch_geometric.nn.GCNConv,
+        ],
+    )
+    @pytest.mark.parametrize("topology", ["full", "empty"])
+    @pytest.mark.parametrize("centralised", [True, False])
+    def test_gnn_agent_params(
+        self,
+        gnn_class,
+        topology,
+        centralised,
+        batch_size=(3, 2),
+        n_agents=4,
+        obs_size=4,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"observation": Unbounded(shape=(n_agents, obs_size))},
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        gnn = GnnConfig(
+            topology=topology,
+            self_loops=False,
+            gnn_class=gnn_class,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=centralised,
+            share_params=False,
+            device="cpu",
+            action_spec=None,
+        )
+        obs_input = input_spec.expand(batch_size).rand()
+        output = gnn(obs_input.clone()).get((agent_goup, "out"))
+        output.sum().backward()
+        for param in gnn.gnns.parameters():
+            assert param.grad is not None
+        # The state_dict only holds the stacked parameters of the agent gnns
+        assert all(key.startswith("gnns.params.") for key in gnn.state_dict().keys())
+
+        # The vmapped agent gnns match running each agent gnn on the graph
+        x = obs_input.get((agent_goup, "observation"))
+        graph = _batch_from_dense_to_ptg(
+            x=x, edge_index=gnn.edge_index, self_loops=False
+        )
+        expected_output = []
+        for i, agent_gnn in enumerate(_agent_gnns(gnn)):
+            agent_output = agent_gnn(x=graph.x, edge_index=graph.edge_index).view(
+                *batch_size, n_agents, out_features
+            )
+            expected_output.append(
+                agent_output.mean(dim=-2) if centralised else agent_output[..., i, :]
+            )
+        torch.testing.assert_close(output, torch.stack(expected_output, dim=-2))
+
+        # The state_dicts saved when the agent gnns were in a ModuleList are stacked when loaded
+        loop_state_dict = {
+            f"gnns.{i}.{name}": param[i].detach() + 1
+            for name, param in gnn.gnns.params.flatten_keys(".").items()
+            for i in range(n_agents)
+        }
+        gnn.load_state_dict(loop_state_dict)
+        for name, param in gnn.gnns.params.flatten_keys(".").items():
+            torch.testing.assert_close(
+                param.data,
+                torch.stack(
+                    [loop_state_dict[f"gnns.{i}.{name}"] for i in range(n_agents)]
+                ),
+            )
+
+    @pytest.mark.parametrize(
+        "gnn_class",
+        [
+            [torch_geometric.nn.GraphConv, torch_geometric.nn.GATv2Conv],
+            [
+                torch_geometric.nn.GraphConv,
+                torch_geometric.nn.GCNConv,
+                torch_geometric.nn.GATv2Conv,
+            ],
+        ],
+    )
+    @pytest.mark.parametrize("residual", [True, False])
+    @pytest.mark.parametrize("share_params", [True, False])
+    def test_gnn_layers(
+        self,
+        gnn_class,
+        residual,
+        share_params,
+        batch_size=(3, 2),
+        n_agents=4,
+        obs_size=4,
+        pos_size=2,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, pos_size)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        gnn = GnnConfig(
+            topology="full",
+            self_loops=False,
+            gnn_class=gnn_class,
+            gnn_kwargs=[{} for _ in gnn_class],
+            num_cells=[obs_size + pos_size] * (len(gnn_class) - 1),
+            activation_class=torch.nn.Tanh,
+            residual=residual,
+            position_key="pos",
+            pos_features=pos_size,
+            exclude_pos_from_node_features=False,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=share_params,
+            device="cpu",
+            action_spec=None,
+        )
+        obs_input = input_spec.expand(batch_size).rand()
+        output = gnn(obs_input.clone()).get((agent_goup, "out"))
+
+        # The layers match running them one after the other on the graph
+        pos = obs_input.get((agent_goup, "pos"))
+        graph = _batch_from_dense_to_ptg(
+            x=torch.cat([obs_input.get((agent_goup, "observation")), pos], dim=-1),
+            edge_index=gnn.edge_index,
+            self_loops=False,
+            pos=pos,
+        )
+        expected_output = []
+        for i, agent_gnn in enumerate(_agent_gnns(gnn)):
+            x = graph.x
+            for j, layer in enumerate(agent_gnn.layers):
+                layer_kwargs = {}
+                if isinstance(layer, torch_geometric.nn.GATv2Conv):
+                    layer_kwargs["edge_attr"] = graph.edge_attr
+                layer_output = layer(x=x, edge_index=graph.edge_index, **layer_kwargs)
+                if j < len(gnn_class) - 1:
+                    layer_output = torch.tanh(layer_output)
+                if residual and layer_output.shape == x.shape:
+                    layer_output = layer_output + x
+                x = layer_output
+            agent_output = x.view(*batch_size, n_agents, out_features)
+            expected_output.append(
+                agent_output if share_params else agent_output[..., i, :]
+            )
+        expected_output = (
+            expected_output[0] if share_params else torch.stack(expected_output, dim=-2)
+        )
+        torch.testing.assert_close(output, expected_output)
+
+    @pytest.mark.parametrize("max_num_neighbors", [None, 2])
+    def test_gnn_graph_cache(
+        self,
+        monkeypatch,
+        max_num_neighbors,
+        batch_size=(3, 2),
+        n_agents=6,
+        obs_size=4,
+        agent_goup="agents",
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, 5))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        graph_config = {
+            "topology": "from_pos",
+            "self_loops": False,
+            "position_key": "pos",
+            "pos_features": 2,
+            "exclude_pos_from_node_features": False,
+            "edge_radius": 1.0,
+            "max_num_neighbors": max_num_neighbors,
+        }
+        model_kwargs = {
+            "input_spec": input_spec,
+            "output_spec": output_spec,
+            "agent_group": agent_goup,
+            "input_has_agent_dim": True,
+            "n_agents": n_agents,
+            "centralised": False,
+            "share_params": True,
+            "device": "cpu",
+            "action_spec": None,
+        }
+        actor = GnnConfig(
+            gnn_class=torch_geometric.nn.GATv2Conv, **graph_config
+        ).get_model(**model_kwargs)
+        critics = [
+            GnnConfig(gnn_class=torch_geometric.nn.GraphConv, **graph_config),
+            AttentionGnnConfig(num_heads=2, embed_dim=8, **graph_config),
+        ]
+        critics = [config.get_model(**model_kwargs) for config in critics]
+
+        n_radius_graphs = 0
+        radius_neighbours = benchmarl.models.gnn._radius_neighbours
+
+        def counting_radius_neighbours(*args, **kwargs):
+            nonlocal n_radius_graphs
+            n_radius_graphs += 1
+            return radius_neighbours(*args, **kwargs)
+
+        monkeypatch.setattr(
+            benchmarl.models.gnn, "_radius_neighbours", counting_radius_neighbours
+        )
+
+        input_td = input_spec.expand(batch_size).rand()
+        expected_outputs = [
+            model(input_td.clone()).get((agent_goup, "out"))
+            for model in [actor, *critics]
+        ]
+        assert n_radius_graphs == 3
+
+        # The graph built by the actor is reused by the critics
+        td = input_td.clone()
+        actor(td)
+        graph = td.get((agent_goup, GRAPH_CACHE_KEY))
+        assert len(graph.keys()) == 1
+        neighbours = graph.get(list(graph.keys())[0]).get("neighbours")
+        assert torch.equal(
+            _neighbours_to_edge_index(neighbours),
+            _radius_graph(
+                input_td.get((agent_goup, "pos")).view(-1, n_agents, 2),
+                r=1.0,
+                loop=False,
+                max_num_neighbors=max_num_neighbors,
+            ),
+        )
+        for model, expected_output in zip([actor, *critics], expected_outputs):
+            output = model(td).get((agent_goup, "out"))
+            torch.testing.assert_close(output, expected_output)
+        assert n_radius_graphs == 4
+
+        # A graph built from other positions is not reused
+        td.set((agent_goup, "pos"), td.get((agent_goup, "pos")) + 1)
+        critics[0](td)
+        assert n_radius_graphs == 5
+        # Nor is one whose positions were modified in place
+        td.get((agent_goup, "pos")).mul_(2)
+        critics[0](td)
+        assert n_radius_graphs == 6
+
+        # Stored graphs are part of the model inputs and outputs and are reused by models that store them
+        storing_config = GnnConfig(
+            gnn_class=torch_geometric.nn.GATv2Conv, store_graph=True, **graph_config
+        )
+        storing_actor = storing_config.get_model(**model_kwargs)
+        storing_actor.load_state_dict(actor.state_dict())
+        graph_keys = [
+            (agent_goup, STORED_GRAPH_KEY, key[-2], key[-1])
+            for key in td.get((agent_goup, GRAPH_CACHE_KEY)).keys(True, True)
+        ]
+        assert set(graph_keys) <= set(storing_actor.in_keys)
+        assert set(graph_keys) <= set(storing_actor.out_keys)
+        td = storing_actor(input_td.clone())
+        assert n_radius_graphs == 7
+        assert torch.equal(td.get(graph_keys[0]), neighbours)
+        torch.testing.assert_close(td.get((agent_goup, "out")), expected_outputs[0])
+        storing_actor(td.exclude((agent_goup, "out")))
+        assert n_radius_graphs == 7
+        graph_spec = storing_config._get_graph_spec(agent_goup, n_agents)
+        assert graph_spec.is_in(td.get(agent_goup).select(*graph_spec.keys()))
+
+        # In the collected data, which has no private keys, the stored graphs are reused
+        collected_td = td.exclude((agent_goup, GRAPH_CACHE_KEY))[1:]
+        output = storing_actor(collected_td).get((agent_goup, "out"))
+        assert n_radius_graphs == 7
+        torch.testing.assert_close(output, expected_outputs[0][1:])
+        # And shared with the models that do not store them
+        critics[0](collected_td)
+        assert n_radius_graphs == 7
+
+        # In collection, the stored graphs of the previous step are not reused
+        next_td = td.clone()
+        next_td.set((agent_goup, "pos"), next_td.get((agent_goup, "pos")) + 1)
+        storing_actor(next_td)
+        assert n_radius_graphs == 8
+
+
+class TestAttentionGnn:
+    @pytest.mark.parametrize("topology", ["full", "empty", "from_pos"])
+    @pytest.mark.parametrize("self_loops", [True, False])
+    @pytest.mark.parametrize("share_params", [True, False])
+    @pytest.mark.parametrize("velocity_key", ["vel", None])
+    @pytest.mark.parametrize("position_key", ["pos", None])
+    def test_attention_gnn(
+        self,
+        topology,
+        self_loops,
+        share_params,
+        velocity_key,
+        position_key,
+        batch_size=(3, 2),
+        n_agents=6,
+        obs_size=4,
+        pos_size=2,
+        vel_size=2,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        if topology == "from_pos" and position_key is None:
+            pytest.skip("from_pos topology needs a position_key")
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, pos_size)),
+                        "vel": Unbounded(shape=(n_agents, vel_size)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        model = AttentionGnnConfig(
+            topology=topology,
+            self_loops=self_loops,
+            num_heads=2,
+            embed_dim=8,
+            position_key=position_key,
+            pos_features=pos_size if position_key is not None else 0,
+            velocity_key=velocity_key,
+            vel_features=vel_size if velocity_key is not None else 0,
+            exclude_pos_from_node_features=False,
+            edge_radius=1.0,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=share_params,
+            device="cpu",
+            action_spec=None,
+        )
+        input_td = input_spec.expand(batch_size).rand()
+        output = model(input_td.clone()).get((agent_goup, "out"))
+        assert output_spec.expand(batch_size).is_in(model(input_td.clone()))
+        output.sum().backward()
+        for name, param in model.named_parameters():
+            # Without edges, the attention output does not depend on the node features
+            if topology != "empty" or self_loops or not name.startswith("qkv"):
+                assert param.grad is not None
+
+        # Compare with attention computed one agent at a time
+        pos = input_td.get((agent_goup, "pos")).reshape(-1, n_agents, pos_size)
+        vel = input_td.get((agent_goup, "vel")).reshape(-1, n_agents, vel_size)
+        x = [input_td.get((agent_goup, "observation")).reshape(-1, n_agents, obs_size)]
+        # Inputs that are not position_key or velocity_key come first
+        x += (
+            [vel, pos]
+            if position_key is not None and velocity_key is None
+            else [pos, vel]
+        )
+        x = torch.cat(x, dim=-1)
+        edge_pos = pos if position_key is not None else None
+        edge_vel = vel if velocity_key is not None else None
+        if edge_pos is not None or edge_vel is not None:
+            edge_attr = _dense_edge_attr(pos=edge_pos, vel=edge_vel)
+        q, k, v = (
+            t.unflatten(-1, (2, 4)) for t in model.qkv(x).detach().chunk(3, dim=-1)
+        )
+        expected_output = torch.zeros(x.shape[0], n_agents, out_features)
+        for b in range(x.shape[0]):
+            for i in range(n_agents):
+                p = 0 if share_params else i
+                neighbours = [
+                    j
+                    for j in range(n_agents)
+                    if (self_loops or j != i)
+                    and (
+                        topology == "full"
+                        or (topology == "empty" and j == i)
+                        or (
+                            topology == "from_pos"
+                            and torch.linalg.vector_norm(pos[b, j] - pos[b, i]) <= 1.0
+                        )
+                    )
+                ]
+                attention = torch.zeros(8)
+                if len(neighbours):
+                    scores = torch.stack(
+                        [(q[b, i] * k[b, j]).sum(-1) / 2 for j in neighbours]
+                    )
+                    if model.edge_bias is not None:
+                        scores += torch.stack(
+                            [
+                                torch.nn.functional.linear(
+                                    edge_attr[b, i, j],
+                                    model.edge_bias.weight[p],
+                                    model.edge_bias.bias[p],
+                                )
+                                for j in neighbours
+                            ]
+                        ).detach()
+                    attention = (
+                        (
+                            scores.softmax(0).unsqueeze(-1)
+                            * torch.stack([v[b, j] for j in neighbours])
+                        )
+                        .sum(0)
+                        .flatten()
+                    )
+                expected_output[b, i] = torch.nn.functional.linear(
+                    torch.cat([attention, x[b, i]]),
+                    model.out.weight[p],
+                    model.out.bias[p],
+                ).detach()
+        torch.testing.assert_close(
+            output.detach(), expected_output.view(*batch_size, n_agents, out_features)
+        )
+
+    @pytest.mark.parametrize("topology", ["full", "from_pos"])
+    def test_attention_gnn_edge_bias_vmap(
+        self,
+        topology,
+        batch_size=3,
+        n_agents=6,
+        obs_size=4,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        model = AttentionGnnConfig(
+            topology=topology,
+            self_loops=False,
+            num_heads=2,
+            embed_dim=8,
+            position_key="pos",
+            pos_features=2,
+            exclude_pos_from_node_features=False,
+            edge_radius=0.5,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=True,
+            device="cpu",
+            action_spec=None,
+        )
+        # The learned edge bias is differentiated under vmap, as in the value losses of off-policy algorithms
+        obs_input = input_spec.expand(2, batch_size).rand()
+
+        def forward(td):
+            return model(td).get((agent_goup, "out"))
+
+        output = torch.vmap(forward)(obs_input.clone())
+        expected_output = torch.stack([forward(td) for td in obs_input.clone()])
+        torch.testing.assert_close(output, expected_output)
+        output.sum().backward()
+        grads = [param.grad.clone() for param in model.edge_bias.parameters()]
+        # Outside of vmap, the fused kernel differentiates the bias in the mask
+        model.zero_grad()
+        expected_output.sum().backward()
+        for param, grad in zip(model.edge_bias.parameters(), grads):
+            torch.testing.assert_close(grad, param.grad)
+
+    @pytest.mark.parametrize("share_params", [True, False])
+    def test_attention_gnn_no_neighbours(
+        self,
+        share_params,
+        batch_size=3,
+        n_agents=1,
+        obs_size=4,
+        agent_goup="agents",
+        out_features=5,
+    ):
+        # A single agent without self loops has no neighbours, its attention output is 0
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, out_features))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        model = AttentionGnnConfig(
+            topology="full",
+            self_loops=False,
+            num_heads=2,
+            embed_dim=8,
+            position_key="pos",
+            pos_features=2,
+            exclude_pos_from_node_features=False,
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=share_params,
+            device="cpu",
+            action_spec=None,
+        )
+        assert model.edge_bias is not None
+        input_td = input_spec.expand(batch_size).rand()
+        x = torch.cat(
+            [
+                input_td.get((agent_goup, "observation")),
+                input_td.get((agent_goup, "pos")),
+            ],
+            dim=-1,
+        )
+        expected_output = model.out(
+            torch.cat([torch.zeros(batch_size, n_agents, 8), x], dim=-1)
+        )
+
+        output = model(input_td.clone()).get((agent_goup, "out"))
+        torch.testing.assert_close(output, expected_output)
+        output.sum().backward()
+        with torch.no_grad():
+            output = model(input_td.clone()).get((agent_goup, "out"))
+        torch.testing.assert_close(output, expected_output.detach())
+
+    def test_attention_gnn_sequence(
+        self, batch_size=(3, 2), n_agents=4, obs_size=4, agent_goup="agents"
+    ):
+        torch.manual_seed(0)
+        input_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {
+                        "observation": Unbounded(shape=(n_agents, obs_size)),
+                        "pos": Unbounded(shape=(n_agents, 2)),
+                    },
+                    shape=(n_agents,),
+                )
+            }
+        )
+        output_spec = Composite(
+            {
+                agent_goup: Composite(
+                    {"out": Unbounded(shape=(n_agents, 5))},
+                    shape=(n_agents,),
+                )
+            },
+        )
+        model = SequenceModelConfig(
+            model_configs=[
+                AttentionGnnConfig(
+                    topology="from_pos",
+                    self_loops=False,
+                    num_heads=2,
+                    embed_dim=8,
+                    position_key="pos",
+                    pos_features=2,
+                    exclude_pos_from_node_features=True,
+                    edge_radius=0.5,
+                    max_num_neighbors=2,
+                ),
+                MlpConfig.get_from_yaml(),
+            ],
+            intermediate_sizes=[6],
+        ).get_model(
+            input_spec=input_spec,
+            output_spec=output_spec,
+            agent_group=agent_goup,
+            input_has_agent_dim=True,
+            n_agents=n_agents,
+            centralised=False,
+            share_params=True,
+            device="cpu",
+            action_spec=None,
+        )
+        output = model(input_spec.expand(batch_size).rand())
+        assert output_spec.expand(batch_size).is_in(output)
+
 
 class TestDeepsets:
     @pytest.mark.parametrize("share_params", [True, False])
@@ -4,26 +4,155 @@
 #  LICENSE file in the root directory of this source tree.
 #
 
+import json
+import time
+from pathlib import Path
+
 import pytest
+import torch
+import torch_geometric
 from benchmarl.algorithms import (
     algorithm_config_registry,
     IddpgConfig,
     IppoConfig,
+    IqlConfig,
     IsacConfig,
     MaddpgConfig,
     MappoConfig,
     MasacConfig,
     QmixConfig,
+    VdnConfig,
 )
 from benchmarl.algorithms.common import AlgorithmConfig
 from benchmarl.environments import Task, VmasTask
-from benchmarl.experiment import Experiment
-from benchmarl.models import MlpConfig
+from benchmarl.eval_results import (
+    _decode_json_dict,
+    _encode_json_dict,
+    get_raw_dict_from_multirun_folder,
+    load_and_merge_json_dicts,
+    RESULTS_INDEX_FILE_NAME,
+)
+from benchmarl.experiment import Callback, Experiment
+from benchmarl.experiment.logger import JsonWriter
+from benchmarl.models import (
+    AttentionGnnConfig,
+    GnnConfig,
+    MlpConfig,
+    SequenceModelConfig,
+)
+from benchmarl.models.common import AGENT_MASK_KEY
+from benchmarl.models.gnn import STORED_GRAPH_KEY
+from benchmarl.utils import SEQUENCE_PADDING_KEY
+from tensordict import TensorDictBase
 from torch import nn
+from torchrl.data import Unbounded
+from torchrl.envs import Transform
 from utils import _has_vmas
 from utils_experiment import ExperimentUtils
 
 
+class StoredGraphCallback(Callback):
+    def on_batch_collected(self, batch: TensorDictBase):
+        assert len(batch.get(("agents", STORED_GRAPH_KEY)).keys()) == 1
+
+
+class SequenceWindowCallback(Callback):
+    def __init__(self, sequence_length: int):
+        super().__init__()
+        self.sequence_length = sequence_length
+
+    def on_train_step(self, batch: TensorDictBase, group: str):
+        assert batch.shape[1] == self.sequence_length
+
+
+class PaddedStepsLossCallback(Callback):
+    def __init__(self):
+        super().__init__()
+        self.n_padded_batches = 0
+
+    def on_train_step(self, batch: TensorDictBase, group: str):
+        padding = batch.get(SEQUENCE_PADDING_KEY, None)
+        if padding is None or not padding.any():
+            return
+        self.n_padded_batches += 1
+        # The losses do not depend on the padding steps
+        loss = self.experiment.losses[group]
+        padded_batch = batch.clone()
+        for key in ("advantage", "value_target"):
+            value = padded_batch.get((group, key))
+            padded_batch.set(
+                (group, key),
+                torch.where(padding.unsqueeze(-1).unsqueeze(-1), value + 100, value),
+            )
+        with torch.no_grad():
+            loss_vals = loss(batch.clone())
+            padded_loss_vals = loss(padded_batch)
+        for key in ("loss_objective", "loss_critic"):
+            torch.testing.assert_close(loss_vals.get(key), padded_loss_vals.get(key))
+
+
+class StoredHiddenStateCallback(Callback):
+    def __init__(self, dtype: torch.dtype):
+        super().__init__()
+        self.dtype = dtype
+
+    def on_batch_collected(self, batch: TensorDictBase):
+        for group in self.experiment.group_map.keys():
+            assert batch.get((group, "hidden_gru_0")).dtype == self.dtype
+            # Hidden states are stored once per frame
+            assert ("next", group, "hidden_gru_0") not in batch.keys(True)
+            assert (group, "_hidden_gru_0") not in batch.keys(True)
+
+
+class TrainStepCallback(Callback):
+    def __init__(self):
+        super().__init__()
+        self.groups = []
+        self.concurrent_calls = 0
+        self.max_concurrent_calls = 0
+
+    def on_train_step(self, batch: TensorDictBase, group: str):
+        self.concurrent_calls += 1
+        self.max_concurrent_calls = max(
+            self.max_concurrent_calls, self.concurrent_calls
+        )
+        # Gives the other groups the time to call the callback
+        time.sleep(0.01)
+        self.groups.append(group)
+        self.concurrent_calls -= 1
+
+
+class PadLastAgentTransform(Transform):
+    """Marks the last agent of the group as padded in the agent mask of the observations."""
+
+    def __init__(self, group: str, n_agents: int):
+        super().__init__()
+        self.key = (group, AGENT_MASK_KEY)
+        self.n_agents = n_agents
+
+    def _call(self, next_tensordict: TensorDictBase) -> TensorDictBase:
+        agent_mask = torch.ones(
+            *next_tensordict.batch_size,
+            self.n_agents,
+            dtype=torch.bool,
+            device=next_tensordict.device,
+        )
+        agent_mask[..., -1] = False
+        next_tensordict.set(self.key, agent_mask)
+        return next_tensordict
+
+    def _reset(self, tensordict, tensordict_reset):
+        return self._call(tensordict_reset)
+
+    def transform_observation_spec(self, observation_spec):
+        observation_spec[self.key] = Unbounded(
+            shape=(*observation_spec.shape, self.n_agents),
+            dtype=torch.bool,
+            device=observation_spec.device,
+        )
+        return observation_spec
+
+
 @pytest.mark.skipif(not _has_vmas, reason="VMAS not found")
 class TestVmas:
     @pytest.mark.parametrize("algo_config", algorithm_config_registry.values())
@@ -91,6 +220,358 @@ class TestVmas:
         )
         experiment.run()
 
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MasacConfig])
+    @pytest.mark.parametrize("max_policy_lag", [1, 2])
+    def test_async_collection(
+        self,
+        algo_config: AlgorithmConfig,
+        max_policy_lag: int,
+        experiment_config,
+        mlp_sequence_config,
+        task: Task = VmasTask.BALANCE,
+    ):
+        task = task.get_from_yaml()
+        experiment_config.async_collection = True
+        experiment_config.async_collection_max_policy_lag = max_policy_lag
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task,
+        )
+        experiment.run()
+        assert experiment.n_iters_performed == experiment_config.max_n_iters
+        assert 0 < experiment.collector.policy_lag <= max_policy_lag
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MasacConfig])
+    def test_async_collection_reloading(
+        self,
+        algo_config: AlgorithmConfig,
+        experiment_config,
+        mlp_sequence_config,
+        task: Task = VmasTask.BALANCE,
+    ):
+        experiment_config.async_collection = True
+        ExperimentUtils.check_experiment_loading(
+            algo_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            experiment_config=experiment_config,
+            task=task.get_from_yaml(),
+        )
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MasacConfig])
+    @pytest.mark.parametrize("async_collection", [False, True])
+    def test_collector_workers(
+        self,
+        algo_config: AlgorithmConfig,
+        async_collection: bool,
+        experiment_config,
+        mlp_sequence_config,
+        task: Task = VmasTask.BALANCE,
+    ):
+        task = task.get_from_yaml()
+        experiment_config.n_collector_workers = 2
+        experiment_config.pin_collector_workers = True
+        experiment_config.async_collection = async_collection
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task,
+        )
+        experiment.run()
+        assert experiment.n_iters_performed == experiment_config.max_n_iters
+
+        # Each worker collects the same number of frames from each of its envs
+        experiment_config.on_policy_collected_frames_per_batch = (
+            experiment_config.off_policy_collected_frames_per_batch
+        ) = 50
+        with pytest.raises(ValueError, match="collector workers"):
+            experiment_config.validate(experiment.on_policy)
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, IppoConfig])
+    def test_on_policy_epoch_sampler(
+        self,
+        algo_config: AlgorithmConfig,
+        experiment_config,
+        mlp_sequence_config,
+        task: Task = VmasTask.BALANCE,
+    ):
+        task = task.get_from_yaml()
+        experiment_config.on_policy_use_epoch_sampler = True
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task,
+        )
+        experiment.run()
+
+        # Each epoch samples every frame exactly once
+        buffer = experiment.replay_buffers["agents"]
+        n_minibatches = -(-len(buffer) // experiment_config.on_policy_minibatch_size)
+        indices = torch.cat([buffer.sample()["index"] for _ in range(n_minibatches)])
+        assert torch.equal(indices.sort().values, torch.arange(len(buffer)))
+
+    @pytest.mark.parametrize("algo_config", [MasacConfig, QmixConfig])
+    @pytest.mark.parametrize("prioritised_buffer", [False, True])
+    def test_off_policy_prefetch(
+        self,
+        algo_config: AlgorithmConfig,
+        prioritised_buffer: bool,
+        experiment_config,
+        mlp_sequence_config,
+        task: Task = VmasTask.BALANCE,
+    ):
+        task = task.get_from_yaml()
+        experiment_config.prefer_continuous_actions = (
+            algo_config.supports_continuous_actions()
+        )
+        experiment_config.off_policy_use_prioritized_replay_buffer = prioritised_buffer
+        experiment_config.off_policy_prefetch_batches = 2
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task,
+        )
+        # The prefetching threads do not sample from the global generator
+        assert all(
+            buffer._rng is not None for buffer in experiment.replay_buffers.values()
+        )
+        experiment.run()
+        assert experiment.n_iters_performed == experiment_config.max_n_iters
+
+    def test_json_results(
+        self,
+        experiment_config,
+        mlp_sequence_config,
+        algo_config: AlgorithmConfig = MappoConfig,
+        task: Task = VmasTask.BALANCE,
+    ):
+        task = task.get_from_yaml()
+        experiment_config.evaluation_interval = (
+            experiment_config.on_policy_collected_frames_per_batch
+        )
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task,
+        )
+        json_writer = experiment.logger.json_writer
+        experiment.run()
+
+        # The jsonl file has been compacted in the marl-eval json file
+        assert not json_writer.jsonl_path.exists()
+        raw_dict = load_and_merge_json_dicts([str(json_writer.path)])
+        assert raw_dict == json_writer.data
+        run_data = raw_dict["vmas"]["balance"]["mappo"]["seed_0"]
+        assert len(run_data) == experiment_config.max_n_iters + 1
+
+        # Loading the folder builds the results index, which is used in following loads
+        for _ in range(2):
+            assert (
+                get_raw_dict_from_multirun_folder(experiment_config.save_folder)
+                == raw_dict
+            )
+        index_file = Path(experiment_config.save_folder) / RESULTS_INDEX_FILE_NAME
+        assert index_file.exists()
+        # A corrupted index is rebuilt
+        index_file.write_bytes(b"not an sqlite database")
+        with pytest.warns(UserWarning, match="Rebuilding the corrupted results index"):
+            assert (
+                get_raw_dict_from_multirun_folder(experiment_config.save_folder)
+                == raw_dict
+            )
+        assert (
+            get_raw_dict_from_multirun_folder(experiment_config.save_folder) == raw_dict
+        )
+
+        # The jsonl file can be read while being written
+        data = json_writer.data
+        json_writer.path.unlink()
+        json_writer = JsonWriter(
+            folder=str(json_writer.path.parent),
+            name=json_writer.path.name,
+            algorithm_name="mappo",
+            task_name="balance",
+            environment_name="vmas",
+            seed=0,
+        )
+        for step in range(1, experiment_config.max_n_iters + 1):
+            step_data = run_data[f"step_{step}"]
+            json_writer.write(
+                total_frames=step_data["step_count"],
+                metrics={
+                    key: torch.tensor(value)
+                    for key, value in step_data.items()
+                    if key != "step_count"
+                },
+                evaluation_step=step,
+            )
+        assert load_and_merge_json_dicts([str(json_writer.jsonl_path)]) == data
+        # The index is updated with the changed files
+        assert get_raw_dict_from_multirun_folder(
+            experiment_config.save_folder
+        ) == get_raw_dict_from_multirun_folder(
+            experiment_config.save_folder, use_index=False
+        )
+        json_writer.finish()
+        assert load_and_merge_json_dicts([str(json_writer.path)]) == data
+
+        # The index keeps the types of all json values
+        json_dict = {
+            "a": {"b": [0.5, 1.0], "c": 3, "d": [], "e": [1, 2.5], "f": 2**70},
+            "g": ["text", None, True, {"h": 1.5}],
+            "i": 1.0,
+        }
+        assert json.dumps(
+            _decode_json_dict(*_encode_json_dict(json_dict))
+        ) == json.dumps(json_dict)
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MasacConfig])
+    @pytest.mark.parametrize("task", [VmasTask.SIMPLE_TAG])
+    def test_concurrent_group_training(
+        self,
+        algo_config: AlgorithmConfig,
+        task: Task,
+        experiment_config,
+        mlp_sequence_config,
+    ):
+        task = task.get_from_yaml()
+        experiment_config.concurrent_group_training = True
+        callback = TrainStepCallback()
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task,
+            callbacks=[callback],
+        )
+        assert experiment._group_executor is not None
+        experiment.run()
+        assert experiment.n_iters_performed == experiment_config.max_n_iters
+        # The training step callbacks of the groups are called one at a time
+        assert callback.max_concurrent_calls == 1
+        assert set(callback.groups) == set(experiment.train_group_map.keys())
+
+    @pytest.mark.parametrize(
+        "algo_config",
+        [
+            MappoConfig,
+            IppoConfig,
+            MasacConfig,
+            IsacConfig,
+            MaddpgConfig,
+            IddpgConfig,
+            IqlConfig,
+        ],
+    )
+    @pytest.mark.parametrize("prefer_continuous", [True, False])
+    @pytest.mark.parametrize("task", [VmasTask.BALANCE])
+    def test_padded_agents_loss(
+        self,
+        algo_config: AlgorithmConfig,
+        prefer_continuous: bool,
+        task: Task,
+        experiment_config,
+        monkeypatch,
+    ):
+        # Without parameter sharing, each agent has its own slice of the parameters,
+        # which gets no gradient from the losses when the agent is padded
+        experiment_config.prefer_continuous_actions = prefer_continuous
+        experiment_config.share_policy_params = False
+        algorithm_config = algo_config.get_from_yaml()
+        if algorithm_config.has_critic():
+            algorithm_config.share_param_critic = False
+        task = task.get_from_yaml()
+        group, n_agents = "agents", task.config["n_agents"]
+        monkeypatch.setattr(
+            type(task),
+            "get_env_transforms",
+            lambda self, env: [PadLastAgentTransform(group, n_agents)],
+        )
+        experiment = Experiment(
+            algorithm_config=algorithm_config,
+            model_config=MlpConfig.get_from_yaml(),
+            critic_model_config=MlpConfig.get_from_yaml(),
+            seed=0,
+            config=experiment_config,
+            task=task,
+        )
+        batch = experiment.algorithm.process_batch(
+            group, next(iter(experiment.collector))
+        ).reshape(-1)
+        assert not batch[group, AGENT_MASK_KEY][..., -1].any()
+
+        def get_loss_vals(batch):
+            torch.manual_seed(0)
+            return experiment.algorithm.process_loss_vals(
+                group, experiment.losses[group](batch)
+            )
+
+        loss_vals = get_loss_vals(batch)
+        # The loss terms of the padded agent are left out
+        padded_batch = batch.clone()
+        for key in [
+            ("next", group, "reward"),
+            (group, "advantage"),
+            (group, "value_target"),
+        ]:
+            if key in padded_batch.keys(True):
+                padded_batch[key][..., -1, :] += 100
+        padded_loss_vals = get_loss_vals(padded_batch)
+        for loss_name in experiment.optimizers[group].keys():
+            torch.testing.assert_close(
+                padded_loss_vals[loss_name], loss_vals[loss_name]
+            )
+        for loss_name, optimizer in experiment.optimizers[group].items():
+            params = [p for g in optimizer.param_groups for p in g["params"]]
+            agent_params = [p for p in params if n_agents in p.shape]
+            if not len(agent_params):
+                continue
+            optimizer.zero_grad()
+            loss_vals[loss_name].backward(retain_graph=True)
+            grads = [
+                p.grad.select(list(p.shape).index(n_agents), n_agents - 1)
+                for p in agent_params
+                if p.grad is not None
+            ]
+            assert len(grads)
+            assert all((grad == 0).all() for grad in grads)
+        experiment.close()
+
+    def test_padded_agents_not_supported(
+        self,
+        experiment_config,
+        monkeypatch,
+        algo_config: AlgorithmConfig = VdnConfig,
+        task: Task = VmasTask.BALANCE,
+    ):
+        # The mixed value loss (also used by QMIX) would average the padded agents
+        task = task.get_from_yaml()
+        group, n_agents = "agents", task.config["n_agents"]
+        monkeypatch.setattr(
+            type(task),
+            "get_env_transforms",
+            lambda self, env: [PadLastAgentTransform(group, n_agents)],
+        )
+        with pytest.raises(ValueError, match="does not support padded agents"):
+            Experiment(
+                algorithm_config=algo_config.get_from_yaml(),
+                model_config=MlpConfig.get_from_yaml(),
+                seed=0,
+                config=experiment_config,
+                task=task,
+            )
+
     @pytest.mark.parametrize(
         "algo_config", [IppoConfig, QmixConfig, IsacConfig, IddpgConfig]
     )
@@ -113,6 +594,171 @@ class TestVmas:
         )
         experiment.run()
 
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MasacConfig])
+    @pytest.mark.parametrize("share_params", [True, False])
+    @pytest.mark.parametrize("task", [VmasTask.NAVIGATION])
+    def test_attention_gnn(
+        self,
+        algo_config: AlgorithmConfig,
+        share_params: bool,
+        task: Task,
+        experiment_config,
+    ):
+        model_config = SequenceModelConfig(
+            model_configs=[
+                AttentionGnnConfig(
+                    topology="full",
+                    self_loops=False,
+                    num_heads=2,
+                    embed_dim=8,
+                ),
+                MlpConfig(
+                    num_cells=[4], activation_class=nn.Tanh, layer_class=nn.Linear
+                ),
+            ],
+            intermediate_sizes=[5],
+        )
+        algo_config = algo_config.get_from_yaml()
+        algo_config.share_param_critic = share_params
+        experiment_config.share_policy_params = share_params
+        experiment = Experiment(
+            algorithm_config=algo_config,
+            model_config=model_config,
+            critic_model_config=model_config,
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+        )
+        experiment.run()
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MasacConfig])
+    @pytest.mark.parametrize("topology", ["full", "from_pos"])
+    @pytest.mark.parametrize("task", [VmasTask.NAVIGATION])
+    def test_attention_gnn_edge_features(
+        self,
+        algo_config: AlgorithmConfig,
+        topology: str,
+        task: Task,
+        experiment_config,
+    ):
+        # With a position key, the attention has a learned edge bias, which is differentiated under vmap by MASAC
+        model_config = AttentionGnnConfig(
+            topology=topology,
+            self_loops=False,
+            num_heads=2,
+            embed_dim=8,
+            position_key="observation",
+            pos_features=18,
+            exclude_pos_from_node_features=False,
+            edge_radius=2.0 if topology == "from_pos" else None,
+        )
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=model_config,
+            critic_model_config=model_config,
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+        )
+        experiment.run()
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, IppoConfig, MasacConfig])
+    @pytest.mark.parametrize("gnn_critic", [False, True])
+    @pytest.mark.parametrize("task", [VmasTask.NAVIGATION])
+    def test_gnn_store_graph(
+        self,
+        algo_config: AlgorithmConfig,
+        gnn_critic: bool,
+        task: Task,
+        experiment_config,
+    ):
+        # Navigation has no position key, so the observation is used as position
+        model_config = GnnConfig(
+            topology="from_pos",
+            self_loops=False,
+            gnn_class=torch_geometric.nn.GraphConv,
+            position_key="observation",
+            pos_features=18,
+            exclude_pos_from_node_features=False,
+            edge_radius=2.0,
+            store_graph=True,
+        )
+
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=model_config,
+            critic_model_config=(
+                model_config if gnn_critic else MlpConfig.get_from_yaml()
+            ),
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+            callbacks=[StoredGraphCallback()],
+        )
+        experiment.run()
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, IppoConfig])
+    @pytest.mark.parametrize(
+        "gnn_class", [torch_geometric.nn.GraphConv, torch_geometric.nn.GATv2Conv]
+    )
+    @pytest.mark.parametrize("task", [VmasTask.NAVIGATION])
+    def test_gnn_from_pos_critic(
+        self,
+        algo_config: AlgorithmConfig,
+        gnn_class,
+        task: Task,
+        experiment_config,
+    ):
+        # The value estimator of on-policy algorithms vmaps the critic, which builds a different graph for each element
+        critic_model_config = GnnConfig(
+            topology="from_pos",
+            self_loops=False,
+            gnn_class=gnn_class,
+            position_key="observation",
+            pos_features=18,
+            exclude_pos_from_node_features=False,
+            edge_radius=2.0,
+        )
+
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=MlpConfig.get_from_yaml(),
+            critic_model_config=critic_model_config,
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+        )
+        experiment.run()
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig])
+    @pytest.mark.parametrize("task", [VmasTask.NAVIGATION])
+    def test_gnn_from_pos_actor_critic(
+        self,
+        algo_config: AlgorithmConfig,
+        task: Task,
+        experiment_config,
+    ):
+        # The actor and the critic have the same graph configuration, so they share the cached graph
+        model_config = GnnConfig(
+            topology="from_pos",
+            self_loops=False,
+            gnn_class=torch_geometric.nn.GraphConv,
+            position_key="observation",
+            pos_features=18,
+            exclude_pos_from_node_features=False,
+            edge_radius=2.0,
+        )
+
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=model_config,
+            critic_model_config=model_config,
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+        )
+        experiment.run()
+
     @pytest.mark.parametrize(
         "algo_config", [MaddpgConfig, IppoConfig, QmixConfig, MasacConfig]
     )
@@ -167,6 +813,67 @@ class TestVmas:
         )
         experiment.run()
 
+    @pytest.mark.parametrize("algo_config", [MappoConfig, QmixConfig, MasacConfig])
+    @pytest.mark.parametrize("rnn_burn_in", [0, 3])
+    @pytest.mark.parametrize("task", [VmasTask.NAVIGATION])
+    def test_rnn_sequence_windows(
+        self,
+        algo_config: AlgorithmConfig,
+        rnn_burn_in: int,
+        task: Task,
+        experiment_config,
+        gru_mlp_sequence_config,
+        lstm_mlp_sequence_config,
+        rnn_sequence_length: int = 8,
+    ):
+        experiment_config.rnn_sequence_length = rnn_sequence_length
+        experiment_config.rnn_burn_in = rnn_burn_in
+        padded_steps_callback = PaddedStepsLossCallback()
+        callbacks = [SequenceWindowCallback(rnn_sequence_length)]
+        if algo_config is MappoConfig:
+            # The last window of the collected sequences is padded
+            callbacks.append(padded_steps_callback)
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=gru_mlp_sequence_config,
+            critic_model_config=lstm_mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+            callbacks=callbacks,
+        )
+        experiment.run()
+        if algo_config is MappoConfig:
+            assert padded_steps_callback.n_padded_batches > 0
+
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MaddpgConfig])
+    @pytest.mark.parametrize("rnn_burn_in", [0, 3])
+    @pytest.mark.parametrize("collect_with_grad", [False, True])
+    @pytest.mark.parametrize("task", [VmasTask.NAVIGATION])
+    def test_rnn_store_hidden_state(
+        self,
+        algo_config: AlgorithmConfig,
+        rnn_burn_in: int,
+        collect_with_grad: bool,
+        task: Task,
+        experiment_config,
+        gru_mlp_sequence_config,
+    ):
+        experiment_config.collect_with_grad = collect_with_grad
+        experiment_config.rnn_sequence_length = 8
+        experiment_config.rnn_burn_in = rnn_burn_in
+        gru_mlp_sequence_config.model_configs[0].store_hidden_state = True
+        gru_mlp_sequence_config.model_configs[0].hidden_state_storage_dtype = "bfloat16"
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=gru_mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+            callbacks=[StoredHiddenStateCallback(torch.bfloat16)],
+        )
+        experiment.run()
+
     @pytest.mark.parametrize("algo_config", algorithm_config_registry.values())
     @pytest.mark.parametrize("task", [VmasTask.BALANCE])
     def test_reloading_trainer(
@@ -185,6 +892,43 @@ class TestVmas:
             task=task.get_from_yaml(),
         )
 
+    @pytest.mark.parametrize("algo_config", [MappoConfig, MasacConfig])
+    @pytest.mark.parametrize("task", [VmasTask.BALANCE])
+    def test_async_checkpointing(
+        self,
+        algo_config: AlgorithmConfig,
+        task: Task,
+        experiment_config,
+        mlp_sequence_config,
+    ):
+        experiment_config.async_checkpointing = True
+        experiment_config.keep_checkpoints_num = 2
+        experiment = Experiment(
+            algorithm_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            seed=0,
+            config=experiment_config,
+            task=task.get_from_yaml(),
+        )
+        experiment.run()
+        checkpoint_files = sorted(
+            (experiment.folder_name / "checkpoints").iterdir(),
+            key=lambda file: file.stat().st_mtime_ns,
+        )
+        assert [file.name for file in checkpoint_files] == [
+            f"checkpoint_{experiment.total_frames - experiment_config.checkpoint_interval}.pt",
+            f"checkpoint_{experiment.total_frames}.pt",
+        ]
+
+        experiment_config.keep_checkpoints_num = None
+        experiment_config.save_folder = str(experiment.folder_name.parent)
+        ExperimentUtils.check_experiment_loading(
+            algo_config=algo_config.get_from_yaml(),
+            model_config=mlp_sequence_config,
+            experiment_config=experiment_config,
+            task=task.get_from_yaml(),
+        )
+
     @pytest.mark.parametrize(
         "algo_config", [QmixConfig, IppoConfig, MaddpgConfig, MasacConfig]
     )